@@ -1,34 +1,58 @@
+import startup  # first, so it can time everything below
+
 import os
 import json
 import io
 import base64
 import datetime
-import bcrypt
-import jwt
+import time
+import signal
+import threading
+import zoneinfo
 from functools import wraps
-from flask import Flask, request, jsonify, render_template, send_file
-from flask_cors import CORS
-from supabase import create_client, Client
 from dotenv import load_dotenv
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.units import mm, cm
-from reportlab.lib.colors import HexColor
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image as RLImage
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT
 
 load_dotenv()
 
+with startup.timed('import:flask'):
+    import click
+    import jwt
+    from flask import Flask, request, jsonify, render_template, send_file, stream_with_context, g
+    from flask_cors import CORS
+    from werkzeug.middleware.proxy_fix import ProxyFix
+
+# ReportLab, the Supabase SDK, bcrypt, Pillow and openpyxl are not imported
+# here: each module loads them on first use (see startup.py)
+with startup.timed('import:modules'):
+    import db
+    import cache
+    import photos
+    import pdf
+    import settings
+    import reference
+    import auth
+    import metrics
+    import pricing
+    import responses
+    import signatures
+    import jobs
+    import bulk
+    import bus
+
+# A CACHE_BUS that cannot work (unknown, or postgres without psycopg or
+# DATABASE_URL) stops the app here instead of failing the first write
+bus.get_bus()
+
 app = Flask(__name__)
-CORS(app)
+# Render terminates TLS in front of us; trust its X-Forwarded-For for the
+# client address (login throttling is per IP)
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=int(os.environ.get('PROXY_HOPS', 1)))
+CORS(app, expose_headers=['X-Next-Cursor'])
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'pressureflow-secret-key-change-me')
 
-# Supabase client
-SUPABASE_URL = os.environ.get('SUPABASE_URL', '')
-SUPABASE_KEY = os.environ.get('SUPABASE_KEY', '')
-
-def get_supabase() -> Client:
-    return create_client(SUPABASE_URL, SUPABASE_KEY)
+# Supabase client (one pooled client per worker process, see db.py)
+def get_supabase():
+    return db.get_client()
 
 # ─── AUTH HELPERS ───────────────────────────────────────────────
 def token_required(f):
@@ -47,7 +71,9 @@ def token_required(f):
             return jsonify({'error': 'Token verlopen'}), 401
         except jwt.InvalidTokenError:
             return jsonify({'error': 'Ongeldig token'}), 401
-        return f(*args, **kwargs)
+        # Identical reads are only shared between users of the same role
+        with db.read_scope(request.user_role):
+            return f(*args, **kwargs)
     return decorated
 
 def admin_required(f):
@@ -58,21 +84,82 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated
 
+# ─── INSTRUMENTATION ────────────────────────────────────────────
+@app.before_request
+def start_request_metrics():
+    g.request_stats, g.request_stats_token = metrics.start_request()
+
+@app.after_request
+def record_request_metrics(response):
+    stats = g.get('request_stats')
+    if stats is None:
+        return response
+    elapsed = time.perf_counter() - stats.started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    db_calls = len(stats.calls)
+    db_seconds = sum(call[3] for call in stats.calls)
+    
+    metrics.REQUEST_SECONDS.observe(elapsed, request.method, route, str(response.status_code))
+    metrics.REQUEST_BYTES.observe(request.content_length or 0, route)
+    if not response.is_streamed:
+        metrics.RESPONSE_BYTES.observe(response.content_length or 0, route)
+    metrics.SUPABASE_CALLS.observe(db_calls, route)
+    metrics.SUPABASE_REQUEST_SECONDS.observe(db_seconds, route)
+    
+    if elapsed >= metrics.SLOW_REQUEST_SECONDS:
+        metrics.SLOW_REQUESTS.inc(route)
+        breakdown = ', '.join(f'{method} {resource} {status or "error"} {seconds * 1000:.0f}ms'
+                              for method, resource, status, seconds in stats.calls)
+        app.logger.warning('Slow request %s %s → %s in %.0fms; %d Supabase calls (%.0fms): %s',
+                           request.method, request.path, response.status_code, elapsed * 1000,
+                           db_calls, db_seconds * 1000, breakdown or '-')
+    return response
+
+@app.after_request
+def record_first_response(response):
+    startup.first_response()
+    return response
+
+@app.teardown_request
+def end_request_metrics(exc):
+    token = g.pop('request_stats_token', None)
+    if token is not None:
+        metrics.end_request(token)
+
+@app.route('/api/metrics', methods=['GET'])
+@token_required
+@admin_required
+def get_metrics():
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# ─── RESPONSE ENCODING ──────────────────────────────────────────
+# orjson for jsonify, gzip/brotli for large bodies (see responses.py)
+responses.init_app(app)
+
 # ─── PAGES ──────────────────────────────────────────────────────
 @app.route('/')
 def index():
     return send_file('templates/index.html')
 
+@app.route('/api/health')
+def health():
+    if not db.healthcheck():
+        return jsonify({'status': 'error', 'database': 'onbereikbaar'}), 503
+    return jsonify({'status': 'ok'})
+
 # ─── AUTH ROUTES ────────────────────────────────────────────────
+@app.errorhandler(auth.AuthBusy)
+def auth_busy(e):
+    return jsonify({'error': 'Te veel inlogpogingen tegelijk, probeer het zo opnieuw'}), 503, {'Retry-After': '2'}
+
 @app.route('/api/auth/register', methods=['POST'])
 def register():
     data = request.json
     sb = get_supabase()
-    hashed = bcrypt.hashpw(data['password'].encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    hashed = auth.hash_password(data['password'])
     
-    # Check if any users exist (first user becomes admin)
-    existing = sb.table('users').select('id').limit(1).execute()
-    role = 'admin' if len(existing.data) == 0 else data.get('role', 'technician')
+    # First user becomes admin
+    role = data.get('role', 'technician') if auth.users_exist(sb) else 'admin'
     
     try:
         result = sb.table('users').insert({
@@ -81,6 +168,7 @@ def register():
             'password_hash': hashed,
             'role': role
         }).execute()
+        auth.mark_users_exist()
         return jsonify({'message': 'Account aangemaakt', 'role': role}), 201
     except Exception as e:
         return jsonify({'error': str(e)}), 400
@@ -88,16 +176,26 @@ def register():
 @app.route('/api/auth/login', methods=['POST'])
 def login():
     data = request.json
+    wait = auth.login_throttle.attempt(request.remote_addr, data.get('email', ''))
+    if wait:
+        return jsonify({'error': 'Te veel inlogpogingen, probeer het later opnieuw'}), 429, {'Retry-After': str(wait)}
     sb = get_supabase()
     
     try:
-        result = sb.table('users').select('*').eq('email', data['email']).execute()
+        result = sb.table('users').select('id, name, email, role, password_hash').eq('email', data['email']).execute()
         if not result.data:
+            auth.login_throttle.failed(data['email'])
             return jsonify({'error': 'Ongeldige inloggegevens'}), 401
         
         user = result.data[0]
-        if not bcrypt.checkpw(data['password'].encode('utf-8'), user['password_hash'].encode('utf-8')):
+        if not auth.check_password(data['password'], user['password_hash']):
+            auth.login_throttle.failed(data['email'])
             return jsonify({'error': 'Ongeldige inloggegevens'}), 401
+        auth.login_throttle.succeeded(data['email'])
+        
+        if auth.needs_rehash(user['password_hash']):
+            # BCRYPT_ROUNDS changed since this hash was made
+            sb.table('users').update({'password_hash': auth.hash_password(data['password'])}).eq('id', user['id']).execute()
         
         token = jwt.encode({
             'user_id': user['id'],
@@ -109,64 +207,230 @@ def login():
             'token': token,
             'user': {'id': user['id'], 'name': user['name'], 'email': user['email'], 'role': user['role']}
         })
+    except auth.AuthBusy:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# ─── LIST HELPERS ───────────────────────────────────────────────
+# List endpoints return one page at a time, ordered by (order column, id).
+# The opaque cursor for the next page is sent in the X-Next-Cursor header.
+LIST_PAGE_SIZE = int(os.environ.get('LIST_PAGE_SIZE', 100))
+LIST_MAX_PAGE_SIZE = 500
+NDJSON_BATCH_SIZE = 1000
+
+# Customer search returns only the best ranked matches
+SEARCH_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+SEARCH_MAX_QUERY = 100
+
+LIST_SPECS = {
+    'customers': {
+        'order': 'created_at', 'desc': True,
+        'columns': ('id', 'name', 'address', 'phone', 'email', 'parking_situation', 'water_tap_location',
+                    'water_pressure_lpm', 'notes', 'created_at', 'updated_at'),
+        'embeds': {},
+        'default': None,
+    },
+    'estimates': {
+        'order': 'created_at', 'desc': True,
+        'columns': ('id', 'customer_id', 'user_id', 'status', 'subtotal', 'btw_percentage', 'total_incl_btw',
+                    'signature_sha256', 'signature_data', 'notes', 'created_at', 'updated_at'),
+        'embeds': {'customers': 'customers(name, address, phone)'},
+        # signature_data is a legacy base64 PNG; only sent when asked for explicitly
+        'default': ('id', 'customer_id', 'user_id', 'status', 'subtotal', 'btw_percentage', 'total_incl_btw',
+                    'notes', 'created_at', 'updated_at', 'customers'),
+    },
+    'inventory': {
+        'order': 'item_name', 'desc': False,
+        'columns': ('id', 'item_name', 'quantity_on_hand', 'unit', 'threshold_warning', 'created_at', 'updated_at'),
+        'embeds': {},
+        'default': None,
+    },
+    'users': {
+        'order': 'created_at', 'desc': False,
+        'columns': ('id', 'name', 'email', 'role', 'created_at'),
+        'embeds': {},
+        'default': None,
+    },
+}
+
+def encode_cursor(row, order_col):
+    raw = json.dumps([row[order_col], row['id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    value, row_id = json.loads(raw)
+    return value, row_id
+
+def pg_quote(value):
+    # Quoted value inside a PostgREST or=(...) filter
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def list_columns(spec):
+    fields = request.args.get('fields', '')
+    names = [f.strip() for f in fields.split(',') if f.strip()] or list(spec['default'] or spec['columns'])
+    for name in names:
+        if name not in spec['columns'] and name not in spec['embeds']:
+            raise ValueError(name)
+    # The cursor is built from the order column and id
+    for required in (spec['order'], 'id'):
+        if required not in names:
+            names.append(required)
+    return ','.join(spec['embeds'].get(name, name) for name in names)
+
+def fetch_page(table, columns, apply_filters, cursor, limit):
+    spec = LIST_SPECS[table]
+    col = spec['order']
+    op, direction = ('lt', '.desc') if spec['desc'] else ('gt', '')
+    query = apply_filters(get_supabase().table(table).select(columns))
+    if cursor:
+        value, last_id = cursor
+        query.params = query.params.add(
+            'or', f'({col}.{op}.{pg_quote(value)},and({col}.eq.{pg_quote(value)},id.{op}.{pg_quote(last_id)}))'
+        )
+    query.params = query.params.add('order', f'{col}{direction},id{direction}').add('limit', limit)
+    return query.execute().data
+
+def paged_list(table, apply_filters=lambda query: query):
+    spec = LIST_SPECS[table]
+    try:
+        columns = list_columns(spec)
+        limit = min(int(request.args.get('limit', LIST_PAGE_SIZE)), LIST_MAX_PAGE_SIZE)
+        cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Ongeldige fields, limit of cursor parameter'}), 400
+    if limit < 1:
+        return jsonify({'error': 'Ongeldige fields, limit of cursor parameter'}), 400
+    
+    if request.args.get('format') == 'ndjson':
+        # Full export: walk all pages, one JSON object per line
+        def generate(cursor):
+            while True:
+                rows = fetch_page(table, columns, apply_filters, cursor, NDJSON_BATCH_SIZE)
+                for row in rows:
+                    yield json.dumps(row, default=str) + '\n'
+                if len(rows) < NDJSON_BATCH_SIZE:
+                    break
+                cursor = (rows[-1][spec['order']], rows[-1]['id'])
+        return app.response_class(stream_with_context(generate(cursor)), mimetype='application/x-ndjson')
+    
+    rows = fetch_page(table, columns, apply_filters, cursor, limit + 1)
+    response = jsonify(rows[:limit])
+    if len(rows) > limit:
+        response.headers['X-Next-Cursor'] = encode_cursor(rows[limit - 1], spec['order'])
+    return response
+
 # ─── DASHBOARD ──────────────────────────────────────────────────
+# Snapshot shared by everyone opening the app; dropped as soon as an estimate,
+# inventory item or customer changes, and at most DASHBOARD_CACHE_TTL old.
+dashboard_cache = cache.TTLCache(int(os.environ.get('DASHBOARD_CACHE_TTL', 30)),
+                                 tags=('estimates', 'inventory', 'customers'))
+
+def load_dashboard_snapshot(month_start, last_month_start):
+    # Counts, revenue sums and low-stock items are computed in one RPC
+    summary = db.rpc('dashboard_summary', {
+        'p_month_start': month_start.isoformat(),
+        'p_last_month_start': last_month_start.isoformat()
+    })
+    summary['month_revenue'] = float(summary['month_revenue'] or 0)
+    summary['last_month_revenue'] = float(summary['last_month_revenue'] or 0)
+    return summary
+
 @app.route('/api/dashboard', methods=['GET'])
 @token_required
 def get_dashboard():
-    sb = get_supabase()
-    today = datetime.date.today().isoformat()
-    
-    # Get today's jobs
-    today_jobs = sb.table('estimates').select('*, customers(name, address)').eq('status', 'akkoord').execute()
-    
-    # Get open quotes
-    open_quotes = sb.table('estimates').select('id').eq('status', 'offerte').execute()
-    
-    # Revenue this month
-    now = datetime.date.today()
-    month_start = now.replace(day=1).isoformat()
-    revenue = sb.table('estimates').select('total_incl_btw').in_('status', ['voltooid', 'factuur', 'betaald']).gte('updated_at', month_start).execute()
-    month_revenue = sum(float(r['total_incl_btw']) for r in revenue.data)
-    
-    # Revenue last month
-    last_month_end = now.replace(day=1) - datetime.timedelta(days=1)
-    last_month_start = last_month_end.replace(day=1).isoformat()
-    last_revenue = sb.table('estimates').select('total_incl_btw').in_('status', ['voltooid', 'factuur', 'betaald']).gte('updated_at', last_month_start).lte('updated_at', last_month_end.isoformat()).execute()
-    last_month_revenue = sum(float(r['total_incl_btw']) for r in last_revenue.data)
-    
-    # Inventory warnings
-    inventory = sb.table('inventory').select('*').execute()
-    warnings = [i for i in inventory.data if float(i['quantity_on_hand']) <= float(i['threshold_warning'])]
-    
-    # Customer count
-    customers = sb.table('customers').select('id', count='exact').execute()
-    
-    result = {
-        'today_jobs': today_jobs.data,
-        'open_quotes_count': len(open_quotes.data),
-        'month_revenue': month_revenue,
-        'last_month_revenue': last_month_revenue,
-        'inventory_warnings': warnings,
-        'customer_count': customers.count or 0,
-        'is_admin': request.user_role == 'admin'
-    }
-    
+    month_start = datetime.date.today().replace(day=1)
+    last_month_start = (month_start - datetime.timedelta(days=1)).replace(day=1)
+    snapshot = dashboard_cache.get_or_set(
+        month_start.isoformat(),
+        lambda: load_dashboard_snapshot(month_start, last_month_start)
+    )
+    result = dict(snapshot)
+    result['is_admin'] = request.user_role == 'admin'
     return jsonify(result)
 
+# ─── REPORTS ────────────────────────────────────────────────────
+REPORT_PERIODS = ('day', 'week', 'month', 'quarter', 'year', 'total')
+REPORT_GROUPS = {'user': ('user_id', 'user_name'), 'service': ('service_id', 'service_name'),
+                 'btw': ('btw_percentage',)}
+REPORT_SUMS = ('jobs', 'lines', 'subtotal', 'btw', 'total_incl_btw')
+
+@app.route('/api/reports/revenue', methods=['GET'])
+@token_required
+@admin_required
+def revenue_report():
+    # Answered from the revenue_rollups table, which triggers keep up to date
+    # (see supabase_setup.sql): the cost depends on the period, not on the
+    # number of estimates
+    today = datetime.date.today()
+    try:
+        date_from = datetime.date.fromisoformat(request.args.get('from') or today.replace(month=1, day=1).isoformat())
+        date_to = datetime.date.fromisoformat(request.args.get('to') or today.isoformat())
+    except ValueError:
+        return jsonify({'error': 'Ongeldige datum, gebruik JJJJ-MM-DD'}), 400
+    period = request.args.get('period', 'month')
+    group_by = [g.strip() for g in request.args.get('group_by', '').split(',') if g.strip()]
+    if period not in REPORT_PERIODS or any(g not in REPORT_GROUPS for g in group_by):
+        return jsonify({'error': f"period is een van {', '.join(REPORT_PERIODS)}; "
+                                 f"group_by een combinatie van {', '.join(REPORT_GROUPS)}"}), 400
+    if date_to < date_from:
+        return jsonify({'error': 'Einddatum ligt voor de begindatum'}), 400
+
+    rows = db.rpc('revenue_report', {
+        'p_from': date_from.isoformat(),
+        # The report takes a half-open range; "to" is inclusive for the caller
+        'p_to': (date_to + datetime.timedelta(days=1)).isoformat(),
+        'p_period': period,
+        'p_group': group_by
+    }) or []
+
+    keys = ['period'] + [key for g in group_by for key in REPORT_GROUPS[g]]
+    result = []
+    totals = dict.fromkeys(REPORT_SUMS, 0)
+    for row in rows:
+        item = {key: row.get(key) for key in keys}
+        if 'btw_percentage' in item:
+            item['btw_percentage'] = float(item['btw_percentage'])
+        for key in REPORT_SUMS:
+            item[key] = int(row[key]) if key in ('jobs', 'lines') else round(float(row[key]), 2)
+            totals[key] += item[key]
+        result.append(item)
+    for key in ('subtotal', 'btw', 'total_incl_btw'):
+        totals[key] = round(totals[key], 2)
+
+    return jsonify({
+        'from': date_from.isoformat(),
+        'to': date_to.isoformat(),
+        'period': period,
+        'group_by': group_by,
+        'rows': result,
+        'totals': totals
+    })
+
 # ─── CUSTOMERS ──────────────────────────────────────────────────
 @app.route('/api/customers', methods=['GET'])
 @token_required
 def get_customers():
-    sb = get_supabase()
-    search = request.args.get('search', '')
-    query = sb.table('customers').select('*').order('created_at', desc=True)
-    if search:
-        query = query.or_(f'name.ilike.%{search}%,address.ilike.%{search}%,phone.ilike.%{search}%')
-    result = query.execute()
-    return jsonify(result.data)
+    search = request.args.get('search', '').strip()
+    if not search:
+        return paged_list('customers')
+    
+    # Ranked search through the trigram/full-text indexes; one page of best
+    # matches instead of a cursor
+    spec = LIST_SPECS['customers']
+    try:
+        fields = request.args.get('fields', '')
+        names = [f.strip() for f in fields.split(',') if f.strip()] or list(spec['columns'])
+        if any(name not in spec['columns'] for name in names):
+            raise ValueError(fields)
+        limit = min(int(request.args.get('limit', SEARCH_LIMIT)), SEARCH_MAX_LIMIT)
+    except ValueError:
+        return jsonify({'error': 'Ongeldige fields of limit parameter'}), 400
+    
+    rows = db.rpc('search_customers', {'p_query': search[:SEARCH_MAX_QUERY], 'p_limit': limit})
+    return jsonify([{name: row.get(name) for name in names + ['rank']} for row in rows])
 
 @app.route('/api/customers', methods=['POST'])
 @token_required
@@ -183,17 +447,92 @@ def create_customer():
         'water_pressure_lpm': data.get('water_pressure_lpm', 0),
         'notes': data.get('notes', '')
     }).execute()
+    cache.bump('customers')
     return jsonify(result.data[0]), 201
 
+@app.route('/api/customers/import', methods=['POST'])
+@token_required
+@admin_required
+def import_customers():
+    # Multipart (field "file") or the raw CSV/XLSX as the request body
+    if 'file' in request.files:
+        upload = request.files['file']
+        stream, filename = upload.stream, upload.filename or ''
+    else:
+        stream, filename = request.stream, request.args.get('filename', '')
+    try:
+        batch_size = int(request.args.get('batch_size', bulk.IMPORT_BATCH_SIZE))
+    except ValueError:
+        batch_size = 0
+    if not 1 <= batch_size <= bulk.IMPORT_MAX_BATCH_SIZE:
+        return jsonify({'error': f'batch_size moet tussen 1 en {bulk.IMPORT_MAX_BATCH_SIZE} liggen'}), 400
+    
+    # A retried upload with the same Idempotency-Key gets the first one's job
+    client_key = request.headers.get('Idempotency-Key')
+    key = f'import:{request.user_id}:{client_key}' if client_key else None
+    job = jobs.find(key) if key else None
+    if job is None:
+        try:
+            path, fmt = bulk.spool_upload(stream, filename)
+        except bulk.BulkError as e:
+            return jsonify({'error': str(e)}), 400
+        job = jobs.enqueue('customers.import', {
+            'path': path, 'format': fmt, 'batch_size': batch_size,
+            'update': request.args.get('update', 'false').lower() == 'true',
+        }, key=key, user_id=request.user_id)
+    response = jsonify({'message': 'Import gestart', 'job': job})
+    response.status_code = 202
+    response.headers['Location'] = f"/api/jobs/{job['id']}"
+    return response
+
+@jobs.task('customers.import', max_attempts=3, on_failure=lambda payload: bulk.discard(payload['path']))
+def import_customers_job(payload):
+    try:
+        result = bulk.import_customers(payload['path'], payload['format'], batch_size=payload['batch_size'],
+                                       update=payload['update'], report=jobs.report_progress)
+    except bulk.BulkError as e:
+        bulk.discard(payload['path'])
+        raise jobs.JobFailed(str(e))
+    finally:
+        # Batches written before a failure are visible too
+        cache.bump('customers')
+    bulk.discard(payload['path'])
+    return result
+
+def export_response(table):
+    fmt = request.args.get('format', 'csv')
+    filename = f"{table}_{datetime.date.today().isoformat()}.{fmt}"
+    if fmt == 'csv':
+        response = app.response_class(stream_with_context(bulk.export_csv(table)), mimetype='text/csv')
+    elif fmt == 'xlsx':
+        try:
+            path = bulk.export_xlsx(table)
+        except bulk.BulkError as e:
+            return jsonify({'error': str(e)}), 400
+        response = send_file(path, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        response.call_on_close(lambda: bulk.discard(path))
+    else:
+        return jsonify({'error': 'format moet csv of xlsx zijn'}), 400
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+@app.route('/api/customers/export', methods=['GET'])
+@token_required
+@admin_required
+def export_customers():
+    return export_response('customers')
+
 @app.route('/api/customers/<customer_id>', methods=['GET'])
 @token_required
 def get_customer(customer_id):
     sb = get_supabase()
-    result = sb.table('customers').select('*').eq('id', customer_id).execute()
+    # Customer and their estimates are fetched concurrently
+    result, estimates = db.fan_out(
+        sb.table('customers').select('*').eq('id', customer_id).execute,
+        sb.table('estimates').select('*').eq('customer_id', customer_id).order('created_at', desc=True).execute,
+    )
     if not result.data:
         return jsonify({'error': 'Klant niet gevonden'}), 404
-    # Get estimates for this customer
-    estimates = sb.table('estimates').select('*').eq('customer_id', customer_id).order('created_at', desc=True).execute()
     customer = result.data[0]
     customer['estimates'] = estimates.data
     return jsonify(customer)
@@ -205,6 +544,7 @@ def update_customer(customer_id):
     sb = get_supabase()
     data['updated_at'] = datetime.datetime.utcnow().isoformat()
     result = sb.table('customers').update(data).eq('id', customer_id).execute()
+    cache.bump('customers')
     return jsonify(result.data[0])
 
 @app.route('/api/customers/<customer_id>', methods=['DELETE'])
@@ -212,15 +552,18 @@ def update_customer(customer_id):
 def delete_customer(customer_id):
     sb = get_supabase()
     sb.table('customers').delete().eq('id', customer_id).execute()
+    cache.bump('customers', 'estimates')
     return jsonify({'message': 'Klant verwijderd'})
 
 # ─── SERVICES ───────────────────────────────────────────────────
 @app.route('/api/services', methods=['GET'])
 @token_required
 def get_services():
-    sb = get_supabase()
-    result = sb.table('services').select('*').eq('active', True).order('name').execute()
-    return jsonify(result.data)
+    def build():
+        sb = get_supabase()
+        result = sb.table('services').select('*').eq('active', True).order('name').execute()
+        return jsonify(result.data)
+    return reference.services.respond(build)
 
 @app.route('/api/services', methods=['POST'])
 @token_required
@@ -229,6 +572,7 @@ def create_service():
     data = request.json
     sb = get_supabase()
     result = sb.table('services').insert(data).execute()
+    cache.bump('services')
     return jsonify(result.data[0]), 201
 
 @app.route('/api/services/<service_id>', methods=['PUT'])
@@ -238,6 +582,7 @@ def update_service(service_id):
     data = request.json
     sb = get_supabase()
     result = sb.table('services').update(data).eq('id', service_id).execute()
+    cache.bump('services')
     return jsonify(result.data[0])
 
 @app.route('/api/services/<service_id>', methods=['DELETE'])
@@ -246,15 +591,18 @@ def update_service(service_id):
 def delete_service(service_id):
     sb = get_supabase()
     sb.table('services').update({'active': False}).eq('id', service_id).execute()
+    cache.bump('services')
     return jsonify({'message': 'Dienst verwijderd'})
 
 # ─── UPSELL ITEMS ──────────────────────────────────────────────
 @app.route('/api/upsells', methods=['GET'])
 @token_required
 def get_upsells():
-    sb = get_supabase()
-    result = sb.table('upsell_items').select('*').eq('active', True).order('name').execute()
-    return jsonify(result.data)
+    def build():
+        sb = get_supabase()
+        result = sb.table('upsell_items').select('*').eq('active', True).order('name').execute()
+        return jsonify(result.data)
+    return reference.upsell_items.respond(build)
 
 @app.route('/api/upsells', methods=['POST'])
 @token_required
@@ -263,6 +611,7 @@ def create_upsell():
     data = request.json
     sb = get_supabase()
     result = sb.table('upsell_items').insert(data).execute()
+    cache.bump('upsell_items')
     return jsonify(result.data[0]), 201
 
 @app.route('/api/upsells/<upsell_id>', methods=['PUT'])
@@ -272,6 +621,7 @@ def update_upsell(upsell_id):
     data = request.json
     sb = get_supabase()
     result = sb.table('upsell_items').update(data).eq('id', upsell_id).execute()
+    cache.bump('upsell_items')
     return jsonify(result.data[0])
 
 @app.route('/api/upsells/<upsell_id>', methods=['DELETE'])
@@ -280,97 +630,82 @@ def update_upsell(upsell_id):
 def delete_upsell(upsell_id):
     sb = get_supabase()
     sb.table('upsell_items').update({'active': False}).eq('id', upsell_id).execute()
+    cache.bump('upsell_items')
     return jsonify({'message': 'Upsell verwijderd'})
 
 # ─── ESTIMATES ──────────────────────────────────────────────────
 @app.route('/api/estimates', methods=['GET'])
 @token_required
 def get_estimates():
-    sb = get_supabase()
     status = request.args.get('status', '')
-    query = sb.table('estimates').select('*, customers(name, address, phone)').order('created_at', desc=True)
-    if status:
-        query = query.eq('status', status)
-    result = query.execute()
-    return jsonify(result.data)
+    return paged_list('estimates', lambda query: query.eq('status', status) if status else query)
 
 @app.route('/api/estimates', methods=['POST'])
 @token_required
 def create_estimate():
     data = request.json
-    sb = get_supabase()
-    
-    # Calculate totals
-    subtotal = 0
-    lines = data.get('lines', [])
-    upsells = data.get('upsells', [])
-    
-    for line in lines:
-        multiplier = float(line.get('multiplier', 1.0))
-        line_total = float(line['square_meters']) * float(line['unit_price']) * multiplier
-        line['line_total'] = line_total
-        subtotal += line_total
-    
-    for upsell in upsells:
-        subtotal += float(upsell['price'])
-    
-    btw_pct = float(data.get('btw_percentage', 21))
-    btw_amount = subtotal * (btw_pct / 100)
-    total_incl = subtotal + btw_amount
-    
-    # Create estimate
-    estimate = sb.table('estimates').insert({
-        'customer_id': data['customer_id'],
-        'user_id': request.user_id,
-        'status': data.get('status', 'concept'),
-        'subtotal': subtotal,
-        'btw_percentage': btw_pct,
-        'total_incl_btw': total_incl,
-        'notes': data.get('notes', '')
-    }).execute()
     
-    estimate_id = estimate.data[0]['id']
-    
-    # Insert lines
-    for line in lines:
-        sb.table('estimate_lines').insert({
-            'estimate_id': estimate_id,
-            'service_id': line.get('service_id'),
-            'description': line['description'],
-            'square_meters': line['square_meters'],
-            'pollution_level': line.get('pollution_level', 'standaard'),
-            'unit_price': line['unit_price'],
-            'multiplier': line.get('multiplier', 1.0),
-            'line_total': line['line_total']
-        }).execute()
+    # Prices come from the price list, not from the client
+    try:
+        quote = pricing.price_quote(data)
+    except pricing.PricingError as e:
+        return jsonify({'error': str(e)}), 400
     
-    # Insert upsells
-    for upsell in upsells:
-        sb.table('estimate_upsells').insert({
-            'estimate_id': estimate_id,
-            'upsell_item_id': upsell.get('upsell_item_id'),
-            'description': upsell['description'],
-            'price': upsell['price']
-        }).execute()
+    # Estimate, lines and upsells are written in one transaction
+    estimate = db.rpc('create_estimate_with_children', pricing.as_json({
+        'p_estimate': {
+            'customer_id': data['customer_id'],
+            'user_id': request.user_id,
+            'status': data.get('status', 'concept'),
+            'subtotal': quote['subtotal'],
+            'btw_percentage': quote['btw_percentage'],
+            'total_incl_btw': quote['total_incl_btw'],
+            'notes': data.get('notes', '')
+        },
+        'p_lines': quote['lines'],
+        'p_upsells': quote['upsells']
+    }))
     
-    return jsonify(estimate.data[0]), 201
+    cache.bump('estimates')
+    return jsonify(estimate), 201
+
+@app.route('/api/estimates/preview', methods=['POST'])
+@token_required
+def preview_estimates():
+    # Prices one draft ({lines, upsells, btw_percentage}) or several
+    # ({quotes: [...]}) exactly like create_estimate would; nothing is saved
+    data = request.get_json(silent=True)
+    try:
+        if isinstance(data, dict) and 'quotes' in data:
+            return jsonify({'quotes': pricing.as_json(pricing.price_quotes(data['quotes']))})
+        return jsonify(pricing.as_json(pricing.price_quote(data)))
+    except pricing.PricingError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/estimates/export', methods=['GET'])
+@token_required
+@admin_required
+def export_estimates():
+    return export_response('estimates')
 
 @app.route('/api/estimates/<estimate_id>', methods=['GET'])
 @token_required
 def get_estimate(estimate_id):
     sb = get_supabase()
-    estimate = sb.table('estimates').select('*, customers(*)').eq('id', estimate_id).execute()
+    # All four only need the id, so they go out at the same time
+    estimate, lines, upsells, photo_rows = db.fan_out(
+        sb.table('estimates').select('*, customers(*)').eq('id', estimate_id).execute,
+        sb.table('estimate_lines').select('*').eq('estimate_id', estimate_id).execute,
+        sb.table('estimate_upsells').select('*').eq('estimate_id', estimate_id).execute,
+        sb.table('project_photos').select('id, photo_type, caption, created_at').eq('estimate_id', estimate_id).execute,
+    )
     if not estimate.data:
         return jsonify({'error': 'Offerte niet gevonden'}), 404
     
-    lines = sb.table('estimate_lines').select('*').eq('estimate_id', estimate_id).execute()
-    upsells = sb.table('estimate_upsells').select('*').eq('estimate_id', estimate_id).execute()
-    photos = sb.table('project_photos').select('id, photo_type, caption, created_at').eq('estimate_id', estimate_id).execute()
-    
     result = estimate.data[0]
     result['lines'] = lines.data
     result['upsells'] = upsells.data
-    result['photos'] = photos.data
+    result['photos'] = photo_rows.data
     return jsonify(result)
 
 @app.route('/api/estimates/<estimate_id>', methods=['PUT'])
@@ -380,105 +715,267 @@ def update_estimate(estimate_id):
     sb = get_supabase()
     
     update_data = {k: v for k, v in data.items() if k in [
-        'status', 'subtotal', 'btw_percentage', 'total_incl_btw', 'signature_data', 'notes'
+        'status', 'subtotal', 'btw_percentage', 'total_incl_btw', 'notes'
     ]}
     update_data['updated_at'] = datetime.datetime.utcnow().isoformat()
     
     result = sb.table('estimates').update(update_data).eq('id', estimate_id).execute()
+    cache.bump('estimates')
     return jsonify(result.data[0])
 
 @app.route('/api/estimates/<estimate_id>/sign', methods=['POST'])
 @token_required
 def sign_estimate(estimate_id):
-    data = request.json
+    data = request.json or {}
+    try:
+        sha256 = signatures.save_signature(data.get('signature') or '')
+    except signatures.SignatureError as e:
+        return jsonify({'error': str(e)}), 400
     sb = get_supabase()
     sb.table('estimates').update({
-        'signature_data': data['signature'],
+        'signature_sha256': sha256,
+        'signature_data': None,
         'status': 'akkoord',
         'updated_at': datetime.datetime.utcnow().isoformat()
     }).eq('id', estimate_id).execute()
-    return jsonify({'message': 'Offerte getekend en geaccepteerd'})
+    cache.bump('estimates')
+    # The signed offer is usually downloaded next; have it rendered by then
+    jobs.enqueue('pdf.prerender', {'estimate_id': estimate_id}, key=f'pdf:{estimate_id}:{sha256}',
+                 user_id=request.user_id)
+    return jsonify({'message': 'Offerte getekend en geaccepteerd', 'signature_sha256': sha256})
 
-@app.route('/api/estimates/<estimate_id>/complete', methods=['POST'])
+@app.route('/api/signatures/<sha256>.png', methods=['GET'])
 @token_required
-def complete_estimate(estimate_id):
+def serve_signature(sha256):
+    if not signatures.is_hash(sha256):
+        return jsonify({'error': 'Handtekening niet gevonden'}), 404
+    path = signatures.local_path(sha256)
+    if not os.path.exists(path):
+        return jsonify({'error': 'Handtekening niet gevonden'}), 404
+    # Named by the hash of its bytes, so it never changes
+    response = send_file(path, mimetype='image/png', conditional=True, etag=sha256, max_age=PHOTO_MAX_AGE)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+@app.cli.command('migrate-signatures')
+@click.option('--batch-size', default=50, show_default=True, help='Rows fetched per query.')
+def migrate_signatures_command(batch_size):
+    """Normalize base64 signatures from estimates.signature_data into the photo store.
+
+    Every migrated estimate gets a new updated_at and sync position, so
+    offline devices download those estimates again on their next sync.
+    """
     sb = get_supabase()
-    
-    # Get estimate lines
-    lines = sb.table('estimate_lines').select('*, services(linked_inventory_id, chemical_usage_rate)').eq('estimate_id', estimate_id).execute()
-    
-    # Auto-deduct inventory
-    for line in lines.data:
+    moved = failed = 0
+    last_id = '00000000-0000-0000-0000-000000000000'
+    while True:
+        rows = sb.table('estimates').select('id, signature_data').is_('signature_sha256', 'null') \
+            .not_.is_('signature_data', 'null').gt('id', last_id).order('id').limit(batch_size).execute().data
+        if not rows:
+            break
+        for row in rows:
+            last_id = row['id']
+            try:
+                sha256 = signatures.save_signature(row['signature_data'])
+            except signatures.SignatureError as e:
+                failed += 1
+                click.echo(f'{row["id"]}: {e}', err=True)
+                continue
+            # The updated_at and sync_touch triggers fire here too. That is
+            # wanted: synced devices need the new signature_sha256
+            sb.table('estimates').update({'signature_sha256': sha256, 'signature_data': None}).eq('id', row['id']).execute()
+            moved += 1
+        click.echo(f'{moved} moved, {failed} failed')
+    cache.bump('estimates')
+    click.echo(f'Done: {moved} signatures moved, {failed} failed')
+
+def inventory_usage(lines):
+    # Chemical usage per linked inventory item, summed over all lines of a job
+    usage = {}
+    area = {}
+    for line in lines:
         service = line.get('services')
         if service and service.get('linked_inventory_id') and service.get('chemical_usage_rate'):
-            usage = float(line['square_meters']) * float(service['chemical_usage_rate'])
             inv_id = service['linked_inventory_id']
-            
-            # Get current stock
-            inv = sb.table('inventory').select('quantity_on_hand').eq('id', inv_id).execute()
-            if inv.data:
-                new_qty = max(0, float(inv.data[0]['quantity_on_hand']) - usage)
-                sb.table('inventory').update({
-                    'quantity_on_hand': new_qty,
-                    'updated_at': datetime.datetime.utcnow().isoformat()
-                }).eq('id', inv_id).execute()
-                
-                # Log the change
-                sb.table('inventory_log').insert({
-                    'inventory_id': inv_id,
-                    'estimate_id': estimate_id,
-                    'change_amount': -usage,
-                    'reason': f'Auto-aftrek klus voltooid ({line["square_meters"]} m²)'
-                }).execute()
-    
-    # Update status
-    sb.table('estimates').update({
-        'status': 'voltooid',
-        'updated_at': datetime.datetime.utcnow().isoformat()
-    }).eq('id', estimate_id).execute()
+            usage[inv_id] = usage.get(inv_id, 0) + float(line['square_meters']) * float(service['chemical_usage_rate'])
+            area[inv_id] = area.get(inv_id, 0) + float(line['square_meters'])
+    return [{
+        'inventory_id': inv_id,
+        'change_amount': -amount,
+        'reason': f'Auto-aftrek klus voltooid ({area[inv_id]:g} m²)'
+    } for inv_id, amount in usage.items()]
+
+@app.route('/api/estimates/<estimate_id>/complete', methods=['POST'])
+@token_required
+def complete_estimate(estimate_id):
+    # Stock is deducted by a job; the client follows it at /api/jobs/<id>.
+    # A retried request with the same Idempotency-Key gets the same job.
+    client_key = request.headers.get('Idempotency-Key')
+    job = jobs.enqueue('estimate.complete', {'estimate_id': estimate_id},
+                       key=f'complete:{estimate_id}:{client_key}' if client_key else None,
+                       user_id=request.user_id)
+    response = jsonify({'message': 'Klus wordt voltooid', 'job': job})
+    response.status_code = 202
+    response.headers['Location'] = f"/api/jobs/{job['id']}"
+    return response
+
+@jobs.task('estimate.complete')
+def complete_estimate_job(payload):
+    estimate_id = payload['estimate_id']
+    sb = get_supabase()
+    lines = sb.table('estimate_lines').select('square_meters, services(linked_inventory_id, chemical_usage_rate)').eq('estimate_id', estimate_id).execute()
     
-    return jsonify({'message': 'Klus voltooid, voorraad bijgewerkt'})
+    # Status change and all stock decrements happen in one transaction, so a
+    # retry after a crash cannot deduct twice: the second run finds it completed
+    result = db.rpc('complete_estimate', {
+        'p_estimate_id': estimate_id,
+        'p_changes': inventory_usage(lines.data)
+    })
+    if result is None:
+        raise jobs.JobFailed('Offerte niet gevonden')
+    if not result['completed'] and result['status'] != 'voltooid':
+        raise jobs.JobFailed('Klus is al gefactureerd')
+    # Also after a run that completed it but died before finishing the job:
+    # the retry still has to drop the caches and queue the PDF
+    cache.bump('estimates', 'inventory')
+    jobs.enqueue('pdf.prerender', {'estimate_id': estimate_id}, key=f'pdf:{estimate_id}:completed')
+    if not result['completed']:
+        return {'message': 'Klus was al voltooid', 'inventory': []}
+    return {'message': 'Klus voltooid, voorraad bijgewerkt', 'inventory': result['inventory']}
 
 # ─── PHOTOS ─────────────────────────────────────────────────────
+# Photos are immutable once stored, so their metadata can be cached for long
+photo_meta_cache = cache.TTLCache(int(os.environ.get('PHOTO_META_CACHE_TTL', 600)),
+                                  tags=('project_photos',), max_entries=2048)
+PHOTO_MAX_AGE = 365 * 24 * 3600
+
+def get_photo_meta(photo_id):
+    def load():
+        result = get_supabase().table('project_photos').select(photos.METADATA_COLUMNS).eq('id', photo_id).execute()
+        return result.data[0] if result.data else None
+    return photo_meta_cache.get_or_set(photo_id, load)
+
 @app.route('/api/estimates/<estimate_id>/photos', methods=['POST'])
 @token_required
 def upload_photo(estimate_id):
-    data = request.json
-    sb = get_supabase()
+    # Accepts multipart (field "photo"), a raw image body, or the legacy JSON data URL
+    if 'photo' in request.files:
+        stream = request.files['photo'].stream
+        fields = request.form
+    elif request.mimetype.startswith('image/'):
+        stream = request.stream
+        fields = request.args
+    else:
+        fields = request.get_json(silent=True) or {}
+        if not isinstance(fields.get('photo_data'), str) or not fields['photo_data']:
+            return jsonify({'error': 'Geen foto ontvangen'}), 400
+        stream = None
+    
+    try:
+        if stream is None:
+            stream = io.BytesIO(photos.decode_data_url(fields['photo_data']))
+        meta = photos.save_photo(stream)
+    except photos.PhotoError as e:
+        return jsonify({'error': str(e)}), 400
     
+    sb = get_supabase()
     result = sb.table('project_photos').insert({
         'estimate_id': estimate_id,
-        'customer_id': data.get('customer_id'),
-        'photo_type': data.get('photo_type', 'voor'),
-        'photo_data': data['photo_data'],
-        'caption': data.get('caption', '')
+        'customer_id': fields.get('customer_id') or None,
+        'photo_type': fields.get('photo_type', 'voor'),
+        'caption': fields.get('caption', ''),
+        **meta
     }).execute()
+    cache.bump('estimates')
     
-    return jsonify({'id': result.data[0]['id']}), 201
+    return jsonify({'id': result.data[0]['id'], **meta}), 201
 
 @app.route('/api/photos/<photo_id>', methods=['GET'])
 @token_required
 def get_photo(photo_id):
-    sb = get_supabase()
-    result = sb.table('project_photos').select('*').eq('id', photo_id).execute()
-    if not result.data:
+    photo = get_photo_meta(photo_id)
+    if not photo:
         return jsonify({'error': 'Foto niet gevonden'}), 404
-    return jsonify(result.data[0])
+    photo = dict(photo)
+    if photo['storage_key']:
+        photo['url'] = f'/api/photos/{photo_id}/raw'
+        photo['thumb_url'] = f'/api/photos/{photo_id}/thumb'
+    else:
+        # Not yet moved out of the database by `flask migrate-photos`
+        legacy = get_supabase().table('project_photos').select('photo_data').eq('id', photo_id).execute()
+        photo['photo_data'] = legacy.data[0]['photo_data'] if legacy.data else None
+    return jsonify(photo)
+
+@app.route('/api/photos/<photo_id>/<variant>', methods=['GET'])
+@token_required
+def serve_photo(photo_id, variant):
+    if variant not in ('raw', 'thumb'):
+        return jsonify({'error': 'Foto niet gevonden'}), 404
+    photo = get_photo_meta(photo_id)
+    if not photo or not photo['storage_key']:
+        return jsonify({'error': 'Foto niet gevonden'}), 404
+    
+    key = photo['thumb_key'] if variant == 'thumb' else photo['storage_key']
+    mimetype = 'image/jpeg' if variant == 'thumb' else photo['content_type']
+    path = photos.get_store().local_path(key)
+    if not os.path.exists(path):
+        return jsonify({'error': 'Foto niet gevonden'}), 404
+    
+    # Content-addressed blobs never change: strong ETag, Range support, long max-age
+    response = send_file(path, mimetype=mimetype, conditional=True,
+                         etag=f"{photo['sha256']}-{variant}", max_age=PHOTO_MAX_AGE)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
 
 @app.route('/api/photos/<photo_id>', methods=['DELETE'])
 @token_required
 def delete_photo(photo_id):
     sb = get_supabase()
-    sb.table('project_photos').delete().eq('id', photo_id).execute()
+    deleted = sb.table('project_photos').delete().eq('id', photo_id).execute()
+    for photo in deleted.data:
+        # The same image may be attached to other estimates
+        if photo.get('storage_key'):
+            others = sb.table('project_photos').select('id').eq('storage_key', photo['storage_key']).limit(1).execute()
+            if not others.data:
+                photos.delete_blobs(photo)
+    cache.bump('project_photos', 'estimates')
     return jsonify({'message': 'Foto verwijderd'})
 
+@app.cli.command('migrate-photos')
+@click.option('--batch-size', default=20, show_default=True, help='Rows fetched per query.')
+def migrate_photos_command(batch_size):
+    """Move base64 photos from project_photos.photo_data into the photo store."""
+    sb = get_supabase()
+    moved = failed = 0
+    last_id = '00000000-0000-0000-0000-000000000000'
+    while True:
+        rows = sb.table('project_photos').select('id, photo_data').is_('storage_key', 'null') \
+            .gt('id', last_id).order('id').limit(batch_size).execute().data
+        if not rows:
+            break
+        for row in rows:
+            last_id = row['id']
+            try:
+                meta = photos.save_photo(io.BytesIO(photos.decode_data_url(row['photo_data'] or '')))
+            except photos.PhotoError as e:
+                failed += 1
+                click.echo(f'{row["id"]}: {e}', err=True)
+                continue
+            sb.table('project_photos').update({**meta, 'photo_data': None}).eq('id', row['id']).execute()
+            moved += 1
+        click.echo(f'{moved} moved, {failed} failed')
+    cache.bump('project_photos')
+    click.echo(f'Done: {moved} photos moved, {failed} failed')
+
 # ─── INVENTORY ──────────────────────────────────────────────────
 @app.route('/api/inventory', methods=['GET'])
 @token_required
 def get_inventory():
-    sb = get_supabase()
-    result = sb.table('inventory').select('*').order('item_name').execute()
-    return jsonify(result.data)
+    return reference.inventory.respond(lambda: paged_list('inventory'))
 
 @app.route('/api/inventory', methods=['POST'])
 @token_required
@@ -487,6 +984,7 @@ def create_inventory_item():
     data = request.json
     sb = get_supabase()
     result = sb.table('inventory').insert(data).execute()
+    cache.bump('inventory')
     return jsonify(result.data[0]), 201
 
 @app.route('/api/inventory/<item_id>', methods=['PUT'])
@@ -497,203 +995,246 @@ def update_inventory(item_id):
     sb = get_supabase()
     data['updated_at'] = datetime.datetime.utcnow().isoformat()
     result = sb.table('inventory').update(data).eq('id', item_id).execute()
+    cache.bump('inventory')
     return jsonify(result.data[0])
 
 @app.route('/api/inventory/<item_id>/adjust', methods=['POST'])
 @token_required
 def adjust_inventory(item_id):
     data = request.json
-    sb = get_supabase()
     
-    current = sb.table('inventory').select('quantity_on_hand').eq('id', item_id).execute()
-    if not current.data:
+    updated = db.rpc('apply_inventory_changes', {
+        'p_changes': [{
+            'inventory_id': item_id,
+            'change_amount': float(data['amount']),
+            'reason': data.get('reason', 'Handmatige aanpassing')
+        }]
+    })
+    if not updated:
         return jsonify({'error': 'Item niet gevonden'}), 404
+    cache.bump('inventory')
     
-    new_qty = float(current.data[0]['quantity_on_hand']) + float(data['amount'])
-    sb.table('inventory').update({
-        'quantity_on_hand': max(0, new_qty),
-        'updated_at': datetime.datetime.utcnow().isoformat()
-    }).eq('id', item_id).execute()
-    
-    sb.table('inventory_log').insert({
-        'inventory_id': item_id,
-        'change_amount': data['amount'],
-        'reason': data.get('reason', 'Handmatige aanpassing')
-    }).execute()
-    
-    return jsonify({'message': 'Voorraad aangepast', 'new_quantity': new_qty})
+    return jsonify({'message': 'Voorraad aangepast', 'new_quantity': float(updated[0]['quantity_on_hand'])})
 
 # ─── SETTINGS ───────────────────────────────────────────────────
 @app.route('/api/settings', methods=['GET'])
 @token_required
 def get_settings():
-    sb = get_supabase()
-    result = sb.table('settings').select('*').execute()
-    settings = {s['key']: s['value'] for s in result.data}
-    return jsonify(settings)
+    return jsonify(settings.current())
 
 @app.route('/api/settings', methods=['PUT'])
 @token_required
 @admin_required
 def update_settings():
     data = request.json
-    sb = get_supabase()
-    for key, value in data.items():
-        sb.table('settings').upsert({
-            'key': key,
-            'value': str(value),
-            'updated_at': datetime.datetime.utcnow().isoformat()
-        }).execute()
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Ongeldige instellingen'}), 400
+    try:
+        settings.update(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     return jsonify({'message': 'Instellingen opgeslagen'})
 
 # ─── PDF GENERATION ─────────────────────────────────────────────
+def load_pdf_document(estimate_id):
+    """(estimate with customer, lines, upsells), or None if it does not exist."""
+    # Estimate, customer, lines and upsells in one query
+    estimate = get_supabase().table('estimates').select('*, customers(*), estimate_lines(*), estimate_upsells(*)').eq('id', estimate_id).execute()
+    if not estimate.data:
+        return None
+    est = estimate.data[0]
+    lines = est.pop('estimate_lines', None) or []
+    upsells = est.pop('estimate_upsells', None) or []
+    return est, lines, upsells
+
 @app.route('/api/estimates/<estimate_id>/pdf', methods=['GET'])
 @token_required
 def generate_pdf(estimate_id):
-    sb = get_supabase()
-    
-    # Fetch all data
-    estimate = sb.table('estimates').select('*, customers(*)').eq('id', estimate_id).execute()
-    if not estimate.data:
+    document = load_pdf_document(estimate_id)
+    if document is None:
         return jsonify({'error': 'Offerte niet gevonden'}), 404
     
-    est = estimate.data[0]
-    customer = est.get('customers', {})
-    lines = sb.table('estimate_lines').select('*').eq('estimate_id', estimate_id).execute()
-    upsells = sb.table('estimate_upsells').select('*').eq('estimate_id', estimate_id).execute()
-    settings_data = sb.table('settings').select('*').execute()
-    settings = {s['key']: s['value'] for s in settings_data.data}
-    
-    # Build PDF
-    buffer = io.BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=2*cm, bottomMargin=2*cm, leftMargin=2*cm, rightMargin=2*cm)
-    
-    styles = getSampleStyleSheet()
-    styles.add(ParagraphStyle(name='CompanyName', fontSize=20, spaceAfter=6, textColor=HexColor('#1a56db'), fontName='Helvetica-Bold'))
-    styles.add(ParagraphStyle(name='DocTitle', fontSize=14, spaceAfter=12, textColor=HexColor('#374151'), fontName='Helvetica-Bold'))
-    styles.add(ParagraphStyle(name='SectionHead', fontSize=11, spaceAfter=6, textColor=HexColor('#1a56db'), fontName='Helvetica-Bold'))
-    styles.add(ParagraphStyle(name='BodyText2', fontSize=10, spaceAfter=4, textColor=HexColor('#374151')))
-    styles.add(ParagraphStyle(name='SmallRight', fontSize=9, alignment=TA_RIGHT, textColor=HexColor('#6b7280')))
-    styles.add(ParagraphStyle(name='TotalStyle', fontSize=13, fontName='Helvetica-Bold', textColor=HexColor('#1a56db'), alignment=TA_RIGHT))
-    
-    story = []
-    
-    # Header
-    is_invoice = est['status'] in ['factuur', 'betaald']
-    doc_type = 'FACTUUR' if is_invoice else 'OFFERTE'
-    prefix = settings.get('invoice_prefix', 'FAC') if is_invoice else settings.get('estimate_prefix', 'OFF')
-    
-    story.append(Paragraph(settings.get('company_name', 'PressureFlow'), styles['CompanyName']))
-    if settings.get('company_address'):
-        story.append(Paragraph(settings['company_address'], styles['BodyText2']))
-    if settings.get('company_phone'):
-        story.append(Paragraph(f"Tel: {settings['company_phone']}", styles['BodyText2']))
-    if settings.get('company_email'):
-        story.append(Paragraph(f"E-mail: {settings['company_email']}", styles['BodyText2']))
-    if settings.get('company_kvk'):
-        story.append(Paragraph(f"KVK: {settings['company_kvk']}", styles['BodyText2']))
-    if settings.get('company_btw_id'):
-        story.append(Paragraph(f"BTW-ID: {settings['company_btw_id']}", styles['BodyText2']))
+    est, lines, upsells = document
+    company = settings.current()
     
-    story.append(Spacer(1, 1*cm))
-    story.append(Paragraph(f"{doc_type} {prefix}-{estimate_id[:8].upper()}", styles['DocTitle']))
-    story.append(Paragraph(f"Datum: {est['created_at'][:10]}", styles['BodyText2']))
-    story.append(Spacer(1, 0.5*cm))
+    # Same content → same key, so the browser's copy or the disk cache is reused
+    key = pdf.cache_key(est, lines, upsells, company)
+    if key in request.if_none_match:
+        response = app.response_class(status=304)
+        response.set_etag(key)
+        return response
     
-    # Customer info
-    story.append(Paragraph('KLANTGEGEVENS', styles['SectionHead']))
-    story.append(Paragraph(f"{customer.get('name', '-')}", styles['BodyText2']))
-    if customer.get('address'):
-        story.append(Paragraph(customer['address'], styles['BodyText2']))
-    if customer.get('phone'):
-        story.append(Paragraph(f"Tel: {customer['phone']}", styles['BodyText2']))
-    if customer.get('email'):
-        story.append(Paragraph(f"E-mail: {customer['email']}", styles['BodyText2']))
-    
-    story.append(Spacer(1, 0.8*cm))
-    
-    # Services table
-    story.append(Paragraph('WERKZAAMHEDEN', styles['SectionHead']))
-    table_data = [['Omschrijving', 'm²', 'Prijs/m²', 'Vervuiling', 'Totaal']]
-    for line in lines.data:
-        pollution = 'Zwaar (1.3x)' if line['pollution_level'] == 'zwaar' else 'Standaard'
-        table_data.append([
-            line['description'],
-            f"{float(line['square_meters']):.1f}",
-            f"€{float(line['unit_price']):.2f}",
-            pollution,
-            f"€{float(line['line_total']):.2f}"
-        ])
-    
-    if upsells.data:
-        for ups in upsells.data:
-            table_data.append([ups['description'], '', '', '', f"€{float(ups['price']):.2f}"])
-    
-    t = Table(table_data, colWidths=[7*cm, 2*cm, 2.5*cm, 2.5*cm, 3*cm])
-    t.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), HexColor('#1a56db')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), HexColor('#ffffff')),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 9),
-        ('ALIGN', (1, 0), (-1, -1), 'RIGHT'),
-        ('GRID', (0, 0), (-1, -1), 0.5, HexColor('#e5e7eb')),
-        ('ROWBACKGROUNDS', (0, 1), (-1, -1), [HexColor('#ffffff'), HexColor('#f9fafb')]),
-        ('TOPPADDING', (0, 0), (-1, -1), 6),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-    ]))
-    story.append(t)
-    story.append(Spacer(1, 0.5*cm))
-    
-    # Totals
-    btw_pct = float(est['btw_percentage'])
-    subtotal = float(est['subtotal'])
-    btw_amount = subtotal * (btw_pct / 100)
-    
-    story.append(Paragraph(f"Subtotaal: €{subtotal:.2f}", styles['SmallRight']))
-    story.append(Paragraph(f"BTW ({btw_pct:.0f}%): €{btw_amount:.2f}", styles['SmallRight']))
-    story.append(Spacer(1, 4))
-    story.append(Paragraph(f"TOTAAL: €{float(est['total_incl_btw']):.2f}", styles['TotalStyle']))
-    
-    # Signature
-    if est.get('signature_data'):
-        story.append(Spacer(1, 1*cm))
-        story.append(Paragraph('HANDTEKENING KLANT', styles['SectionHead']))
-        try:
-            sig_data = est['signature_data'].split(',')[1] if ',' in est['signature_data'] else est['signature_data']
-            sig_bytes = base64.b64decode(sig_data)
-            sig_buffer = io.BytesIO(sig_bytes)
-            sig_img = RLImage(sig_buffer, width=6*cm, height=3*cm)
-            story.append(sig_img)
-        except Exception:
-            story.append(Paragraph('[Handtekening opgeslagen]', styles['BodyText2']))
-    
-    # Payment info for invoices
-    if is_invoice and settings.get('company_iban'):
-        story.append(Spacer(1, 1*cm))
-        story.append(Paragraph('BETAALGEGEVENS', styles['SectionHead']))
-        story.append(Paragraph(f"IBAN: {settings['company_iban']}", styles['BodyText2']))
-        story.append(Paragraph(f"T.n.v. {settings.get('company_name', '')}", styles['BodyText2']))
-        story.append(Paragraph(f"Ref: {prefix}-{estimate_id[:8].upper()}", styles['BodyText2']))
-    
-    if est.get('notes'):
-        story.append(Spacer(1, 0.5*cm))
-        story.append(Paragraph('OPMERKINGEN', styles['SectionHead']))
-        story.append(Paragraph(est['notes'], styles['BodyText2']))
-    
-    doc.build(story)
-    buffer.seek(0)
+    path, key = pdf.cached_pdf_offloaded(est, lines, upsells, company)
+    _, _, filename = pdf.document_info(est, company)
+    response = send_file(path, mimetype='application/pdf', as_attachment=True, download_name=filename,
+                         conditional=True, etag=key, max_age=0)
+    response.cache_control.private = True
+    return response
+
+@jobs.task('pdf.prerender', max_attempts=3)
+def prerender_pdf_job(payload):
+    document = load_pdf_document(payload['estimate_id'])
+    if document is None:
+        raise jobs.JobFailed('Offerte niet gevonden')
+    _, key = pdf.cached_pdf_offloaded(*document, settings.current())
+    return {'etag': key}
+
+# ─── INVOICE EXPORT ─────────────────────────────────────────────
+EXPORT_PAGE_SIZE = 200
+INVOICE_TIMEZONE = zoneinfo.ZoneInfo('Europe/Amsterdam')
+
+def iter_export_documents(statuses, date_from, date_until):
+    # Paged by id so only one page of estimates is held at a time. The period
+    # is in completion dates, Dutch time like the revenue report: an invoice
+    # belongs to the period its work was done, not when it was quoted.
+    sb = get_supabase()
+    since = datetime.datetime.combine(date_from, datetime.time(), INVOICE_TIMEZONE).isoformat()
+    until = datetime.datetime.combine(date_until, datetime.time(), INVOICE_TIMEZONE).isoformat()
+    last_id = None
+    while True:
+        query = sb.table('estimates').select('*, customers(*), estimate_lines(*), estimate_upsells(*)') \
+            .in_('status', statuses).gte('completed_at', since).lt('completed_at', until) \
+            .order('id').limit(EXPORT_PAGE_SIZE)
+        if last_id:
+            query = query.gt('id', last_id)
+        rows = query.execute().data
+        for est in rows:
+            lines = est.pop('estimate_lines', None) or []
+            upsells = est.pop('estimate_upsells', None) or []
+            yield est, lines, upsells
+        if len(rows) < EXPORT_PAGE_SIZE:
+            break
+        last_id = rows[-1]['id']
+
+@app.route('/api/invoices/export', methods=['GET'])
+@token_required
+@admin_required
+def export_invoices():
+    statuses = [st for st in request.args.get('status', 'factuur,betaald').split(',') if st]
+    if not statuses or any(st not in pdf.INVOICE_STATUSES for st in statuses):
+        return jsonify({'error': 'Ongeldige status'}), 400
+    try:
+        date_from = datetime.date.fromisoformat(request.args['from'])
+        date_to = datetime.date.fromisoformat(request.args['to'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Geef een geldige periode op (from/to als JJJJ-MM-DD)'}), 400
     
-    filename = f"{doc_type.lower()}_{estimate_id[:8]}.pdf"
-    return send_file(buffer, mimetype='application/pdf', as_attachment=True, download_name=filename)
+    documents = iter_export_documents(statuses, date_from, date_to + datetime.timedelta(days=1))
+    filename = f'facturen_{date_from.isoformat()}_{date_to.isoformat()}.zip'
+    return app.response_class(
+        stream_with_context(pdf.export_zip(documents, settings.current())),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
 
 # ─── USERS (Admin) ─────────────────────────────────────────────
 @app.route('/api/users', methods=['GET'])
 @token_required
 @admin_required
 def get_users():
-    sb = get_supabase()
-    result = sb.table('users').select('id, name, email, role, created_at').order('created_at').execute()
-    return jsonify(result.data)
+    return paged_list('users')
+
+# ─── SYNC ───────────────────────────────────────────────────────
+# Devices keep their own copy of customers, estimates, services, upsells,
+# inventory and photo metadata and ask for what changed since their last
+# cursor (sync_changes in supabase_setup.sql). Without `since` the first
+# pages are a full copy. The cursor is opaque to clients: either a position
+# in the change stream, or that plus where to resume a page that filled up.
+SYNC_PAGE_SIZE = int(os.environ.get('SYNC_PAGE_SIZE', 1000))
+SYNC_MAX_PAGE_SIZE = 5000
+
+def encode_sync_cursor(*parts):
+    raw = json.dumps(parts).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_sync_cursor(cursor):
+    parts = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    if not isinstance(parts, list) or len(parts) not in (1, 5) or not all(isinstance(p, (str, type(None))) for p in parts):
+        raise ValueError(cursor)
+    return parts + [None] * (5 - len(parts))
+
+@app.route('/api/sync', methods=['GET'])
+@token_required
+def sync():
+    try:
+        since, resume_since, table, after_txid, after_id = \
+            decode_sync_cursor(request.args['since']) if request.args.get('since') else [None] * 5
+        limit = min(int(request.args.get('limit', SYNC_PAGE_SIZE)), SYNC_MAX_PAGE_SIZE)
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Ongeldige sync cursor of limit'}), 400
+
+    def fetch(since, table=None, after_txid=None, after_id=None):
+        return db.rpc('sync_changes', {'p_since': since, 'p_table': table, 'p_after_txid': after_txid,
+                                       'p_after_id': after_id, 'p_limit': limit})
+
+    result = fetch(since, table, after_txid, after_id)
+    # A full copy starts here: the device drops what it has
+    full = since is None and table is None
+    if result.get('reset'):
+        # Tombstones this device still needed are gone: start over
+        result, full, since, resume_since = fetch(None), True, None, None
+
+    # Paging through one sync keeps the position from its first page
+    resume_since = resume_since or result['xmin']
+    step = result.get('next')
+    if step:
+        cursor = encode_sync_cursor(since, resume_since, step['table'], step['txid'], step['id'])
+    else:
+        cursor = encode_sync_cursor(resume_since)
+    return jsonify({
+        'full': full,
+        'changes': result['changes'],
+        'deleted': result['deleted'],
+        'cursor': cursor,
+        'more': bool(step)
+    })
+
+@app.cli.command('purge-tombstones')
+@click.option('--days', default=30, show_default=True, help='Keep tombstones this many days.')
+def purge_tombstones_command(days):
+    """Remove old sync tombstones; devices that have not synced since then get a full sync."""
+    purged = db.rpc('purge_sync_tombstones', {'p_keep_days': days})
+    click.echo(f'{purged} tombstones removed')
+
+# ─── JOBS ───────────────────────────────────────────────────────
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@token_required
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if not job or (job['user_id'] != request.user_id and request.user_role != 'admin'):
+        return jsonify({'error': 'Taak niet gevonden'}), 404
+    return jsonify(job)
+
+@app.cli.command('worker')
+@click.option('--poll', default=jobs.JOB_POLL_SECONDS, show_default=True, help='Seconds between queue checks when idle.')
+def worker_command(poll):
+    """Run background jobs until stopped (SIGTERM/SIGINT)."""
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+    click.echo(f'Worker {os.getpid()} running jobs from {jobs.JOBS_DB_PATH}')
+    jobs.work(stop, poll=poll)
+
+@app.before_request
+def ensure_inline_worker():
+    # Started by the first request rather than at import, so CLI commands
+    # and the gunicorn master do not run one
+    if jobs.JOBS_INLINE_WORKER:
+        jobs.start_inline_worker()
+
+# ─── STARTUP ────────────────────────────────────────────────────
+@app.cli.command('startup-report')
+@click.option('--warm/--no-warm', default=True, show_default=True,
+              help='Also load what is deferred to first use, as the gunicorn master does.')
+def startup_report_command(warm):
+    """Show how long this process took to start, per subsystem."""
+    if warm:
+        startup.warm()
+    for phase, seconds in startup.report():
+        click.echo(f'{phase:<20} {seconds * 1000:8.1f} ms')
+
+# Every route and hook is registered; what follows is serving
+startup.ready()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
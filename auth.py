@@ -0,0 +1,169 @@
+"""Password hashing and login throttling.
+
+bcrypt is deliberately slow. It runs on a small bounded thread pool (bcrypt
+releases the GIL while it works) so a burst of logins can only occupy
+AUTH_HASH_THREADS cores and never queues up behind every request thread.
+Hashes made with another cost than BCRYPT_ROUNDS are upgraded on the next
+successful login. bcrypt itself is imported on the first hash.
+"""
+import collections
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+HASH_THREADS = int(os.environ.get('AUTH_HASH_THREADS', 2))
+# Hashes waiting or running per process before new logins are turned away
+MAX_PENDING = int(os.environ.get('AUTH_MAX_PENDING', HASH_THREADS * 8))
+
+LOGIN_WINDOW = int(os.environ.get('LOGIN_WINDOW_SECONDS', 300))
+LOGIN_MAX_PER_IP = int(os.environ.get('LOGIN_MAX_PER_IP', 30))
+LOGIN_MAX_FAILURES_PER_EMAIL = int(os.environ.get('LOGIN_MAX_FAILURES_PER_EMAIL', 5))
+
+
+class AuthBusy(Exception):
+    """Too many hashes in flight; the client should retry shortly."""
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_pending = threading.BoundedSemaphore(MAX_PENDING)
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=HASH_THREADS, thread_name_prefix='bcrypt')
+    return _pool
+
+
+def _after_fork():
+    global _pool, _pool_lock, _pending
+    _pool = None
+    _pool_lock = threading.Lock()
+    _pending = threading.BoundedSemaphore(MAX_PENDING)
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _run(operation, fn, *args):
+    if not _pending.acquire(blocking=False):
+        raise AuthBusy()
+    try:
+        def timed():
+            started = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                metrics.AUTH_HASH_SECONDS.observe(time.perf_counter() - started, operation)
+        return _get_pool().submit(timed).result()
+    finally:
+        _pending.release()
+
+
+# ─── Hashing ────────────────────────────────────────────────────
+def hash_password(password):
+    import bcrypt
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
+    return _run('hash', bcrypt.hashpw, password.encode('utf-8'), salt).decode('utf-8')
+
+
+def check_password(password, password_hash):
+    import bcrypt
+    try:
+        return _run('check', bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8'))
+    except ValueError:
+        # Not a bcrypt hash at all
+        return False
+
+
+def needs_rehash(password_hash):
+    # "$2b$12$..." — the cost is the second field
+    try:
+        return int(password_hash.split('$')[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+
+# ─── Throttling ─────────────────────────────────────────────────
+class LoginThrottle:
+    """Sliding-window counters: all attempts per IP, failures per email."""
+
+    def __init__(self, window=LOGIN_WINDOW, max_per_ip=LOGIN_MAX_PER_IP,
+                 max_failures_per_email=LOGIN_MAX_FAILURES_PER_EMAIL, max_keys=10000):
+        self.window = window
+        self.max_per_ip = max_per_ip
+        self.max_failures_per_email = max_failures_per_email
+        self.max_keys = max_keys
+        self._hits = {}
+        self._lock = threading.Lock()
+
+    def _recent(self, key, now):
+        hits = self._hits.get(key)
+        if hits is None:
+            return None
+        while hits and hits[0] <= now - self.window:
+            hits.popleft()
+        if not hits:
+            del self._hits[key]
+            return None
+        return hits
+
+    def _add(self, key, now):
+        hits = self._recent(key, now)
+        if hits is None:
+            if len(self._hits) >= self.max_keys:
+                self._hits.pop(next(iter(self._hits)))
+            hits = self._hits[key] = collections.deque()
+        hits.append(now)
+
+    def _retry_after(self, hits, limit, now):
+        if hits is None or len(hits) < limit:
+            return 0
+        return max(1, int(hits[-limit] + self.window - now) + 1)
+
+    def attempt(self, ip, email):
+        """Count a login attempt; returns seconds to wait, 0 when allowed."""
+        now = time.monotonic()
+        with self._lock:
+            email_key = ('email', email.strip().lower())
+            wait = max(self._retry_after(self._recent(('ip', ip), now), self.max_per_ip, now),
+                       self._retry_after(self._recent(email_key, now), self.max_failures_per_email, now))
+            if not wait:
+                self._add(('ip', ip), now)
+            return wait
+
+    def failed(self, email):
+        with self._lock:
+            self._add(('email', email.strip().lower()), time.monotonic())
+
+    def succeeded(self, email):
+        with self._lock:
+            self._hits.pop(('email', email.strip().lower()), None)
+
+
+login_throttle = LoginThrottle()
+
+
+# ─── Users ──────────────────────────────────────────────────────
+# Users are never deleted through the API, so once one exists that stays
+# true and register() can skip the "first user becomes admin" query.
+_users_exist = False
+
+
+def users_exist(client):
+    global _users_exist
+    if not _users_exist:
+        _users_exist = bool(client.table('users').select('id').limit(1).execute().data)
+    return _users_exist
+
+
+def mark_users_exist():
+    global _users_exist
+    _users_exist = True
@@ -0,0 +1,4 @@
+"""Offline benchmarks: the app against an in-memory PostgREST stand-in.
+
+Run with ``python -m bench.run``; see bench/run.py for the options.
+"""
@@ -0,0 +1,181 @@
+"""Seeded, realistic dataset for the fake PostgREST backend.
+
+``scale=1.0`` is the production-sized target (100k customers, 500k
+estimates with their lines, upsells, photos and inventory log); smaller
+scales keep the same shape with proportionally fewer rows.
+"""
+import datetime
+import random
+import uuid
+
+FULL_CUSTOMERS = 100_000
+ESTIMATES_PER_CUSTOMER = 5
+
+FIRST_NAMES = ('Jan', 'Piet', 'Kees', 'Henk', 'Sanne', 'Anouk', 'Lotte', 'Daan', 'Sem', 'Emma',
+               'Julia', 'Tess', 'Bram', 'Lucas', 'Fleur', 'Noah', 'Mila', 'Ruben', 'Sophie', 'Thijs')
+LAST_NAMES = ('de Jong', 'Jansen', 'de Vries', 'van den Berg', 'van Dijk', 'Bakker', 'Janssen',
+              'Visser', 'Smit', 'Meijer', 'de Boer', 'Mulder', 'de Groot', 'Bos', 'Vos', 'Peters',
+              'Hendriks', 'van Leeuwen', 'Dekker', 'Brouwer')
+STREETS = ('Dorpsstraat', 'Kerkstraat', 'Molenweg', 'Schoolstraat', 'Stationsweg', 'Beukenlaan',
+           'Eikenlaan', 'Julianastraat', 'Wilhelminastraat', 'Nieuwstraat', 'Parallelweg', 'Lindenlaan')
+CITIES = ('Utrecht', 'Amersfoort', 'Zeist', 'Houten', 'Nieuwegein', 'IJsselstein', 'Bunnik', 'Maarssen')
+
+SERVICES = (
+    # name, price, heavy multiplier, chemical usage per m², linked inventory item
+    ('Klinkers reinigen', 3.50, 1.3, 0.05, 'Groene aanslag reiniger'),
+    ('Dak reinigen', 5.00, 1.3, 0.08, 'Dakreiniger'),
+    ('Gevel reinigen', 4.00, 1.3, 0.04, 'Gevelreiniger'),
+    ('Vlonder reinigen', 4.50, 1.3, 0.06, 'Houtreiniger'),
+    ('Impregneren', 2.50, 1.0, 0.10, 'Impregneermiddel'),
+)
+UPSELLS = (('Voegzand invegen', 75.0), ('Onkruid verwijderen', 45.0), ('Dakgoot reinigen', 60.0),
+           ('Zonnepanelen reinigen', 90.0))
+INVENTORY = ('Groene aanslag reiniger', 'Dakreiniger', 'Gevelreiniger', 'Houtreiniger',
+             'Impregneermiddel', 'Voegzand', 'Onkruidbrander gas', 'Handschoenen', 'Filters', 'Diesel')
+
+STATUSES = ('concept', 'offerte', 'akkoord', 'voltooid', 'factuur', 'betaald')
+STATUS_WEIGHTS = (10, 15, 5, 10, 15, 45)
+
+SETTINGS = {
+    'company_name': 'Bench Reiniging BV', 'company_email': 'info@bench.test', 'company_phone': '030-1234567',
+    'company_address': 'Dorpsstraat 1, 3511 AA Utrecht', 'company_kvk': '12345678',
+    'company_btw_id': 'NL123456789B01', 'company_iban': 'NL00BANK0123456789', 'company_logo': '',
+    'btw_percentage': '21', 'estimate_prefix': 'OFF', 'invoice_prefix': 'FAC',
+    'estimate_counter': '1', 'invoice_counter': '1',
+}
+
+
+def _uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def _ts(moment):
+    return moment.isoformat(timespec='microseconds')
+
+
+def _phone(rng):
+    number = f'6{rng.randrange(10**7, 10**8)}'
+    style = rng.randrange(3)
+    if style == 0:
+        return f'0{number[0]}-{number[1:]}'
+    if style == 1:
+        return f'+31 {number[0]} {number[1:5]} {number[5:]}'
+    return f'0{number}'
+
+
+def build(scale=0.02, seed=42, now=None):
+    """Return {table: [row, ...]} with ``scale`` × the production volume.
+
+    The revenue tables start empty; ``bench.rpc.backfill_revenue`` fills
+    them the way the migration in supabase_setup.sql does.
+    """
+    rng = random.Random(seed)
+    now = now or datetime.datetime(2026, 6, 15, 12, 0, tzinfo=datetime.timezone.utc)
+    start = now - datetime.timedelta(days=3 * 365)
+    span = int((now - start).total_seconds())
+
+    def moment():
+        return start + datetime.timedelta(seconds=rng.randrange(span))
+
+    tables = {name: [] for name in ('users', 'customers', 'services', 'upsell_items', 'inventory',
+                                    'estimates', 'estimate_lines', 'estimate_upsells', 'project_photos',
+                                    'inventory_log', 'settings', 'revenue_entries', 'revenue_rollups',
+                                    'sync_tombstones')}
+
+    # Not a usable hash; the benchmark uses signed tokens instead of logging in
+    password_hash = '!'
+    for i, (name, role) in enumerate((('Admin', 'admin'), ('Monteur 1', 'technician'), ('Monteur 2', 'technician'))):
+        tables['users'].append({'id': _uuid(rng), 'email': f'user{i}@bench.test', 'name': name, 'role': role,
+                                'password_hash': password_hash, 'created_at': _ts(start)})
+    user_ids = [u['id'] for u in tables['users']]
+
+    inventory_ids = {}
+    for name in INVENTORY:
+        row = {'id': _uuid(rng), 'item_name': name, 'quantity_on_hand': float(rng.randrange(0, 200)),
+               'unit': 'L', 'threshold_warning': 5.0, 'created_at': _ts(start), 'updated_at': _ts(start)}
+        inventory_ids[name] = row['id']
+        tables['inventory'].append(row)
+
+    for name, price, heavy, usage, item in SERVICES:
+        tables['services'].append({'id': _uuid(rng), 'name': name, 'price_per_unit': price, 'unit_type': 'm2',
+                                   'heavy_multiplier': heavy, 'chemical_usage_rate': usage, 'chemical_unit': 'L',
+                                   'linked_inventory_id': inventory_ids[item], 'active': True,
+                                   'created_at': _ts(start), 'updated_at': _ts(start)})
+    for name, price in UPSELLS:
+        tables['upsell_items'].append({'id': _uuid(rng), 'name': name, 'price': price, 'active': True,
+                                       'created_at': _ts(start), 'updated_at': _ts(start)})
+
+    tables['settings'] = [{'key': key, 'value': value, 'updated_at': _ts(start)} for key, value in SETTINGS.items()]
+
+    n_customers = max(10, int(FULL_CUSTOMERS * scale))
+    for _ in range(n_customers):
+        created = moment()
+        tables['customers'].append({
+            'id': _uuid(rng),
+            'name': f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+            'address': f'{rng.choice(STREETS)} {rng.randrange(1, 250)}{rng.choice(("", "", "", "a", "b"))}, '
+                       f'{rng.randrange(1000, 9999)} {rng.choice("ABCDEFGHJKLMNPRSTVWXZ")}{rng.choice("ABCDEFGHJKLMNPRSTVWXZ")} '
+                       f'{rng.choice(CITIES)}',
+            'phone': _phone(rng),
+            'email': '',
+            'parking_situation': rng.choice(('oprit', 'straat', 'vergunning')),
+            'water_tap_location': rng.choice(('voorgevel', 'achtertuin', 'garage', '')),
+            'water_pressure_lpm': float(rng.randrange(8, 20)),
+            'notes': '',
+            'created_at': _ts(created),
+            'updated_at': _ts(created),
+        })
+
+    services = tables['services']
+    upsells = tables['upsell_items']
+    for customer in tables['customers']:
+        for _ in range(rng.randrange(ESTIMATES_PER_CUSTOMER * 2 + 1)):
+            created = moment()
+            updated = min(now, created + datetime.timedelta(days=rng.randrange(0, 30)))
+            status = rng.choices(STATUSES, STATUS_WEIGHTS)[0]
+            estimate_id = _uuid(rng)
+            subtotal = 0.0
+            for _ in range(rng.randrange(1, 4)):
+                service = rng.choice(services)
+                area = float(rng.randrange(10, 150))
+                heavy = rng.random() < 0.3
+                multiplier = service['heavy_multiplier'] if heavy else 1.0
+                total = round(area * service['price_per_unit'] * multiplier, 2)
+                subtotal += total
+                tables['estimate_lines'].append({
+                    'id': _uuid(rng), 'estimate_id': estimate_id, 'service_id': service['id'],
+                    'description': service['name'], 'square_meters': area,
+                    'pollution_level': 'zwaar' if heavy else 'standaard', 'unit_price': service['price_per_unit'],
+                    'multiplier': multiplier, 'line_total': total, 'created_at': _ts(created),
+                })
+            for upsell in rng.sample(upsells, rng.randrange(0, 3)):
+                subtotal += upsell['price']
+                tables['estimate_upsells'].append({
+                    'id': _uuid(rng), 'estimate_id': estimate_id, 'upsell_item_id': upsell['id'],
+                    'description': upsell['name'], 'price': upsell['price'], 'created_at': _ts(created),
+                })
+            for photo_type in rng.sample(('voor', 'na', 'overig'), rng.randrange(0, 3)):
+                digest = f'{rng.getrandbits(256):064x}'
+                tables['project_photos'].append({
+                    'id': _uuid(rng), 'estimate_id': estimate_id, 'customer_id': customer['id'],
+                    'photo_type': photo_type, 'photo_data': None, 'caption': '', 'created_at': _ts(created),
+                    'storage_key': f'{digest[:2]}/{digest}.jpg', 'thumb_key': f'{digest[:2]}/{digest}_thumb.jpg',
+                    'content_type': 'image/jpeg', 'size_bytes': rng.randrange(200_000, 4_000_000),
+                    'width': 4032, 'height': 3024, 'sha256': digest,
+                })
+            subtotal = round(subtotal, 2)
+            tables['estimates'].append({
+                'id': estimate_id, 'customer_id': customer['id'], 'user_id': rng.choice(user_ids),
+                'status': status, 'subtotal': subtotal, 'btw_percentage': 21.0,
+                'total_incl_btw': round(subtotal * 1.21, 2), 'signature_sha256': None, 'signature_data': None, 'notes': '',
+                'created_at': _ts(created), 'updated_at': _ts(updated),
+                'completed_at': _ts(updated) if status in ('voltooid', 'factuur', 'betaald') else None,
+            })
+            if status in ('voltooid', 'factuur', 'betaald'):
+                tables['inventory_log'].append({
+                    'id': _uuid(rng), 'inventory_id': rng.choice(list(inventory_ids.values())),
+                    'estimate_id': estimate_id, 'change_amount': -round(rng.uniform(0.5, 12), 2),
+                    'reason': 'Auto-aftrek klus voltooid', 'created_at': _ts(updated),
+                })
+
+    return tables
@@ -0,0 +1,547 @@
+"""In-memory stand-in for Supabase's PostgREST, as an httpx transport.
+
+Implements the part of the PostgREST API the app uses:
+
+- ``select`` with columns and embedded resources (``*, customers(*)``)
+- filters ``eq neq gt gte lt lte in is like ilike``, ``not.`` and ``or=(...)``
+  with nested ``and(...)``
+- ``order`` (``col.desc,id.desc``, nulls first/last), ``limit``, ``offset``
+- ``Prefer: count=exact`` (Content-Range), ``return=representation``
+- POST (insert, upsert with ``resolution=merge-duplicates``), PATCH, DELETE
+- ``/rpc/<name>``, answered by the Python functions in ``bench.rpc``
+
+It answers from Python dicts, so it is only meant to make round trips and
+app-side work measurable, not to model Postgres query plans. Every request
+is counted against the ``Tally`` of the current context.
+"""
+import contextvars
+import datetime
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
+from urllib.parse import parse_qsl
+
+import httpx
+
+# Primary key per table (default "id")
+PRIMARY_KEYS = {'settings': 'key', 'revenue_rollups': 'key'}
+
+# Text columns with a hash index, used for top-level eq/in filters
+INDEXES = {
+    'users': ('email',),
+    'estimates': ('customer_id', 'status'),
+    'estimate_lines': ('estimate_id',),
+    'estimate_upsells': ('estimate_id',),
+    'project_photos': ('estimate_id', 'storage_key'),
+    'inventory_log': ('inventory_id', 'estimate_id'),
+    'revenue_entries': ('estimate_id',),
+    'revenue_rollups': ('grain',),
+}
+
+# (table, embedded table) → (kind, local column, remote column)
+RELATIONS = {
+    ('estimates', 'customers'): ('one', 'customer_id', 'id'),
+    ('estimates', 'users'): ('one', 'user_id', 'id'),
+    ('customers', 'estimates'): ('many', 'id', 'customer_id'),
+    ('estimates', 'estimate_lines'): ('many', 'id', 'estimate_id'),
+    ('estimates', 'estimate_upsells'): ('many', 'id', 'estimate_id'),
+    ('estimates', 'project_photos'): ('many', 'id', 'estimate_id'),
+    ('estimate_lines', 'services'): ('one', 'service_id', 'id'),
+    ('estimate_lines', 'estimates'): ('one', 'estimate_id', 'id'),
+    ('estimate_upsells', 'upsell_items'): ('one', 'upsell_item_id', 'id'),
+    ('services', 'inventory'): ('one', 'linked_inventory_id', 'id'),
+    ('inventory_log', 'inventory'): ('one', 'inventory_id', 'id'),
+}
+
+# Parent table → [(child table, foreign key column)] deleted along with it
+CASCADES = {
+    'customers': [('estimates', 'customer_id')],
+    'estimates': [('estimate_lines', 'estimate_id'), ('estimate_upsells', 'estimate_id'),
+                  ('project_photos', 'estimate_id')],
+    'inventory': [('inventory_log', 'inventory_id')],
+}
+
+# Column defaults applied on insert
+DEFAULTS = {
+    'estimates': {'status': 'concept', 'subtotal': 0, 'btw_percentage': 21, 'total_incl_btw': 0,
+                  'signature_sha256': None, 'signature_data': None, 'notes': None, 'completed_at': None},
+    'estimate_lines': {'pollution_level': 'standaard', 'multiplier': 1.0, 'square_meters': 0},
+    'services': {'active': True, 'unit_type': 'm2', 'heavy_multiplier': 1.3, 'chemical_usage_rate': 0,
+                 'chemical_unit': 'L', 'linked_inventory_id': None},
+    'upsell_items': {'active': True},
+    'inventory': {'quantity_on_hand': 0, 'unit': 'L', 'threshold_warning': 5},
+}
+TIMESTAMP_COLUMNS = {
+    'created_at': ('users', 'customers', 'services', 'upsell_items', 'inventory', 'estimates',
+                   'estimate_lines', 'estimate_upsells', 'project_photos', 'inventory_log'),
+    'updated_at': ('customers', 'inventory', 'estimates', 'settings', 'services', 'upsell_items'),
+}
+
+# Tables with a sync_txid and delete tombstones (the triggers of the delta
+# sync). Transaction ids are a plain counter: the fake has no concurrent
+# transactions, so the oldest running one is always the next to start.
+SYNC_TABLES = ('customers', 'estimates', 'services', 'upsell_items', 'inventory', 'project_photos')
+_txids = itertools.count(1)
+_txid_lock = threading.Lock()
+
+
+def next_txid():
+    with _txid_lock:
+        return next(_txids)
+
+
+def snapshot_xmin():
+    with _txid_lock:
+        # itertools.count has no peek; take one and leave a gap
+        return next(_txids)
+
+
+class FakeError(Exception):
+    def __init__(self, status, code, message):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+def now_iso():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='microseconds')
+
+
+# ─── Tables ─────────────────────────────────────────────────────
+class Table:
+    def __init__(self, name, rows=()):
+        self.name = name
+        self.pk = PRIMARY_KEYS.get(name, 'id')
+        self.rows = {}
+        self.indexes = {col: {} for col in INDEXES.get(name, ())}
+        self.synced = name in SYNC_TABLES
+        for row in rows:
+            if self.synced:
+                row.setdefault('sync_txid', 0)
+            self._add(row)
+
+    def _index(self, row):
+        for col, index in self.indexes.items():
+            index.setdefault(row.get(col), {})[row[self.pk]] = row
+
+    def _unindex(self, row):
+        for col, index in self.indexes.items():
+            bucket = index.get(row.get(col))
+            if bucket is not None:
+                bucket.pop(row[self.pk], None)
+                if not bucket:
+                    del index[row.get(col)]
+
+    def _add(self, row):
+        self.rows[row[self.pk]] = row
+        self._index(row)
+
+    def get(self, key):
+        return self.rows.get(key)
+
+    def insert(self, values):
+        row = dict(DEFAULTS.get(self.name, {}))
+        for col, tables in TIMESTAMP_COLUMNS.items():
+            if self.name in tables:
+                row[col] = now_iso()
+        if self.pk == 'id':
+            row['id'] = str(uuid.uuid4())
+        row.update(values)
+        if self.synced:
+            row['sync_txid'] = next_txid()
+        if row.get(self.pk) in self.rows:
+            raise FakeError(409, '23505', f'duplicate key value violates unique constraint "{self.name}_pkey"')
+        self._add(row)
+        return row
+
+    def update(self, row, values):
+        self._unindex(row)
+        row.update(values)
+        if self.synced:
+            row['sync_txid'] = next_txid()
+        self._index(row)
+        return row
+
+    def delete(self, row):
+        self._unindex(row)
+        del self.rows[row[self.pk]]
+
+    def candidates(self, filters):
+        """Rows that may match; narrowed through an index when possible."""
+        for op in filters:
+            if op[0] == 'cmp' and not op[4] and op[1] in self.indexes:
+                col, operator, value = op[1], op[2], op[3]
+                if operator == 'eq':
+                    return list(self.indexes[col].get(value, {}).values())
+                if operator == 'in':
+                    rows = []
+                    for v in value:
+                        rows.extend(self.indexes[col].get(v, {}).values())
+                    return rows
+        if self.pk == 'id':
+            for op in filters:
+                if op[0] == 'cmp' and not op[4] and op[1] == 'id' and op[2] == 'eq':
+                    row = self.rows.get(op[3])
+                    return [row] if row is not None else []
+        return list(self.rows.values())
+
+
+# ─── Parsing ────────────────────────────────────────────────────
+def split_top(text, sep=','):
+    """Split on ``sep`` outside parentheses and double quotes."""
+    parts, depth, quoted, current, escaped = [], 0, False, [], False
+    for ch in text:
+        if escaped:
+            current.append(ch)
+            escaped = False
+            continue
+        if ch == '\\' and quoted:
+            current.append(ch)
+            escaped = True
+            continue
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted and ch == '(':
+            depth += 1
+        elif not quoted and ch == ')':
+            depth -= 1
+        if ch == sep and depth == 0 and not quoted:
+            parts.append(''.join(current))
+            current = []
+        else:
+            current.append(ch)
+    parts.append(''.join(current))
+    return [p.strip() for p in parts if p.strip()]
+
+
+def unquote(value):
+    if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+        return re.sub(r'\\(.)', r'\1', value[1:-1])
+    return value
+
+
+def parse_select(text):
+    """'*, customers(name, address)' → [('*', None), ('customers', [...])]."""
+    items = []
+    for part in split_top(text or '*'):
+        if '(' in part and part.endswith(')'):
+            name, inner = part.split('(', 1)
+            name = name.split('!')[0].strip()
+            alias = None
+            if ':' in name:
+                alias, name = name.split(':', 1)
+            items.append((name.strip(), parse_select(inner[:-1]), (alias or name).strip()))
+        else:
+            alias = None
+            if ':' in part:
+                alias, part = part.split(':', 1)
+            items.append((part.strip(), None, (alias or part).strip()))
+    return items
+
+
+def parse_condition(col, expr):
+    """('status', 'in.(a,b)') → ('cmp', 'status', 'in', ['a', 'b'], negated)."""
+    negated = False
+    if expr.startswith('not.'):
+        negated = True
+        expr = expr[4:]
+    operator, _, value = expr.partition('.')
+    if operator == 'in':
+        value = [unquote(v) for v in split_top(value.strip()[1:-1])]
+    elif operator == 'is':
+        value = {'null': None, 'true': True, 'false': False}[value.lower()]
+    else:
+        value = unquote(value)
+    if operator not in ('eq', 'neq', 'gt', 'gte', 'lt', 'lte', 'in', 'is', 'like', 'ilike'):
+        raise FakeError(400, 'PGRST100', f'unsupported operator {operator}')
+    return ('cmp', col, operator, value, negated)
+
+
+def parse_logic(kind, text):
+    """'(a.eq.1,and(b.gt.2,c.lt.3))' → ('or', [conditions...])."""
+    conditions = []
+    for part in split_top(text.strip()[1:-1]):
+        head = part.split('(', 1)[0]
+        if head in ('and', 'or', 'not.and', 'not.or') and '(' in part:
+            node = parse_logic(head.replace('not.', ''), part[len(head):])
+            conditions.append(('not', node) if head.startswith('not.') else node)
+        else:
+            col, expr = part.split('.', 1)
+            conditions.append(parse_condition(col, expr))
+    return (kind, conditions)
+
+
+def parse_order(text):
+    keys = []
+    for part in split_top(text):
+        bits = part.split('.')
+        col, desc, nulls_first = bits[0], False, None
+        for bit in bits[1:]:
+            if bit == 'desc':
+                desc = True
+            elif bit == 'nullsfirst':
+                nulls_first = True
+            elif bit == 'nullslast':
+                nulls_first = False
+        if nulls_first is None:
+            nulls_first = desc
+        keys.append((col, desc, nulls_first))
+    return keys
+
+
+# ─── Evaluation ─────────────────────────────────────────────────
+def coerce(raw, sample):
+    """Turn a filter string into the type of the row value it is compared to."""
+    if isinstance(sample, bool):
+        return raw if isinstance(raw, bool) else str(raw).lower() == 'true'
+    if isinstance(sample, (int, float)):
+        try:
+            return float(raw)
+        except (TypeError, ValueError):
+            return raw
+    return raw
+
+
+def _like(pattern, value, flags=0):
+    regex = '^' + '.*'.join(re.escape(piece) for piece in re.split(r'[*%]', pattern)) + '$'
+    return re.match(regex, value, flags | re.DOTALL) is not None
+
+
+def evaluate(row, condition):
+    kind = condition[0]
+    if kind == 'and':
+        return all(evaluate(row, c) for c in condition[1])
+    if kind == 'or':
+        return any(evaluate(row, c) for c in condition[1])
+    if kind == 'not':
+        return not evaluate(row, condition[1])
+    _, col, operator, raw, negated = condition
+    value = row.get(col)
+    if operator == 'is':
+        result = value is raw
+    elif value is None:
+        result = False
+    elif operator == 'in':
+        result = value in [coerce(v, value) for v in raw]
+    elif operator in ('like', 'ilike'):
+        result = _like(raw, str(value), re.IGNORECASE if operator == 'ilike' else 0)
+    else:
+        other = coerce(raw, value)
+        try:
+            result = {
+                'eq': value == other, 'neq': value != other,
+                'gt': value > other, 'gte': value >= other,
+                'lt': value < other, 'lte': value <= other,
+            }[operator]
+        except TypeError:
+            result = str(value) > str(other) if operator in ('gt', 'gte') else str(value) < str(other)
+    return not result if negated else result
+
+
+def sort_rows(rows, keys):
+    # Stable sorts from the last key to the first, each with its own direction
+    for col, desc, nulls_first in reversed(keys):
+        present = [r for r in rows if r.get(col) is not None]
+        missing = [r for r in rows if r.get(col) is None]
+        present.sort(key=lambda r: r[col], reverse=desc)
+        rows = missing + present if nulls_first else present + missing
+    return rows
+
+
+class FakePostgREST(httpx.BaseTransport):
+    def __init__(self, tables, rpcs=None, latency=0.0):
+        """``tables``: {name: [row, ...]}; ``rpcs``: {name: fn(fake, **params)};
+        ``latency``: simulated network seconds per round trip."""
+        self.tables = {name: Table(name, rows) for name, rows in tables.items()}
+        self.rpcs = rpcs or {}
+        self.latency = latency
+        self.lock = threading.RLock()
+
+    def table(self, name):
+        if name not in self.tables:
+            raise FakeError(404, '42P01', f'relation "public.{name}" does not exist')
+        return self.tables[name]
+
+    # ── embedding / projection ──
+    def project(self, table_name, row, select):
+        out = {}
+        for name, sub, alias in select:
+            if name == '*' and sub is None:
+                out.update(row)
+            elif sub is None:
+                out[alias] = row.get(name)
+            else:
+                out[alias] = self.embed(table_name, name, row, sub)
+        return out
+
+    def embed(self, table_name, target, row, select):
+        relation = RELATIONS.get((table_name, target))
+        if relation is None:
+            raise FakeError(400, 'PGRST200', f"Could not find a relationship between '{table_name}' and '{target}'")
+        kind, local, remote = relation
+        other = self.table(target)
+        if kind == 'one':
+            key = row.get(local)
+            found = other.get(key) if remote == other.pk else next(
+                (r for r in other.rows.values() if r.get(remote) == key), None)
+            return self.project(target, found, select) if found is not None else None
+        if remote in other.indexes:
+            matches = list(other.indexes[remote].get(row.get(local), {}).values())
+        else:
+            matches = [r for r in other.rows.values() if r.get(remote) == row.get(local)]
+        return [self.project(target, r, select) for r in matches]
+
+    # ── request handling ──
+    def handle_request(self, request):
+        tally = current_tally.get()
+        started = time.perf_counter()
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            with self.lock:
+                return self._dispatch(request)
+        except FakeError as e:
+            return httpx.Response(e.status, json={'code': e.code, 'message': e.message, 'details': None, 'hint': None})
+        finally:
+            if tally is not None:
+                tally.add(started, time.perf_counter())
+
+    def _dispatch(self, request):
+        path = request.url.path.split('/rest/v1/', 1)[-1].strip('/')
+        params = parse_qsl(request.url.query.decode('ascii'), keep_blank_values=True)
+        prefer = request.headers.get('prefer', '')
+        body = json.loads(request.content) if request.content else None
+
+        if path.startswith('rpc/'):
+            fn = self.rpcs.get(path[4:])
+            if fn is None:
+                raise FakeError(404, 'PGRST202', f'Could not find the function public.{path[4:]}')
+            result = fn(self, **(body or {}))
+            return httpx.Response(200, content=json.dumps(result, default=str).encode('utf-8'),
+                                  headers={'Content-Type': 'application/json'})
+
+        table = self.table(path)
+        select = parse_select('*')
+        filters, order, limit, offset, on_conflict = [], [], None, 0, None
+        for key, value in params:
+            if key == 'select':
+                select = parse_select(value)
+            elif key == 'order':
+                order = parse_order(value)
+            elif key == 'limit':
+                limit = int(value)
+            elif key == 'offset':
+                offset = int(value)
+            elif key == 'on_conflict':
+                on_conflict = value
+            elif key == 'columns':
+                continue
+            elif key in ('or', 'and', 'not.or', 'not.and'):
+                node = parse_logic(key.replace('not.', ''), value)
+                filters.append(('not', node) if key.startswith('not.') else node)
+            else:
+                filters.append(parse_condition(key, value))
+
+        if request.method in ('GET', 'HEAD'):
+            rows = [r for r in table.candidates(filters) if all(evaluate(r, f) for f in filters)]
+            total = len(rows)
+            if order:
+                rows = sort_rows(rows, order)
+            rows = rows[offset:offset + limit if limit is not None else None]
+            headers = {'Content-Type': 'application/json'}
+            if 'count=exact' in prefer:
+                end = offset + len(rows) - 1
+                headers['Content-Range'] = f'{offset}-{end}/{total}' if rows else f'*/{total}'
+            data = [self.project(table.name, r, select) for r in rows]
+            return httpx.Response(200, content=json.dumps(data, default=str).encode('utf-8'), headers=headers)
+
+        if request.method == 'POST':
+            values = body if isinstance(body, list) else [body]
+            merge = 'resolution=merge-duplicates' in prefer
+            conflict = on_conflict or table.pk
+            written = []
+            for item in values:
+                existing = None
+                if merge and item.get(conflict) is not None:
+                    existing = next((r for r in table.rows.values() if r.get(conflict) == item[conflict]), None) \
+                        if conflict != table.pk else table.get(item[conflict])
+                written.append(table.update(existing, item) if existing else table.insert(item))
+            return self._written(201, table, written, select, prefer)
+
+        if request.method == 'PATCH':
+            rows = [r for r in table.candidates(filters) if all(evaluate(r, f) for f in filters)]
+            written = [table.update(r, body) for r in rows]
+            return self._written(200, table, written, select, prefer)
+
+        if request.method == 'DELETE':
+            rows = [r for r in table.candidates(filters) if all(evaluate(r, f) for f in filters)]
+            for r in rows:
+                self.delete_cascade(table, r)
+            return self._written(200, table, rows, select, prefer)
+
+        raise FakeError(405, 'PGRST000', f'method {request.method} not supported')
+
+    def _written(self, status, table, rows, select, prefer):
+        if 'return=representation' not in prefer:
+            return httpx.Response(204 if status == 200 else status)
+        data = [self.project(table.name, r, select) for r in rows]
+        return httpx.Response(status, content=json.dumps(data, default=str).encode('utf-8'),
+                              headers={'Content-Type': 'application/json'})
+
+    def delete_cascade(self, table, row):
+        for child_name, column in CASCADES.get(table.name, ()):
+            child = self.tables.get(child_name)
+            if child is None:
+                continue
+            children = list(child.indexes[column].get(row[table.pk], {}).values()) if column in child.indexes \
+                else [r for r in child.rows.values() if r.get(column) == row[table.pk]]
+            for child_row in children:
+                self.delete_cascade(child, child_row)
+        table.delete(row)
+        if table.synced and 'sync_tombstones' in self.tables:
+            self.tables['sync_tombstones'].insert({'table_name': table.name, 'row_id': row[table.pk],
+                                                   'sync_txid': next_txid(), 'deleted_at': now_iso()})
+
+    def close(self):
+        # Shared by every client the benchmark builds; nothing to release
+        pass
+
+
+# ─── Round-trip accounting ──────────────────────────────────────
+class Tally:
+    """Round trips and backend time of one benchmarked request."""
+
+    def __init__(self):
+        self.calls = 0
+        self._spans = []
+        self._lock = threading.Lock()
+
+    def add(self, started, finished):
+        with self._lock:
+            self.calls += 1
+            self._spans.append((started, finished))
+
+    @property
+    def seconds(self):
+        """Wall time with at least one round trip in flight.
+
+        Concurrent (fanned-out) round trips overlap, so their durations are
+        merged rather than summed.
+        """
+        total = 0.0
+        end = None
+        for started, finished in sorted(self._spans):
+            if end is None or started > end:
+                total += finished - started
+                end = finished
+            elif finished > end:
+                total += finished - end
+                end = finished
+        return total
+
+
+current_tally = contextvars.ContextVar('bench_tally', default=None)
@@ -0,0 +1,390 @@
+"""Python versions of the Postgres functions in supabase_setup.sql.
+
+Each takes the fake backend plus the RPC's named parameters and returns
+what the SQL function returns. They follow the SQL closely enough for the
+app's handlers to behave the same; search ranking is a simplification of
+the trigram/full-text version.
+"""
+import datetime
+import re
+import zoneinfo
+from decimal import ROUND_HALF_UP, Decimal
+
+from bench.fake_postgrest import SYNC_TABLES, FakeError, now_iso, snapshot_xmin
+
+FUNCTIONS = {}
+
+DONE_STATUSES = ('voltooid', 'factuur', 'betaald')
+
+
+def rpc(fn):
+    FUNCTIONS[fn.__name__] = fn
+    return fn
+
+
+def _estimates_with_status(fake, *statuses):
+    index = fake.table('estimates').indexes['status']
+    for status in statuses:
+        yield from index.get(status, {}).values()
+
+
+@rpc
+def dashboard_summary(fake, p_month_start, p_last_month_start):
+    customers = fake.table('customers')
+    today_jobs = []
+    for e in _estimates_with_status(fake, 'akkoord'):
+        customer = customers.get(e['customer_id']) or {}
+        today_jobs.append({
+            'id': e['id'], 'customer_id': e['customer_id'], 'status': e['status'],
+            'total_incl_btw': e['total_incl_btw'], 'notes': e['notes'], 'created_at': e['created_at'],
+            'updated_at': e['updated_at'],
+            'customers': {'name': customer.get('name'), 'address': customer.get('address')},
+        })
+    today_jobs.sort(key=lambda j: j['created_at'])
+
+    def month_revenue(start):
+        rows = fake.table('revenue_rollups').indexes['grain'].get('month', {}).values()
+        return sum(r['total_incl_btw'] for r in rows if r['period'] == start)
+
+    inventory = fake.table('inventory').rows.values()
+    return {
+        'today_jobs': today_jobs,
+        'open_quotes_count': len(fake.table('estimates').indexes['status'].get('offerte', {})),
+        'month_revenue': month_revenue(p_month_start),
+        'last_month_revenue': month_revenue(p_last_month_start),
+        'inventory_warnings': sorted((dict(i) for i in inventory if i['quantity_on_hand'] <= i['threshold_warning']),
+                                     key=lambda i: i['item_name']),
+        'customer_count': len(customers.rows),
+    }
+
+
+@rpc
+def estimate_json(fake, p_estimate_id):
+    e = fake.table('estimates').get(p_estimate_id)
+    if e is None:
+        return None
+
+    def children(table):
+        rows = fake.table(table).indexes['estimate_id'].get(p_estimate_id, {}).values()
+        return sorted((dict(r) for r in rows), key=lambda r: r['created_at'])
+
+    result = dict(e)
+    result['customers'] = dict(fake.table('customers').get(e['customer_id']) or {}) or None
+    result['lines'] = children('estimate_lines')
+    result['upsells'] = children('estimate_upsells')
+    result['photos'] = [{k: p[k] for k in ('id', 'photo_type', 'caption', 'created_at')}
+                        for p in children('project_photos')]
+    return result
+
+
+@rpc
+def create_estimate_with_children(fake, p_estimate, p_lines, p_upsells):
+    if fake.table('customers').get(p_estimate.get('customer_id')) is None:
+        raise FakeError(409, '23503', 'insert or update on table "estimates" violates foreign key constraint')
+    estimate = fake.table('estimates').insert({
+        'customer_id': p_estimate.get('customer_id'),
+        'user_id': p_estimate.get('user_id'),
+        'status': p_estimate.get('status') or 'concept',
+        'subtotal': p_estimate.get('subtotal'),
+        'btw_percentage': p_estimate.get('btw_percentage'),
+        'total_incl_btw': p_estimate.get('total_incl_btw'),
+        'notes': p_estimate.get('notes') or '',
+    })
+    lines = fake.table('estimate_lines')
+    for line in p_lines or []:
+        lines.insert({
+            'estimate_id': estimate['id'], 'service_id': line.get('service_id'),
+            'description': line.get('description'), 'square_meters': line.get('square_meters'),
+            'pollution_level': line.get('pollution_level') or 'standaard', 'unit_price': line.get('unit_price'),
+            'multiplier': line.get('multiplier') or 1.0, 'line_total': line.get('line_total'),
+        })
+    upsells = fake.table('estimate_upsells')
+    for upsell in p_upsells or []:
+        upsells.insert({
+            'estimate_id': estimate['id'], 'upsell_item_id': upsell.get('upsell_item_id'),
+            'description': upsell.get('description'), 'price': upsell.get('price'),
+        })
+    return estimate_json(fake, estimate['id'])
+
+
+@rpc
+def apply_inventory_changes(fake, p_changes, p_estimate_id=None):
+    inventory = fake.table('inventory')
+    log = fake.table('inventory_log')
+    totals = {}
+    for change in p_changes:
+        totals[change['inventory_id']] = totals.get(change['inventory_id'], 0) + float(change['change_amount'])
+    updated = []
+    for inventory_id, delta in totals.items():
+        item = inventory.get(inventory_id)
+        if item is None:
+            continue
+        inventory.update(item, {'quantity_on_hand': max(0, item['quantity_on_hand'] + delta), 'updated_at': now_iso()})
+        updated.append(item)
+    for change in p_changes:
+        if inventory.get(change['inventory_id']) is not None:
+            log.insert({'inventory_id': change['inventory_id'], 'estimate_id': p_estimate_id,
+                        'change_amount': change['change_amount'], 'reason': change.get('reason')})
+    return sorted((dict(i) for i in updated), key=lambda i: i['item_name'])
+
+
+@rpc
+def complete_estimate(fake, p_estimate_id, p_changes):
+    estimates = fake.table('estimates')
+    e = estimates.get(p_estimate_id)
+    if e is None:
+        return None
+    if e['status'] in DONE_STATUSES:
+        return {'completed': False, 'status': e['status'], 'inventory': []}
+    estimates.update(e, {'status': 'voltooid', 'updated_at': now_iso(), 'completed_at': now_iso()})
+    refresh_estimate_revenue(fake, p_estimate_id)
+    return {'completed': True, 'status': 'voltooid',
+            'inventory': apply_inventory_changes(fake, p_changes or [], p_estimate_id)}
+
+
+# ─── Revenue rollups ────────────────────────────────────────────
+# The database keeps these up to date with triggers; the fake has none, so
+# the RPCs that change an estimate's status call refresh_estimate_revenue.
+AMSTERDAM = zoneinfo.ZoneInfo('Europe/Amsterdam')
+CENT = Decimal('0.01')
+
+
+def _apply_revenue_entries(fake, entries, sign):
+    rollups = fake.table('revenue_rollups')
+    for entry in entries:
+        day = datetime.date.fromisoformat(entry['day'])
+        for grain, period in (('day', day), ('month', day.replace(day=1))):
+            key = f"{grain}|{period}|{entry['user_id']}|{entry['service_id']}|{entry['btw_percentage']}"
+            row = rollups.get(key)
+            if row is None:
+                row = rollups.insert({'key': key, 'grain': grain, 'period': period.isoformat(),
+                                      'user_id': entry['user_id'], 'service_id': entry['service_id'],
+                                      'btw_percentage': entry['btw_percentage'], 'jobs': 0, 'lines': 0,
+                                      'subtotal': 0.0, 'btw': 0.0, 'total_incl_btw': 0.0})
+            for column in ('jobs', 'lines', 'subtotal', 'btw', 'total_incl_btw'):
+                row[column] += sign * entry[column]
+
+
+def refresh_estimate_revenue(fake, estimate_id):
+    entries = fake.table('revenue_entries')
+    removed = list(entries.indexes['estimate_id'].get(estimate_id, {}).values())
+    for entry in removed:
+        entries._unindex(entry)
+        del entries.rows[entry['id']]
+    _apply_revenue_entries(fake, removed, -1)
+
+    e = fake.table('estimates').get(estimate_id)
+    if e is None or not e.get('completed_at'):
+        return
+    day = datetime.datetime.fromisoformat(e['completed_at']).astimezone(AMSTERDAM).date().isoformat()
+    subtotal = Decimal(str(e['subtotal']))
+    btw_total = Decimal(str(e['total_incl_btw'])) - subtotal
+    pieces = {None: [1, 0, subtotal]}
+    for line in fake.table('estimate_lines').indexes['estimate_id'].get(estimate_id, {}).values():
+        amount = Decimal(str(line['line_total']))
+        pieces[None][2] -= amount
+        piece = pieces.setdefault(line['service_id'], [0, 0, Decimal(0)])
+        piece[1] += 1
+        piece[2] += amount
+
+    running = Decimal(0)
+    added = []
+    for service_id in sorted(pieces, key=lambda k: (k is None, k or '')):
+        jobs, lines, amount = pieces[service_id]
+        if subtotal == 0:
+            btw = btw_total if service_id is None else Decimal(0)
+        else:
+            before = (running * btw_total / subtotal).quantize(CENT, ROUND_HALF_UP)
+            running += amount
+            btw = (running * btw_total / subtotal).quantize(CENT, ROUND_HALF_UP) - before
+        added.append(entries.insert({
+            'estimate_id': estimate_id, 'day': day, 'user_id': e['user_id'], 'service_id': service_id,
+            'btw_percentage': float(e['btw_percentage']), 'jobs': jobs, 'lines': lines,
+            'subtotal': float(amount), 'btw': float(btw), 'total_incl_btw': float(amount + btw),
+        }))
+    _apply_revenue_entries(fake, added, 1)
+
+
+def backfill_revenue(fake):
+    for e in list(fake.table('estimates').rows.values()):
+        if e.get('completed_at'):
+            refresh_estimate_revenue(fake, e['id'])
+
+
+@rpc
+def revenue_report(fake, p_from, p_to, p_period='month', p_group=()):
+    date_from = datetime.date.fromisoformat(p_from)
+    date_to = datetime.date.fromisoformat(p_to)
+    month_from = month_to = None
+    if p_period not in ('day', 'week'):
+        first = date_from.replace(day=1)
+        month_from = first if first == date_from else (first + datetime.timedelta(days=32)).replace(day=1)
+        month_to = date_to.replace(day=1)
+
+    def in_months(day):
+        return month_from is not None and month_from <= day < month_to
+
+    def truncate(day):
+        if p_period == 'total':
+            return date_from
+        if p_period == 'week':
+            return day - datetime.timedelta(days=day.weekday())
+        if p_period == 'month':
+            return day.replace(day=1)
+        if p_period == 'quarter':
+            return day.replace(month=(day.month - 1) // 3 * 3 + 1, day=1)
+        if p_period == 'year':
+            return day.replace(month=1, day=1)
+        return day
+
+    grouped = {}
+    index = fake.table('revenue_rollups').indexes['grain']
+    for grain in ('day', 'month'):
+        for r in index.get(grain, {}).values():
+            day = datetime.date.fromisoformat(r['period'])
+            if grain == 'month' and not in_months(day):
+                continue
+            if grain == 'day' and (not date_from <= day < date_to or in_months(day)):
+                continue
+            key = (truncate(day).isoformat(),
+                   r['user_id'] if 'user' in p_group else None,
+                   r['service_id'] if 'service' in p_group else None,
+                   r['btw_percentage'] if 'btw' in p_group else None)
+            sums = grouped.setdefault(key, [0, 0, 0.0, 0.0, 0.0])
+            for i, column in enumerate(('jobs', 'lines', 'subtotal', 'btw', 'total_incl_btw')):
+                sums[i] += r[column]
+
+    users = fake.table('users')
+    services = fake.table('services')
+    rows = []
+    for (period, user_id, service_id, btw_percentage), sums in grouped.items():
+        if not sums[0] and not sums[1]:
+            continue
+        rows.append({
+            'period': period, 'user_id': user_id, 'service_id': service_id, 'btw_percentage': btw_percentage,
+            'jobs': sums[0], 'lines': sums[1], 'subtotal': sums[2], 'btw': sums[3], 'total_incl_btw': sums[4],
+            'user_name': (users.get(user_id) or {}).get('name'),
+            'service_name': (services.get(service_id) or {}).get('name'),
+        })
+    rows.sort(key=lambda r: (r['period'], r['user_name'] or '', r['service_name'] or '', r['btw_percentage'] or 0))
+    return rows
+
+
+# ─── Delta sync ─────────────────────────────────────────────────
+SYNC_OMIT = {'customers': ('search_text', 'search_phone', 'search_vector'), 'estimates': ('signature_data',),
+             'project_photos': ('photo_data',)}
+
+
+@rpc
+def sync_changes(fake, p_since, p_table=None, p_after_txid=None, p_after_id=None, p_limit=1000):
+    since = int(p_since) if p_since is not None else None
+    tables = SYNC_TABLES + ('sync_tombstones',)
+    start = tables.index(p_table) if p_table in tables else 0
+    left = max(p_limit, 1)
+    changes, deleted, step = {}, {}, None
+    after = (int(p_after_txid), p_after_id) if p_after_txid is not None else None
+
+    for i, name in enumerate(tables[start:]):
+        if name == 'sync_tombstones' and since is None:
+            continue
+        rows = [r for r in fake.table(name).rows.values() if since is None or r['sync_txid'] >= since]
+        rows.sort(key=lambda r: (r['sync_txid'], r['id']))
+        if i == 0 and after is not None:
+            rows = [r for r in rows if (r['sync_txid'], r['id']) > after]
+        rows = rows[:left]
+        if name == 'sync_tombstones':
+            for r in rows:
+                ids = deleted.setdefault(r['table_name'], [])
+                if r['row_id'] not in ids:
+                    ids.append(r['row_id'])
+        elif rows:
+            omit = ('sync_txid',) + SYNC_OMIT.get(name, ())
+            changes[name] = [{k: v for k, v in r.items() if k not in omit} for r in rows]
+        left -= len(rows)
+        if left <= 0:
+            step = {'table': name, 'txid': str(rows[-1]['sync_txid']), 'id': rows[-1]['id']}
+            break
+
+    return {'changes': changes, 'deleted': deleted, 'next': step, 'xmin': str(snapshot_xmin())}
+
+
+# ─── Customer search ────────────────────────────────────────────
+def normalize_phone(phone):
+    digits = re.sub(r'[^0-9]', '', phone or '')
+    return re.sub(r'^(0031|31(?=[1-9][0-9]{8}$))', '0', digits)
+
+
+def normalize_search_text(text):
+    return re.sub(r'([0-9]{4})\s+([a-z]{2})\b', r'\1\2', (text or '').lower())
+
+
+@rpc
+def search_customers(fake, p_query, p_limit=20):
+    text = normalize_search_text(p_query)
+    tokens = [t for t in re.split(r'[^0-9a-z]+', text) if t]
+    if not tokens:
+        return []
+    digits = normalize_phone(p_query)
+    compact = re.sub(r'\s', '', p_query)
+    if len(digits) < 3 or len(digits) * 2 < len(compact):
+        digits = None
+
+    matches = []
+    for c in fake.table('customers').rows.values():
+        search_text = normalize_search_text(f"{c['name']} {c.get('address') or ''}")
+        words = [w for w in re.split(r'[^0-9a-z]+', search_text) if w]
+        rank = 0.0
+        if all(any(w.startswith(t) for w in words) for t in tokens):
+            rank = 0.5 + 0.1 * len(tokens)
+        elif text in search_text:
+            rank = 0.4
+        if digits and digits in normalize_phone(c.get('phone')):
+            rank = 1.0
+        if rank:
+            matches.append((rank, c))
+    matches.sort(key=lambda m: (-m[0], m[1]['name']))
+    return [dict(c, rank=rank) for rank, c in matches[:max(1, min(p_limit, 100))]]
+
+
+# ─── Customer import ────────────────────────────────────────────
+def normalize_address(address):
+    return re.sub(r'[\W_]+', ' ', normalize_search_text(address)).strip()
+
+
+@rpc
+def import_customers(fake, p_rows, p_update=False):
+    customers = fake.table('customers')
+    # Oldest customer first wins, like ORDER BY created_at LIMIT 1
+    by_key = {}
+    for c in sorted(customers.rows.values(), key=lambda c: c['created_at'], reverse=True):
+        for key in (('email', (c.get('email') or '').strip().lower()), ('phone', normalize_phone(c.get('phone'))),
+                    ('address', normalize_address(c.get('address')))):
+            if key[1]:
+                by_key[key] = c
+
+    out = []
+    for r in p_rows:
+        keys = (('email', (r.get('email') or '').strip().lower()), ('phone', normalize_phone(r.get('phone'))),
+                ('address', normalize_address(r.get('address'))))
+        match = next((by_key[k] for k in keys if k[1] and k in by_key), None)
+        if match is None:
+            match = customers.insert({
+                'name': r['name'], 'address': r.get('address'), 'phone': r.get('phone'), 'email': r.get('email'),
+                'parking_situation': r.get('parking_situation') or 'oprit',
+                'water_tap_location': r.get('water_tap_location'),
+                'water_pressure_lpm': r['water_pressure_lpm'] if r.get('water_pressure_lpm') is not None else 0,
+                'notes': r.get('notes'),
+            })
+            action = 'inserted'
+        elif p_update:
+            values = {col: r[col] for col in ('address', 'phone', 'email', 'parking_situation', 'water_tap_location',
+                                              'water_pressure_lpm', 'notes') if r.get(col) not in (None, '')}
+            customers.update(match, dict(values, name=r['name'], updated_at=now_iso()))
+            action = 'updated'
+        else:
+            action = 'skipped'
+        for key in keys:
+            if key[1]:
+                by_key.setdefault(key, match)
+        out.append({'row': r.get('row'), 'id': match['id'], 'action': action})
+    return out
@@ -0,0 +1,307 @@
+"""Benchmark the hot API endpoints against the fake PostgREST backend.
+
+    python -m bench.run                       # run, write bench/results/latest.json, compare
+    python -m bench.run --scale 1.0           # production-sized dataset (slow to seed)
+    python -m bench.run --latency-ms 20       # simulate the network round trip to Supabase
+    python -m bench.run --update-baseline     # accept the current numbers as bench/baseline.json
+
+Exits with status 1 when a scenario's median app time is slower than the
+baseline by more than --threshold, or when it makes more Supabase round
+trips or returns more errors than it used to.
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline.json')
+DEFAULT_OUTPUT = os.path.join(HERE, 'results', 'latest.json')
+
+# Latency differences below this are noise, whatever the percentage
+MIN_REGRESSION_MS = 5.0
+
+# Setup steps write to the fake's tables; keep them from interleaving
+_setup_lock = threading.Lock()
+
+
+def configure_environment(workdir):
+    # Must happen before the app is imported: modules read these at import
+    os.environ.update({
+        'SUPABASE_URL': 'http://fake-postgrest.local',
+        # create_client() only checks that the key looks like a JWT
+        'SUPABASE_KEY': 'eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.bench',
+        'SECRET_KEY': 'offline-benchmark-secret-key-not-for-production',
+        'PDF_CACHE_DIR': os.path.join(workdir, 'pdf_cache'),
+        'PHOTO_STORAGE_DIR': os.path.join(workdir, 'photos'),
+        'CACHE_BUS_PATH': os.path.join(workdir, 'cache-bus'),
+        # Jobs queued by the scenarios stay queued: a worker thread running
+        # them would skew the measurements of the scenarios after it
+        'JOBS_DB_PATH': os.path.join(workdir, 'jobs.sqlite3'),
+        'JOBS_INLINE_WORKER': 'false',
+        'SLOW_REQUEST_MS': '60000',
+    })
+
+
+class Scenario:
+    def __init__(self, name, request, setup=None):
+        self.name = name
+        # request(i) → (method, path, json body or None)
+        self.request = request
+        # setup(i) runs before each iteration, outside the measurement
+        self.setup = setup
+
+
+def build_scenarios(app_module, fake_postgrest, fake):
+    estimates = fake.table('estimates')
+    by_status = estimates.indexes['status']
+    invoices = list(by_status.get('factuur', {}))
+    signed = list(by_status.get('akkoord', {})) or list(estimates.rows)
+    any_estimates = list(estimates.rows)
+    customers = list(fake.table('customers').rows.values())
+
+    def reset_signed(i):
+        row = estimates.get(signed[i % len(signed)])
+        estimates.update(row, {'status': 'akkoord'})
+
+    def clear_dashboard(i):
+        app_module.dashboard_cache.clear()
+
+    services = list(fake.table('services').rows.values())
+    upsells = list(fake.table('upsell_items').rows.values())
+
+    def preview_batch(i):
+        # Ten drafts of one to three lines, like re-pricing a day's worth of quotes
+        quotes = [{
+            'lines': [{'service_id': services[(i + q + n) % len(services)]['id'], 'square_meters': 10 + (i * 7 + q * 3 + n) % 140,
+                       'pollution_level': 'zwaar' if (i + q + n) % 3 == 0 else 'standaard'} for n in range(1 + q % 3)],
+            'upsells': [{'upsell_item_id': upsells[(i + q) % len(upsells)]['id']}] if q % 2 else [],
+        } for q in range(10)]
+        return 'POST', '/api/estimates/preview', {'quotes': quotes}
+
+    # Position in the change stream now; nothing in the dataset changes
+    # before the sync scenarios run
+    unchanged = app_module.encode_sync_cursor(str(fake_postgrest.snapshot_xmin()))
+
+    def search_term(i):
+        c = customers[i * 7919 % len(customers)]
+        variants = (c['name'].split()[-1], c['address'].split(',')[1].strip()[:6], c['phone'][-6:])
+        return variants[i % len(variants)]
+
+    return [
+        Scenario('dashboard', lambda i: ('GET', '/api/dashboard', None)),
+        Scenario('dashboard_cold', lambda i: ('GET', '/api/dashboard', None), clear_dashboard),
+        Scenario('revenue_year', lambda i: ('GET', '/api/reports/revenue?from=2025-01-01&to=2025-12-31', None)),
+        Scenario('revenue_quarter_split',
+                 lambda i: ('GET', '/api/reports/revenue?from=2026-01-01&to=2026-03-31&period=total'
+                                   '&group_by=service,user,btw', None)),
+        Scenario('estimates_list', lambda i: ('GET', '/api/estimates', None)),
+        Scenario('estimates_list_status', lambda i: ('GET', '/api/estimates?status=offerte', None)),
+        Scenario('customers_search', lambda i: ('GET', f'/api/customers?search={search_term(i)}', None)),
+        Scenario('estimate_detail', lambda i: ('GET', f'/api/estimates/{any_estimates[i % len(any_estimates)]}', None)),
+        Scenario('estimate_preview_batch', preview_batch),
+        Scenario('sync_unchanged', lambda i: ('GET', f'/api/sync?since={unchanged}', None)),
+        Scenario('sync_full_first_page', lambda i: ('GET', '/api/sync', None)),
+        Scenario('customers_export_csv', lambda i: ('GET', '/api/customers/export', None)),
+        Scenario('estimate_pdf_cold', lambda i: ('GET', f'/api/estimates/{invoices[i % len(invoices)]}/pdf', None)),
+        Scenario('estimate_pdf_warm', lambda i: ('GET', f'/api/estimates/{invoices[0]}/pdf', None)),
+        Scenario('estimate_complete', lambda i: ('POST', f'/api/estimates/{signed[i % len(signed)]}/complete', None),
+                 reset_signed),
+    ]
+
+
+def run_scenario(app_module, fake_module, scenario, token, iterations, concurrency):
+    headers = {'Authorization': f'Bearer {token}'}
+    samples = []
+
+    def one(i):
+        client = app_module.app.test_client()
+        if scenario.setup:
+            with _setup_lock:
+                scenario.setup(i)
+        method, path, body = scenario.request(i)
+        tally = fake_module.Tally()
+        token_ = fake_module.current_tally.set(tally)
+        try:
+            started = time.perf_counter()
+            response = client.open(path, method=method, headers=headers, json=body)
+            response.get_data()
+            elapsed = time.perf_counter() - started
+        finally:
+            fake_module.current_tally.reset(token_)
+        return elapsed, tally.calls, tally.seconds, response.status_code, len(response.get_data())
+
+    # One untimed call so imports, pools and first-use caches are warm
+    one(iterations)
+    # Start every scenario with a clean heap, so GC pauses land evenly
+    gc.collect()
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            samples = list(pool.map(one, range(iterations)))
+    else:
+        samples = [one(i) for i in range(iterations)]
+    wall = time.perf_counter() - started
+
+    latencies = sorted(s[0] * 1000 for s in samples)
+    # Time spent in the app itself, without the fake backend's own work
+    app_times = sorted((s[0] - s[2]) * 1000 for s in samples)
+
+    def pct(p, values=latencies):
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+    errors = sum(1 for s in samples if s[3] >= 400)
+    return {
+        'n': len(samples),
+        'errors': errors,
+        'mean_ms': round(statistics.fmean(latencies), 3),
+        'p50_ms': round(pct(50), 3),
+        'p95_ms': round(pct(95), 3),
+        'p99_ms': round(pct(99), 3),
+        'max_ms': round(latencies[-1], 3),
+        'throughput_rps': round(len(samples) / wall, 2),
+        'round_trips': round(statistics.fmean(s[1] for s in samples), 2),
+        'backend_ms': round(statistics.fmean(s[2] for s in samples) * 1000, 3),
+        'app_p50_ms': round(pct(50, app_times), 3),
+        'app_p95_ms': round(pct(95, app_times), 3),
+        'response_bytes': round(statistics.fmean(s[4] for s in samples)),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Return a list of regression messages.
+
+    Latency is judged on the app's own median time: the fake backend answers
+    from Python dicts and its cost says nothing about production Postgres,
+    and tail latencies on a shared machine are too noisy to gate on.
+    """
+    regressions = []
+    for name, current in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        metric = 'app_p50_ms'
+        if metric in before:
+            limit = before[metric] * (1 + threshold)
+            if current[metric] > limit and current[metric] - before[metric] > MIN_REGRESSION_MS:
+                regressions.append(f'{name}: {metric} {current[metric]:.1f} > {before[metric]:.1f} (+{threshold:.0%})')
+        if current['round_trips'] > before['round_trips']:
+            regressions.append(f"{name}: round trips {current['round_trips']} > {before['round_trips']}")
+        if current['errors'] > before['errors']:
+            regressions.append(f"{name}: {current['errors']} errors (was {before['errors']})")
+    return regressions
+
+
+def print_table(results, baseline):
+    before = baseline.get('scenarios', {}) if baseline else {}
+    print(f"{'scenario':<24}{'p50 ms':>9}{'p95 ms':>9}{'app p50':>9}{'rps':>9}{'trips':>7}{'backend':>9}{'errors':>7}{'vs app':>9}")
+    for name, r in results['scenarios'].items():
+        delta = ''
+        if before.get(name, {}).get('app_p50_ms'):
+            delta = f"{(r['app_p50_ms'] / before[name]['app_p50_ms'] - 1):+.0%}"
+        print(f"{name:<24}{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}{r['app_p50_ms']:>9.2f}{r['throughput_rps']:>9.1f}"
+              f"{r['round_trips']:>7.1f}{r['backend_ms']:>9.2f}{r['errors']:>7}{delta:>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=float, default=0.02, help='fraction of 100k customers / 500k estimates')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--iterations', type=int, default=50, help='timed requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=1, help='parallel clients per scenario')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='simulated Supabase round-trip time')
+    parser.add_argument('--only', action='append', help='run only these scenarios (repeatable)')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown before failing')
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='pressureflow-bench-')
+    configure_environment(workdir)
+
+    sys.path.insert(0, os.path.dirname(HERE))
+    import jwt
+    import db
+    import app as app_module
+    from bench import dataset, fake_postgrest, rpc
+
+    seed_started = time.perf_counter()
+    tables = dataset.build(scale=args.scale, seed=args.seed)
+    fake = fake_postgrest.FakePostgREST(tables, rpcs=rpc.FUNCTIONS, latency=args.latency_ms / 1000)
+    rpc.backfill_revenue(fake)
+    seed_seconds = time.perf_counter() - seed_started
+    db.use_transport(fake)
+
+    admin = next(u for u in tables['users'] if u['role'] == 'admin')
+    token = jwt.encode({'user_id': admin['id'], 'role': 'admin',
+                        'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)},
+                       app_module.app.config['SECRET_KEY'], algorithm='HS256')
+
+    results = {
+        'meta': {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scale': args.scale,
+            'seed': args.seed,
+            'iterations': args.iterations,
+            'concurrency': args.concurrency,
+            'latency_ms': args.latency_ms,
+            'rows': {name: len(rows) for name, rows in tables.items()},
+            'seed_seconds': round(seed_seconds, 2),
+        },
+        'scenarios': {},
+    }
+    for scenario in build_scenarios(app_module, fake_postgrest, fake):
+        if args.only and scenario.name not in args.only:
+            continue
+        results['scenarios'][scenario.name] = run_scenario(
+            app_module, fake_postgrest, scenario, token, args.iterations, args.concurrency)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    comparable = baseline is not None and all(
+        baseline['meta'].get(key) == results['meta'][key] for key in ('scale', 'latency_ms', 'concurrency'))
+    print_table(results, baseline if comparable else None)
+    print(f'\nResults written to {args.output}')
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Baseline updated: {args.baseline}')
+        return 0
+    if baseline is None:
+        print('No baseline yet; run with --update-baseline to create one.')
+        return 0
+    if not comparable:
+        print('Baseline was recorded with another --scale/--latency-ms/--concurrency; not comparing.')
+        return 0
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print('\nRegressions:')
+        for message in regressions:
+            print(f'  {message}')
+        return 1
+    print('No regressions against the baseline.')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,379 @@
+"""Bulk customer import and customer/estimate export.
+
+An import file (CSV, or XLSX when openpyxl is installed) is spooled to disk
+by the request and read row by row in a background job. Rows are validated
+against the customers constraints and normalized, duplicates within the
+file are dropped, and the rest goes to the ``import_customers`` function in
+batches. That function matches existing customers on e-mail, phone or
+address, so running an import twice inserts nothing new. Progress and
+per-row errors are reported on the job.
+
+Exports page through the table by id and are streamed as CSV, so memory use
+does not grow with the table.
+"""
+import csv
+import importlib.util
+import io
+import os
+import re
+import tempfile
+import zipfile
+from decimal import Decimal, InvalidOperation
+
+import db
+
+# openpyxl is optional and slow to import; it is loaded on the first XLSX import or export
+XLSX_SUPPORTED = importlib.util.find_spec('openpyxl') is not None
+
+IMPORT_DIR = os.environ.get(
+    'IMPORT_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'imports')
+)
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 500))
+IMPORT_MAX_BATCH_SIZE = 2000
+MAX_IMPORT_BYTES = int(os.environ.get('MAX_IMPORT_MB', 50)) * 1024 * 1024
+MAX_REPORTED_ERRORS = 500
+EXPORT_PAGE_SIZE = 1000
+CHUNK_SIZE = 64 * 1024
+
+COLUMNS = ('name', 'address', 'phone', 'email', 'parking_situation', 'water_tap_location',
+           'water_pressure_lpm', 'notes')
+PARKING_SITUATIONS = ('oprit', 'straat', 'vergunning')
+MAX_LENGTHS = {'name': 200, 'address': 300, 'phone': 50, 'email': 254, 'water_tap_location': 200, 'notes': 5000}
+
+# Header names as they come out of spreadsheets, lowercased and without
+# spaces, dashes or underscores
+HEADER_ALIASES = {
+    'name': 'name', 'naam': 'name', 'klant': 'name', 'klantnaam': 'name', 'bedrijfsnaam': 'name',
+    'address': 'address', 'adres': 'address', 'straat': 'address',
+    'phone': 'phone', 'telefoon': 'phone', 'telefoonnummer': 'phone', 'tel': 'phone', 'mobiel': 'phone',
+    'email': 'email', 'emailadres': 'email', 'mail': 'email',
+    'parkingsituation': 'parking_situation', 'parkeren': 'parking_situation', 'parkeersituatie': 'parking_situation',
+    'watertaplocation': 'water_tap_location', 'waterkraan': 'water_tap_location', 'kraan': 'water_tap_location',
+    'waterpressurelpm': 'water_pressure_lpm', 'waterdruk': 'water_pressure_lpm', 'waterdruklpm': 'water_pressure_lpm',
+    'notes': 'notes', 'notities': 'notes', 'opmerkingen': 'notes',
+}
+
+EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+
+class BulkError(ValueError):
+    """The file as a whole cannot be imported or exported; the message is shown to the user."""
+
+
+class RowError(ValueError):
+    pass
+
+
+# ─── Upload ─────────────────────────────────────────────────────
+def spool_upload(stream, filename=''):
+    """Copy an upload to IMPORT_DIR in chunks; returns (path, 'csv' | 'xlsx')."""
+    os.makedirs(IMPORT_DIR, exist_ok=True)
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=IMPORT_DIR, delete=False) as f:
+        try:
+            head = b''
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if not head:
+                    head = chunk[:4]
+                size += len(chunk)
+                if size > MAX_IMPORT_BYTES:
+                    raise BulkError('Bestand is te groot')
+                f.write(chunk)
+            if size == 0:
+                raise BulkError('Leeg bestand')
+        except Exception:
+            f.close()
+            os.remove(f.name)
+            raise
+
+    # An .xlsx file is a ZIP archive
+    fmt = 'xlsx' if head.startswith(b'PK\x03\x04') or filename.lower().endswith('.xlsx') else 'csv'
+    if fmt == 'xlsx' and not XLSX_SUPPORTED:
+        os.remove(f.name)
+        raise BulkError('XLSX wordt niet ondersteund op deze server, upload een CSV bestand')
+    return f.name, fmt
+
+
+def discard(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# ─── Reading ────────────────────────────────────────────────────
+# Spreadsheets run a cell starting with one of these as a formula; exports
+# prefix such text with ' and imports take that prefix off again
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+_FORMULA_STARTS = frozenset(FORMULA_PREFIXES)
+
+
+def _escape_row(values):
+    # One pass per row, this runs for every cell of an export
+    return ["'" + v if v.__class__ is str and v[:1] in _FORMULA_STARTS else v for v in values]
+
+
+def _unescape(value):
+    if value.startswith("'") and value[1:].startswith(FORMULA_PREFIXES):
+        return value[1:]
+    return value
+
+
+def _csv_rows(path):
+    with open(path, 'rb') as f:
+        sample = f.read(CHUNK_SIZE)
+    try:
+        sample.decode('utf-8')
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError as e:
+        # A multi-byte character cut off at the end of the sample is fine
+        encoding = 'utf-8-sig' if e.start >= len(sample) - 3 else 'cp1252'
+
+    with open(path, encoding=encoding, newline='') as f:
+        first = f.readline()
+        # Dutch Excel writes ';' separated files
+        delimiter = max((';', ',', '\t'), key=first.count)
+        f.seek(0)
+        yield from csv.reader(f, delimiter=delimiter)
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _xlsx_rows(path):
+    import openpyxl
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        for row in wb.active.iter_rows(values_only=True):
+            yield [_cell(value) for value in row]
+    finally:
+        wb.close()
+
+
+def _header_key(name):
+    return re.sub(r'[\s_\-.]+', '', name.strip().lower())
+
+
+def read_rows(path, fmt):
+    """Yield (line number, {column: text}) for every non-empty data row."""
+    rows = _xlsx_rows(path) if fmt == 'xlsx' else _csv_rows(path)
+    try:
+        header = next(rows)
+    except StopIteration:
+        raise BulkError('Leeg bestand')
+    except (csv.Error, OSError, KeyError, ValueError, zipfile.BadZipFile):
+        raise BulkError('Bestand kan niet gelezen worden')
+
+    mapping = [HEADER_ALIASES.get(_header_key(h)) for h in header]
+    if 'name' not in mapping:
+        raise BulkError('Kolom "naam" (of "name") ontbreekt in de eerste regel')
+
+    line_no = 1
+    try:
+        for line_no, values in enumerate(rows, start=2):
+            if not any(v.strip() for v in values):
+                continue
+            yield line_no, {col: _unescape(value) for col, value in zip(mapping, values) if col}
+    except csv.Error as e:
+        raise BulkError(f'Bestand kan niet gelezen worden na regel {line_no}: {e}')
+    except UnicodeDecodeError:
+        # The encoding is guessed from the start of the file. Decoding runs
+        # ahead of the csv reader, so line_no is not where it went wrong.
+        raise BulkError('Bestand kan niet gelezen worden: gebruik één tekenset (UTF-8) voor het hele bestand')
+
+
+# ─── Validation ─────────────────────────────────────────────────
+def normalize_phone(phone):
+    # Same as normalize_phone() in supabase_setup.sql
+    digits = re.sub(r'[^0-9]', '', phone or '')
+    return re.sub(r'^(0031|31(?=[1-9][0-9]{8}$))', '0', digits)
+
+
+def normalize_address(address):
+    # Same as normalize_address() in supabase_setup.sql
+    text = re.sub(r'([0-9]{4})\s+([a-z]{2})\b', r'\1\2', (address or '').lower())
+    return re.sub(r'[\W_]+', ' ', text).strip()
+
+
+def normalize_row(raw):
+    """Customer columns for one file row; raises RowError with a Dutch message."""
+    row = {}
+    for col in COLUMNS:
+        value = re.sub(r'\s+', ' ', raw.get(col) or '').strip() if col != 'notes' else (raw.get(col) or '').strip()
+        if col in MAX_LENGTHS and len(value) > MAX_LENGTHS[col]:
+            raise RowError(f'{col} is langer dan {MAX_LENGTHS[col]} tekens')
+        row[col] = value
+
+    if not row['name']:
+        raise RowError('Naam ontbreekt')
+
+    row['email'] = row['email'].lower()
+    if row['email'] and not EMAIL_RE.match(row['email']):
+        raise RowError(f"Ongeldig e-mailadres: {row['email']}")
+
+    if row['phone']:
+        digits = normalize_phone(row['phone'])
+        if len(digits) == 9 and digits[0] in '1234567':
+            # A spreadsheet that stored the number as a number dropped the 0
+            row['phone'] = '0' + digits
+            digits = row['phone']
+        if not 6 <= len(digits) <= 15:
+            raise RowError(f"Ongeldig telefoonnummer: {row['phone']}")
+
+    # Empty parking and water pressure get their defaults when the customer
+    # is created, and leave an existing customer's value alone
+    row['parking_situation'] = row['parking_situation'].lower()
+    if row['parking_situation'] and row['parking_situation'] not in PARKING_SITUATIONS:
+        raise RowError(f"parking_situation moet {', '.join(PARKING_SITUATIONS)} zijn")
+
+    if row['water_pressure_lpm']:
+        try:
+            pressure = Decimal(row['water_pressure_lpm'].replace(',', '.'))
+        except InvalidOperation:
+            raise RowError(f"Waterdruk is geen getal: {row['water_pressure_lpm']}")
+        if not pressure.is_finite() or pressure < 0:
+            raise RowError('Waterdruk moet een positief getal zijn')
+        row['water_pressure_lpm'] = float(pressure)
+    else:
+        row['water_pressure_lpm'] = None
+    return row
+
+
+def dedupe_keys(row):
+    keys = []
+    if row['email']:
+        keys.append(('email', row['email']))
+    phone = normalize_phone(row['phone'])
+    if phone:
+        keys.append(('phone', phone))
+    address = normalize_address(row['address'])
+    if address:
+        keys.append(('address', address))
+    return keys
+
+
+# ─── Import ─────────────────────────────────────────────────────
+def import_customers(path, fmt, batch_size=IMPORT_BATCH_SIZE, update=False, report=None):
+    """Import a spooled file; ``report(progress)`` is called after every batch.
+
+    Returns the counts and the first MAX_REPORTED_ERRORS row errors.
+    """
+    progress = {'rows': 0, 'inserted': 0, 'updated': 0, 'skipped': 0, 'duplicates': 0, 'invalid': 0}
+    errors = []
+    seen = {}
+    batch = []
+
+    def error(line_no, message):
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({'row': line_no, 'error': message})
+
+    def flush():
+        if not batch:
+            return
+        for outcome in db.rpc('import_customers', {'p_rows': batch, 'p_update': update}):
+            progress[outcome['action']] += 1
+        batch.clear()
+        if report:
+            report(dict(progress))
+
+    for line_no, raw in read_rows(path, fmt):
+        progress['rows'] += 1
+        try:
+            row = normalize_row(raw)
+        except RowError as e:
+            progress['invalid'] += 1
+            error(line_no, str(e))
+            continue
+
+        keys = dedupe_keys(row)
+        first = next((seen[k] for k in keys if k in seen), None)
+        if first is not None:
+            progress['duplicates'] += 1
+            error(line_no, f'Dubbel met regel {first}, overgeslagen')
+            continue
+        for k in keys:
+            seen[k] = line_no
+
+        batch.append({'row': line_no, **row})
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    return dict(progress, errors=errors, more_errors=max(progress['invalid'] + progress['duplicates'] - len(errors), 0))
+
+
+# ─── Export ─────────────────────────────────────────────────────
+EXPORTS = {
+    'customers': {
+        'select': 'id, ' + ', '.join(COLUMNS) + ', created_at, updated_at',
+        'columns': ('id',) + COLUMNS + ('created_at', 'updated_at'),
+    },
+    'estimates': {
+        'select': 'id, customer_id, customers(name), status, subtotal, btw_percentage, total_incl_btw, '
+                  'notes, created_at, updated_at, completed_at',
+        'columns': ('id', 'customer_id', 'customer_name', 'status', 'subtotal', 'btw_percentage',
+                    'total_incl_btw', 'notes', 'created_at', 'updated_at', 'completed_at'),
+    },
+}
+
+
+def iter_export_rows(table):
+    """All rows of an export as lists, one page of EXPORT_PAGE_SIZE at a time."""
+    spec = EXPORTS[table]
+    sb = db.get_client()
+    last_id = None
+    while True:
+        query = sb.table(table).select(spec['select']).order('id').limit(EXPORT_PAGE_SIZE)
+        if last_id:
+            query = query.gt('id', last_id)
+        rows = query.execute().data
+        for row in rows:
+            if 'customers' in row:
+                row['customer_name'] = (row.pop('customers') or {}).get('name')
+            yield [row.get(col) for col in spec['columns']]
+        if len(rows) < EXPORT_PAGE_SIZE:
+            break
+        last_id = rows[-1]['id']
+
+
+def export_csv(table):
+    """Yield a CSV export in chunks of about a page."""
+    spec = EXPORTS[table]
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    # The BOM makes Excel read the file as UTF-8
+    buf.write('\ufeff')
+    writer.writerow(spec['columns'])
+    for i, values in enumerate(iter_export_rows(table), start=1):
+        writer.writerow(['' if v is None else v for v in _escape_row(values)])
+        if i % EXPORT_PAGE_SIZE == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def export_xlsx(table):
+    """Write an XLSX export to a temporary file and return its path (caller removes it)."""
+    if not XLSX_SUPPORTED:
+        raise BulkError('XLSX wordt niet ondersteund op deze server')
+    import openpyxl
+    spec = EXPORTS[table]
+    # write_only streams rows to disk instead of building the sheet in memory
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(table)
+    ws.append(list(spec['columns']))
+    for values in iter_export_rows(table):
+        ws.append(_escape_row(values))
+    os.makedirs(IMPORT_DIR, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=IMPORT_DIR, suffix='.xlsx', delete=False) as f:
+        wb.save(f)
+    return f.name
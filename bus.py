@@ -0,0 +1,234 @@
+"""Cache invalidation bus.
+
+Every cache tag (a table name such as ``estimates`` or ``settings``) has a
+version counter. Write handlers ``publish()`` the tags they changed, which
+bumps those counters for every process that reads them; caches remember the
+versions an entry was built from and drop it once one has moved on (see
+cache.py).
+
+CACHE_BUS picks how far a bump reaches:
+
+``local``
+    This process only. For tests and single-process runs.
+``file`` (default)
+    Every process on this host: the counters live in a small memory-mapped
+    file (CACHE_BUS_PATH) that all gunicorn workers, the job worker and the
+    CLI map. Reading a version is a memory read, no system call.
+``postgres``
+    Every process on every instance. Counters live in the ``cache_versions``
+    table; ``bump_cache_versions()`` raises them and sends a NOTIFY that each
+    process receives on its own LISTEN connection (DATABASE_URL, needs
+    psycopg). While that connection is down versions are unknown and every
+    cache read misses, so a lost notification can never leave a cache stale.
+"""
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import traceback
+import zlib
+
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
+
+CACHE_BUS = os.environ.get('CACHE_BUS', 'file').lower()
+CACHE_BUS_PATH = os.environ.get(
+    'CACHE_BUS_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'cache-bus')
+)
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+CHANNEL = 'cache_invalidation'
+LISTEN_RETRY_SECONDS = float(os.environ.get('CACHE_BUS_RETRY_SECONDS', 5))
+
+
+class LocalBus:
+    """Counters in a dict: nothing outside this process sees a bump."""
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def version(self, tag):
+        return self._versions.get(tag, 0)
+
+    def publish(self, *tags):
+        with self._lock:
+            for tag in tags:
+                self._versions[tag] = self._versions.get(tag, 0) + 1
+
+
+class FileBus:
+    """Counters in a shared memory-mapped file, for all processes on a host.
+
+    Tags hash into SLOTS fixed 8-byte counters. Two tags sharing a slot only
+    means a bump of one also drops caches of the other. Bumps are serialized
+    with a lock on the file; reads are plain aligned 8-byte loads.
+    """
+
+    SLOTS = 512
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+        self._mm = None
+        self._lock = threading.Lock()
+
+    def _map(self):
+        if self._mm is None:
+            with self._lock:
+                if self._mm is None:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                    size = self.SLOTS * 8
+                    if os.fstat(fd).st_size < size:
+                        # Growing only appends zeros; counters already there stay
+                        os.ftruncate(fd, size)
+                    self._fd = fd
+                    self._mm = mmap.mmap(fd, size)
+        return self._mm
+
+    def _offset(self, tag):
+        return zlib.crc32(tag.encode('utf-8')) % self.SLOTS * 8
+
+    def version(self, tag):
+        return struct.unpack_from('<Q', self._map(), self._offset(tag))[0]
+
+    def publish(self, *tags):
+        mm = self._map()
+        offsets = {self._offset(tag) for tag in tags}
+        # lockf() excludes other processes, the thread lock other threads of
+        # this one (POSIX record locks are held per process)
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                for offset in offsets:
+                    struct.pack_into('<Q', mm, offset, struct.unpack_from('<Q', mm, offset)[0] + 1)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def after_fork(self):
+        # The mapping and the descriptor are inherited and stay shared; a
+        # lock held by another thread at fork time is not
+        self._lock = threading.Lock()
+
+
+class PostgresBus:
+    """Counters in Postgres, pushed to every process with LISTEN/NOTIFY."""
+
+    def __init__(self, dsn):
+        if psycopg is None:
+            raise RuntimeError('CACHE_BUS=postgres needs psycopg (pip install "psycopg[binary]")')
+        if not dsn:
+            raise RuntimeError('CACHE_BUS=postgres needs DATABASE_URL')
+        self.dsn = dsn
+        self._versions = None  # None while not listening: versions unknown
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def _ensure_listener(self):
+        if self._listener is not None and self._listener.is_alive():
+            return
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name='cache-bus-listener', daemon=True)
+                self._listener.start()
+
+    def _apply(self, versions):
+        with self._lock:
+            if self._versions is None:
+                return
+            for tag, v in versions.items():
+                if v > self._versions.get(tag, 0):
+                    self._versions[tag] = v
+
+    def _listen(self):
+        while True:
+            try:
+                with psycopg.connect(self.dsn, autocommit=True, keepalives=1, keepalives_idle=30,
+                                     keepalives_interval=10, keepalives_count=3) as conn:
+                    # LISTEN before reading the table: a bump between the two
+                    # is then both in the snapshot and in a notification
+                    conn.execute(f'LISTEN {CHANNEL}')
+                    rows = conn.execute('SELECT tag, version FROM cache_versions').fetchall()
+                    with self._lock:
+                        self._versions = dict(rows)
+                    for notify in conn.notifies():
+                        self._apply(json.loads(notify.payload))
+            except Exception:
+                traceback.print_exc()
+            with self._lock:
+                self._versions = None
+            time.sleep(LISTEN_RETRY_SECONDS)
+
+    def version(self, tag):
+        self._ensure_listener()
+        versions = self._versions
+        if versions is None:
+            # Not listening: a version nothing else compares equal to
+            return object()
+        return versions.get(tag, 0)
+
+    def publish(self, *tags):
+        import db
+        self._apply(db.rpc('bump_cache_versions', {'p_tags': list(tags)}) or {})
+
+    def after_fork(self):
+        # The listener thread and its connection stay with the parent
+        self._versions = None
+        self._lock = threading.Lock()
+        self._listener = None
+
+
+def create(kind=CACHE_BUS):
+    if kind == 'local':
+        return LocalBus()
+    if kind == 'file':
+        return FileBus(CACHE_BUS_PATH)
+    if kind == 'postgres':
+        return PostgresBus(DATABASE_URL)
+    raise ValueError(f'Unknown CACHE_BUS: {kind}')
+
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def get_bus():
+    global _bus
+    if _bus is None:
+        with _bus_lock:
+            if _bus is None:
+                _bus = create()
+    return _bus
+
+
+def use_bus(bus):
+    """Replace this process's bus, e.g. with a ``LocalBus()`` in tests."""
+    global _bus
+    _bus = bus
+
+
+def version(tag):
+    return get_bus().version(tag)
+
+
+def publish(*tags):
+    """Tell every process reading ``tags`` that those tables changed."""
+    if tags:
+        get_bus().publish(*tags)
+
+
+def _after_fork():
+    global _bus_lock
+    _bus_lock = threading.Lock()
+    after_fork = getattr(_bus, 'after_fork', None)
+    if after_fork is not None:
+        after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,68 @@
+"""In-process caches for the API handlers.
+
+Cached values are tagged with the tables they were built from. Write
+handlers call ``bump('estimates')`` etc., which publishes the tags on the
+invalidation bus (see bus.py): their versions move on in every worker and,
+with the Postgres bus, on every instance. An entry built from an older
+version of one of its tags is treated as missing on the next read.
+"""
+import threading
+import time
+
+import bus
+
+MISSING = object()
+
+
+def bump(*tags):
+    bus.publish(*tags)
+
+
+def version(tag):
+    return bus.version(tag)
+
+
+class TTLCache:
+    def __init__(self, ttl, tags=(), max_entries=256):
+        self.ttl = ttl
+        self.tags = tuple(tags)
+        self.max_entries = max_entries
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def stamp(self):
+        return tuple(version(tag) for tag in self.tags)
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return MISSING
+        value, expires_at, stamp = entry
+        if time.monotonic() >= expires_at or stamp != self.stamp():
+            with self._lock:
+                if self._data.get(key) is entry:
+                    del self._data[key]
+            return MISSING
+        return value
+
+    def set(self, key, value, stamp=None):
+        # Callers that read the versions *before* loading pass that stamp in,
+        # so a write that lands during the load invalidates the new entry.
+        if stamp is None:
+            stamp = self.stamp()
+        with self._lock:
+            if len(self._data) >= self.max_entries and key not in self._data:
+                self._data.pop(next(iter(self._data)))
+            self._data[key] = (value, time.monotonic() + self.ttl, stamp)
+
+    def get_or_set(self, key, loader):
+        value = self.get(key)
+        if value is MISSING:
+            stamp = self.stamp()
+            value = loader()
+            self.set(key, value, stamp)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
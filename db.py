@@ -0,0 +1,379 @@
+"""Process-wide Supabase client.
+
+Each worker process keeps one client whose PostgREST session is a pooled,
+keep-alive httpx client. Handlers borrow it through ``get_client()``; it is
+re-created after a fork and can be reset when the upstream connection breaks.
+The SDK itself is imported when the first client is built (or before the
+fork by ``startup.warm()``), not when this module is.
+
+Identical reads that run at the same time share one round trip: the first
+one goes upstream, the others wait for its response (see
+``_CoalescingTransport``). Nothing older than the read in flight is served
+unless SUPABASE_COALESCE_REUSE_MS is set.
+"""
+import contextlib
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+import metrics
+import startup
+
+SUPABASE_URL = os.environ.get('SUPABASE_URL', '')
+SUPABASE_KEY = os.environ.get('SUPABASE_KEY', '')
+
+POOL_SIZE = int(os.environ.get('SUPABASE_POOL_SIZE', 10))
+POOL_KEEPALIVE = int(os.environ.get('SUPABASE_POOL_KEEPALIVE', POOL_SIZE))
+KEEPALIVE_EXPIRY = float(os.environ.get('SUPABASE_KEEPALIVE_EXPIRY', 30))
+TIMEOUT = float(os.environ.get('SUPABASE_TIMEOUT', 15))
+CONNECT_TIMEOUT = float(os.environ.get('SUPABASE_CONNECT_TIMEOUT', 5))
+POOL_TIMEOUT = float(os.environ.get('SUPABASE_POOL_TIMEOUT', 10))
+CONNECT_RETRIES = int(os.environ.get('SUPABASE_CONNECT_RETRIES', 2))
+FAN_OUT_THREADS = int(os.environ.get('SUPABASE_FAN_OUT_THREADS', POOL_SIZE))
+COALESCE_READS = os.environ.get('SUPABASE_COALESCE', 'true').lower() == 'true'
+COALESCE_REUSE_SECONDS = float(os.environ.get('SUPABASE_COALESCE_REUSE_MS', 0)) / 1000
+
+# Idempotent requests are retried once when a pooled keep-alive connection
+# turns out to have been closed by the other side.
+_RETRY_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+_lock = threading.Lock()
+_client = None
+_pid = None
+_fan_out_pool = None
+
+
+class _ReconnectingTransport(httpx.HTTPTransport):
+    def handle_request(self, request):
+        try:
+            return super().handle_request(request)
+        except (httpx.RemoteProtocolError, httpx.ReadError):
+            if request.method not in _RETRY_METHODS:
+                raise
+            return super().handle_request(request)
+
+
+class _MeteredTransport(httpx.BaseTransport):
+    """Records every round trip for the metrics of the current request."""
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    def handle_request(self, request):
+        started = time.perf_counter()
+        status = None
+        try:
+            response = self.inner.handle_request(request)
+            status = response.status_code
+            return response
+        finally:
+            metrics.record_call(request.method, request.url.path, status, time.perf_counter() - started)
+
+    def close(self):
+        self.inner.close()
+
+
+# Postgres functions declared STABLE in supabase_setup.sql: they only read, so
+# identical calls may share a result like GETs do
+READ_ONLY_RPCS = frozenset({'dashboard_summary', 'estimate_json', 'revenue_report', 'search_customers',
+                            'sync_changes'})
+# Request headers that change what PostgREST answers (the role it runs as,
+# the representation, the page); the key ignores all others
+_KEY_HEADERS = ('authorization', 'apikey', 'accept', 'accept-profile', 'prefer', 'range', 'range-unit')
+# Finished responses kept for the reuse window are swept once this many keys
+# have piled up
+_MAX_REUSED = 256
+
+# Application role of the current request; reads of different roles never
+# share a round trip, even when the query text is the same
+_read_scope = contextvars.ContextVar('supabase_read_scope', default=None)
+
+
+@contextlib.contextmanager
+def read_scope(role):
+    """Run the block's Supabase reads in the coalescing scope of ``role``."""
+    token = _read_scope.set(role)
+    try:
+        yield
+    finally:
+        _read_scope.reset(token)
+
+
+class _Flight:
+    """One upstream read and everyone waiting for it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.status = None
+        self.headers = None
+        self.content = None
+        self.error = None
+        self.expires = 0.0
+
+    def response_for(self, request):
+        # Every caller gets its own Response over the same bytes and decodes
+        # its own JSON, so one handler trimming or mutating rows cannot touch
+        # what another one sees
+        if self.error is not None:
+            raise self.error
+        return httpx.Response(self.status, headers=self.headers, content=self.content, request=request)
+
+
+class _CoalescingTransport(httpx.BaseTransport):
+    """Lets concurrent identical reads share one upstream round trip.
+
+    A read is a GET/HEAD or a POST to one of READ_ONLY_RPCS. Its key is the
+    method, path, sorted query string (PostgREST's table, select and
+    filters), body, the response-shaping headers and the read scope. The
+    first caller with a key goes upstream; callers arriving while it is in
+    flight wait for and share its response. With COALESCE_REUSE_SECONDS set
+    a successful response is also handed to identical reads arriving just
+    after it.
+
+    Any other request may write, so it detaches every read in flight: reads
+    that start after a write always make their own round trip and see it.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    @staticmethod
+    def _key(request):
+        path = request.url.path
+        if request.method in ('GET', 'HEAD'):
+            body = b''
+        elif request.method == 'POST' and '/rpc/' in path and path.rsplit('/rpc/', 1)[1] in READ_ONLY_RPCS:
+            body = request.read()
+        else:
+            return None
+        params = tuple(sorted(request.url.params.multi_items()))
+        headers = tuple(request.headers.get(h) for h in _KEY_HEADERS)
+        return request.method, path, params, body, headers, _read_scope.get()
+
+    def handle_request(self, request):
+        key = self._key(request)
+        if key is None:
+            # Detached before the write so no read that started earlier is
+            # joined later, and after it so a read that started while it
+            # ran is not handed to the writer's next read
+            self._detach_all()
+            try:
+                return self.inner.handle_request(request)
+            finally:
+                self._detach_all()
+
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and flight.done.is_set() and flight.expires <= time.monotonic():
+                flight = None
+            leader = flight is None
+            if leader:
+                if len(self._flights) >= _MAX_REUSED:
+                    self._drop_expired()
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            metrics.SUPABASE_COALESCED.inc(request.method, metrics.resource_of(request.url.path))
+            return flight.response_for(request)
+
+        try:
+            response = self.inner.handle_request(request)
+            try:
+                flight.content = b''.join(response.stream)
+            finally:
+                response.close()
+            flight.status = response.status_code
+            flight.headers = response.headers
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if (flight.error is None and 200 <= flight.status <= 299 and COALESCE_REUSE_SECONDS > 0
+                        and self._flights.get(key) is flight):
+                    flight.expires = time.monotonic() + COALESCE_REUSE_SECONDS
+                elif self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+        return flight.response_for(request)
+
+    def _detach_all(self):
+        with self._lock:
+            self._flights.clear()
+
+    def _drop_expired(self):
+        now = time.monotonic()
+        for key in [k for k, f in self._flights.items() if f.done.is_set() and f.expires <= now]:
+            del self._flights[key]
+
+    def close(self):
+        self.inner.close()
+
+
+# Replaces the network transport, e.g. with the benchmark's fake PostgREST
+_transport_override = None
+
+
+def use_transport(transport):
+    """Send all PostgREST traffic of this process to ``transport`` (None: network)."""
+    global _transport_override
+    _transport_override = transport
+    reset_client()
+
+
+def _timeout():
+    return httpx.Timeout(TIMEOUT, connect=CONNECT_TIMEOUT, pool=POOL_TIMEOUT)
+
+
+def _limits():
+    return httpx.Limits(max_connections=POOL_SIZE,
+                        max_keepalive_connections=POOL_KEEPALIVE,
+                        keepalive_expiry=KEEPALIVE_EXPIRY)
+
+
+def _transport():
+    transport = _MeteredTransport(
+        _transport_override or _ReconnectingTransport(limits=_limits(), retries=CONNECT_RETRIES)
+    )
+    # Outside the metered transport: a shared read is one round trip
+    return _CoalescingTransport(transport) if COALESCE_READS else transport
+
+
+def load_sdk():
+    """Import the Supabase SDK (slow: postgrest, gotrue, storage, realtime)."""
+    with startup.timed('load:supabase'):
+        from postgrest.utils import SyncClient
+        from supabase import create_client
+        from supabase.lib.client_options import ClientOptions
+    return create_client, ClientOptions, SyncClient
+
+
+def _build_client():
+    create_client, ClientOptions, SyncClient = load_sdk()
+    options = ClientOptions(
+        postgrest_client_timeout=_timeout(),
+        storage_client_timeout=int(TIMEOUT),
+        auto_refresh_token=False,
+        persist_session=False,
+    )
+    client = create_client(SUPABASE_URL, SUPABASE_KEY, options)
+
+    # The SDK builds a plain httpx client with default limits; swap it for one
+    # with our pool settings and a transport that survives dropped keep-alives.
+    postgrest = client.postgrest
+    default_session = postgrest.session
+    postgrest.session = SyncClient(
+        base_url=default_session.base_url,
+        headers=default_session.headers,
+        timeout=_timeout(),
+        transport=_transport(),
+    )
+    default_session.close()
+    return client
+
+
+def get_client():
+    global _client, _pid
+    pid = os.getpid()
+    if _client is not None and _pid == pid:
+        return _client
+    with _lock:
+        if _client is None or _pid != pid:
+            _client = _build_client()
+            _pid = pid
+    return _client
+
+
+def reset_client():
+    """Drop the pooled client; the next ``get_client()`` builds a fresh one."""
+    global _client, _pid
+    with _lock:
+        client, _client, _pid = _client, None, None
+    if client is not None and client._postgrest is not None:
+        try:
+            client._postgrest.session.close()
+        except Exception:
+            pass
+
+
+def _after_fork():
+    # Sockets inherited from the parent must never be shared with it, so the
+    # child just forgets the client without closing the parent's connections.
+    # Threads do not survive a fork either, so the fan-out pool goes too.
+    global _client, _pid, _lock, _fan_out_pool
+    _client = None
+    _pid = None
+    _lock = threading.Lock()
+    _fan_out_pool = None
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def fan_out(*calls):
+    """Run independent queries concurrently and return their results in order.
+
+    Each call is a zero-argument callable, typically a query builder's
+    ``execute``. They share the pooled keep-alive client, so latency is the
+    slowest round trip instead of the sum. The first exception is re-raised.
+    """
+    global _fan_out_pool
+    if len(calls) < 2:
+        return [call() for call in calls]
+    if _fan_out_pool is None:
+        with _lock:
+            if _fan_out_pool is None:
+                _fan_out_pool = ThreadPoolExecutor(max_workers=FAN_OUT_THREADS,
+                                                   thread_name_prefix='supabase-fan-out')
+    # The caller's thread runs the first query itself instead of idling.
+    # Each call runs in a copy of the caller's context, so its round trips
+    # are counted for the request that made them.
+    futures = [_fan_out_pool.submit(contextvars.copy_context().run, call) for call in calls[1:]]
+    first = calls[0]()
+    return [first] + [future.result() for future in futures]
+
+
+def rpc(fn, params=None):
+    """Call a Postgres function and return its decoded JSON result.
+
+    The SDK's rpc() insists on list-shaped results, our functions often
+    return a single JSON object.
+    """
+    session = get_client().postgrest.session
+    r = session.post(f'/rpc/{fn}', json=params or {})
+    if not 200 <= r.status_code <= 299:
+        from postgrest.exceptions import APIError
+        try:
+            error = r.json()
+        except ValueError:
+            error = {'message': r.text, 'code': str(r.status_code)}
+        raise APIError(error)
+    return r.json() if r.content else None
+
+
+def healthcheck():
+    """Ping PostgREST through the pool; rebuild the client if the link is dead.
+
+    An error response (5xx, bad key, missing grant) fails the check without
+    a rebuild: the connection itself is fine.
+    """
+    from postgrest.exceptions import APIError
+    try:
+        get_client().table('settings').select('key').limit(1).execute()
+        return True
+    except APIError:
+        return False
+    except httpx.TransportError:
+        reset_client()
+        try:
+            get_client().table('settings').select('key').limit(1).execute()
+            return True
+        except (httpx.TransportError, APIError):
+            return False
@@ -0,0 +1,30 @@
+# Gunicorn settings for Render (and any other host); read from the environment.
+#
+# Handlers spend most of their time waiting on Supabase, so each worker runs
+# a pool of threads instead of serving one request at a time. CPU-heavy work
+# (PDF layout) is handed to a separate process pool, see pdf.py.
+#
+# The app is imported once in the master (preload_app) and the workers are
+# forked from it, so they start without importing anything and share those
+# pages with the master. Nothing in the app opens connections or starts
+# threads at import; those are created per process on first use.
+import gc
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+keepalive = 5
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+
+def when_ready(server):
+    # Runs in the master after the app is loaded and before the first fork
+    if preload_app:
+        import startup
+        startup.warm()
+        # Objects that exist now are never collected; keeping the collector
+        # off them stops it from copying the shared pages into every worker
+        gc.freeze()
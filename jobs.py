@@ -0,0 +1,345 @@
+"""Durable background jobs in a local SQLite queue.
+
+Request handlers ``enqueue()`` slow follow-up work and return; a worker
+(``flask --app app worker``, the ``worker:`` line of the Procfile) runs it.
+Unless JOBS_INLINE_WORKER is turned off, every web process also runs a
+worker thread, so a single web service (or ``python app.py``) works without
+a separate worker process.
+
+The queue is a single SQLite file (WAL mode), so web and worker processes
+must share its disk. A worker leases the job it runs; when it dies the lease
+runs out and another worker picks the job up again, so handlers must be
+safe to run twice. Failed attempts are retried with exponential backoff up
+to the task's ``max_attempts``; raising ``JobFailed`` fails a job at once.
+An idempotency key makes ``enqueue()`` return the existing job instead of
+adding a second one.
+"""
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+import metrics
+
+JOBS_DB_PATH = os.environ.get(
+    'JOBS_DB_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'jobs.sqlite3')
+)
+JOB_POLL_SECONDS = float(os.environ.get('JOB_POLL_SECONDS', 1.0))
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 300))
+JOB_RETRY_BASE_SECONDS = float(os.environ.get('JOB_RETRY_BASE_SECONDS', 5))
+JOB_RETRY_MAX_SECONDS = float(os.environ.get('JOB_RETRY_MAX_SECONDS', 900))
+JOB_RETENTION_DAYS = int(os.environ.get('JOB_RETENTION_DAYS', 7))
+JOBS_INLINE_WORKER = os.environ.get('JOBS_INLINE_WORKER', 'true').lower() == 'true'
+
+PUBLIC_COLUMNS = ('id', 'name', 'status', 'attempts', 'max_attempts', 'progress', 'result', 'error',
+                  'user_id', 'created_at', 'updated_at', 'run_at')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    run_at REAL NOT NULL,
+    locked_until REAL,
+    locked_by TEXT,
+    idempotency_key TEXT UNIQUE,
+    user_id TEXT,
+    progress TEXT,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs(status, run_at);
+"""
+
+
+class JobFailed(Exception):
+    """Raised by a handler for errors a retry cannot fix; the message is kept."""
+
+
+class Task:
+    def __init__(self, name, fn, max_attempts, on_failure):
+        self.name = name
+        self.fn = fn
+        self.max_attempts = max_attempts
+        self.on_failure = on_failure
+
+
+_tasks = {}
+
+
+def task(name, max_attempts=5, on_failure=None):
+    """Register ``fn(payload) -> result`` as the handler for jobs called ``name``.
+
+    ``on_failure(payload)`` runs once the job has failed for good, to clean
+    up what the attempts left behind.
+    """
+    def register(fn):
+        _tasks[name] = Task(name, fn, max_attempts, on_failure)
+        return fn
+    return register
+
+
+# ─── Storage ────────────────────────────────────────────────────
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+
+def _connect():
+    # One connection per thread and process; sqlite3 connections must not
+    # cross either
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.pid == os.getpid():
+        return conn
+    global _schema_ready
+    os.makedirs(os.path.dirname(JOBS_DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                conn.executescript(SCHEMA)
+                columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+                if 'progress' not in columns:
+                    # Queue files created before jobs reported progress
+                    conn.execute('ALTER TABLE jobs ADD COLUMN progress TEXT')
+                _schema_ready = True
+    _local.conn = conn
+    _local.pid = os.getpid()
+    return conn
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE … COMMIT: takes the write lock up front, so two
+    workers cannot both read a job as due and claim it."""
+
+    def __enter__(self):
+        self.conn = _connect()
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+def _as_dict(row):
+    job = {k: row[k] for k in PUBLIC_COLUMNS}
+    for k in ('progress', 'result'):
+        job[k] = json.loads(job[k]) if job[k] is not None else None
+    for k in ('created_at', 'updated_at', 'run_at'):
+        job[k] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(job[k]))
+    return job
+
+
+def get(job_id):
+    row = _connect().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    return _as_dict(row) if row else None
+
+
+def find(key):
+    """The job enqueued under idempotency key ``key``, if any."""
+    row = _connect().execute('SELECT * FROM jobs WHERE idempotency_key = ?', (key,)).fetchone()
+    return _as_dict(row) if row else None
+
+
+_wakeup = threading.Event()
+
+
+def enqueue(name, payload=None, key=None, user_id=None, delay=0):
+    """Queue a job; returns it as a dict.
+
+    With ``key`` set, a job enqueued earlier under the same key is returned
+    instead (a failed one is queued again).
+    """
+    if name not in _tasks:
+        raise KeyError(f'Unknown job: {name}')
+    now = time.time()
+    with _Transaction() as conn:
+        if key is not None:
+            row = conn.execute('SELECT * FROM jobs WHERE idempotency_key = ?', (key,)).fetchone()
+            if row is not None:
+                if row['status'] == 'failed':
+                    conn.execute("UPDATE jobs SET status = 'queued', attempts = 0, error = NULL, run_at = ?, "
+                                 "updated_at = ? WHERE id = ?", (now + delay, now, row['id']))
+                    row = conn.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone()
+                _wakeup.set()
+                return _as_dict(row)
+        job_id = uuid.uuid4().hex
+        conn.execute(
+            'INSERT INTO jobs (id, name, payload, max_attempts, run_at, idempotency_key, user_id, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (job_id, name, json.dumps(payload or {}), _tasks[name].max_attempts, now + delay, key, user_id, now, now)
+        )
+        row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    _wakeup.set()
+    return _as_dict(row)
+
+
+def _fail_abandoned():
+    """Fail jobs whose worker died (or hung) on their last attempt.
+
+    Whatever killed that worker would most likely kill the next one, so
+    they are not leased again.
+    """
+    now = time.time()
+    abandoned = ("SELECT id, name, payload FROM jobs WHERE status = 'running' AND locked_until < ? "
+                 "AND attempts >= max_attempts")
+    # Checked without the write lock first; there is rarely anything to do
+    if _connect().execute(abandoned + ' LIMIT 1', (now,)).fetchone() is None:
+        return
+    with _Transaction() as conn:
+        rows = conn.execute(abandoned, (now,)).fetchall()
+        for row in rows:
+            conn.execute("UPDATE jobs SET status = 'failed', error = 'Lease verlopen: worker gestopt tijdens de taak', "
+                         "locked_until = NULL, locked_by = NULL, updated_at = ? WHERE id = ?", (now, row['id']))
+    for row in rows:
+        t = _tasks.get(row['name'])
+        if t is not None and t.on_failure is not None:
+            try:
+                t.on_failure(json.loads(row['payload']))
+            except Exception:
+                traceback.print_exc()
+
+
+def _claim(worker_id):
+    now = time.time()
+    with _Transaction() as conn:
+        # Queued and due, or running on a worker whose lease ran out with
+        # attempts left (see _fail_abandoned for the others)
+        row = conn.execute(
+            "SELECT id FROM jobs WHERE (status = 'queued' AND run_at <= ?) "
+            "OR (status = 'running' AND locked_until < ? AND attempts < max_attempts) "
+            "ORDER BY run_at LIMIT 1", (now, now)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_until = ?, locked_by = ?, "
+                     "updated_at = ? WHERE id = ?", (now + JOB_LEASE_SECONDS, worker_id, now, row['id']))
+        return conn.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone()
+
+
+def backoff(attempts):
+    # 5s, 10s, 20s, … capped, with jitter so retries of a burst spread out
+    delay = min(JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1), JOB_RETRY_MAX_SECONDS)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _finish(job_id, worker_id, **fields):
+    fields['updated_at'] = time.time()
+    fields['locked_until'] = None
+    fields['locked_by'] = None
+    assignments = ', '.join(f'{k} = ?' for k in fields)
+    with _Transaction() as conn:
+        # A worker that overran its lease no longer owns the job
+        conn.execute(f'UPDATE jobs SET {assignments} WHERE id = ? AND locked_by = ?',
+                     (*fields.values(), job_id, worker_id))
+
+
+_running = threading.local()
+
+
+def report_progress(progress):
+    """Called by a handler: store ``progress`` (JSON) on the job it is running."""
+    job_id, worker_id = _running.job
+    with _Transaction() as conn:
+        conn.execute('UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ? AND locked_by = ?',
+                     (json.dumps(progress, default=str), time.time(), job_id, worker_id))
+
+
+def run_one(worker_id):
+    """Claim and run one due job; returns False when there was none."""
+    _fail_abandoned()
+    row = _claim(worker_id)
+    if row is None:
+        return False
+    t = _tasks.get(row['name'])
+    started = time.perf_counter()
+    _running.job = (row['id'], worker_id)
+    try:
+        if t is None:
+            raise JobFailed(f"Unknown job: {row['name']}")
+        result = t.fn(json.loads(row['payload']))
+    except Exception as e:
+        permanent = isinstance(e, JobFailed) or row['attempts'] >= row['max_attempts']
+        error = str(e) if isinstance(e, JobFailed) else ''.join(traceback.format_exception_only(type(e), e)).strip()
+        if permanent:
+            _finish(row['id'], worker_id, status='failed', error=error)
+            if t is not None and t.on_failure is not None:
+                try:
+                    t.on_failure(json.loads(row['payload']))
+                except Exception:
+                    traceback.print_exc()
+        else:
+            _finish(row['id'], worker_id, status='queued', error=error, run_at=time.time() + backoff(row['attempts']))
+        metrics.JOB_SECONDS.observe(time.perf_counter() - started, row['name'], 'failed' if permanent else 'retry')
+        return True
+    _finish(row['id'], worker_id, status='done', error=None, result=json.dumps(result, default=str))
+    metrics.JOB_SECONDS.observe(time.perf_counter() - started, row['name'], 'done')
+    return True
+
+
+def purge(days=JOB_RETENTION_DAYS):
+    """Delete finished jobs (and with them their idempotency keys) older than ``days``."""
+    cutoff = time.time() - days * 86400
+    with _Transaction() as conn:
+        return conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                            (cutoff,)).rowcount
+
+
+def work(stop=None, poll=JOB_POLL_SECONDS):
+    """Run jobs until ``stop`` (a threading.Event) is set."""
+    stop = stop or threading.Event()
+    worker_id = f'{os.uname().nodename}:{os.getpid()}:{threading.get_ident()}'
+    next_purge = 0
+    while not stop.is_set():
+        try:
+            if time.time() >= next_purge:
+                purge()
+                next_purge = time.time() + 3600
+            if run_one(worker_id):
+                continue
+        except sqlite3.OperationalError:
+            # Locked for longer than the busy timeout; try again next round
+            traceback.print_exc()
+        _wakeup.wait(poll)
+        _wakeup.clear()
+
+
+# ─── Inline worker ──────────────────────────────────────────────
+_inline = None
+_inline_lock = threading.Lock()
+
+
+def start_inline_worker():
+    """Run a worker thread inside this (web) process, once."""
+    global _inline
+    if _inline is not None and _inline.is_alive():
+        return
+    with _inline_lock:
+        if _inline is None or not _inline.is_alive():
+            _inline = threading.Thread(target=work, name='jobs-inline-worker', daemon=True)
+            _inline.start()
+
+
+def _after_fork():
+    # Threads and SQLite connections do not survive fork; the next
+    # start_inline_worker() call starts a fresh thread in the child
+    global _inline, _local, _wakeup
+    _inline = None
+    _local = threading.local()
+    _wakeup = threading.Event()
+
+
+os.register_at_fork(after_in_child=_after_fork)
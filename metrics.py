@@ -0,0 +1,195 @@
+"""Request instrumentation in Prometheus text format.
+
+Metrics are kept per worker process; with several gunicorn workers each
+scrape of ``/api/metrics`` shows the worker that answered it (the ``pid``
+label tells them apart).
+
+Supabase round trips are attributed to the request that made them through a
+context variable, which ``db.fan_out()`` carries into its pool threads.
+"""
+import contextvars
+import os
+import threading
+import time
+
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_MS', 1000)) / 1000
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}')
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # labels → [bucket counts..., sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, series in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, [("le", _number(bound))])} {count}')
+                lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {_number(series[-2])}')
+                lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {series[-1]}')
+        return lines
+
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'API request latency',
+                            ('method', 'route', 'status'))
+REQUEST_BYTES = Histogram('http_request_size_bytes', 'Request body size', ('route',), SIZE_BUCKETS)
+RESPONSE_BYTES = Histogram('http_response_size_bytes', 'Response body size (streamed bodies excluded)',
+                           ('route',), SIZE_BUCKETS)
+SLOW_REQUESTS = Counter('http_slow_requests_total', 'Requests slower than SLOW_REQUEST_MS', ('route',))
+SUPABASE_CALLS = Histogram('supabase_calls_per_request', 'Supabase round trips made by one API request',
+                           ('route',), COUNT_BUCKETS)
+SUPABASE_REQUEST_SECONDS = Histogram('supabase_time_per_request_seconds',
+                                     'Time one API request spent in Supabase round trips', ('route',))
+SUPABASE_CALL_SECONDS = Histogram('supabase_call_duration_seconds', 'Latency of single Supabase round trips',
+                                  ('method', 'resource'))
+SUPABASE_ERRORS = Counter('supabase_call_errors_total', 'Supabase round trips that failed in transport',
+                          ('method', 'resource'))
+SUPABASE_COALESCED = Counter('supabase_coalesced_reads_total',
+                             'Supabase reads answered by an identical read already in flight (or just finished)',
+                             ('method', 'resource'))
+PDF_RENDER_SECONDS = Histogram('pdf_render_seconds', 'Time to render one PDF on a cache miss')
+AUTH_HASH_SECONDS = Histogram('auth_hash_seconds', 'bcrypt hash/check time', ('operation',),
+                              (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+STARTUP_SECONDS = Gauge('app_startup_seconds',
+                        'Startup of this worker: import time per subsystem and time to first response',
+                        ('phase',))
+JOB_SECONDS = Histogram('job_duration_seconds', 'Background job run time by outcome (done, retry, failed)',
+                        ('job', 'outcome'))
+
+
+# ─── Per-request tracking ───────────────────────────────────────
+class RequestStats:
+    __slots__ = ('started', 'calls', '_lock')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        # (method, resource, status, seconds)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def add_call(self, method, resource, status, seconds):
+        with self._lock:
+            self.calls.append((method, resource, status, seconds))
+
+
+_current = contextvars.ContextVar('request_stats', default=None)
+
+
+def start_request():
+    stats = RequestStats()
+    return stats, _current.set(stats)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def current_request():
+    return _current.get()
+
+
+def resource_of(path):
+    # "/rest/v1/estimates" → "estimates", "/rest/v1/rpc/complete_estimate" → "rpc/complete_estimate"
+    return path.split('/rest/v1/', 1)[-1].strip('/') or '/'
+
+
+def record_call(method, path, status, seconds):
+    resource = resource_of(path)
+    SUPABASE_CALL_SECONDS.observe(seconds, method, resource)
+    if status is None:
+        SUPABASE_ERRORS.inc(method, resource)
+    stats = _current.get()
+    if stats is not None:
+        stats.add_call(method, resource, status, seconds)
+
+
+def render():
+    lines = ['# HELP process_info Worker process serving this scrape',
+             '# TYPE process_info gauge',
+             f'process_info{_labels(("pid",), (os.getpid(),))} 1']
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,256 @@
+"""Estimate/invoice PDFs: cache keys, the on-disk render cache and the
+render pool.
+
+Rendering only needs plain dicts (estimate with customer, lines, upsells and
+settings), so it can also run in a worker process without the Flask app. The
+layout itself lives in pdf_layout.py and is only imported where a PDF is
+rendered: web workers hand that to the pool and never load ReportLab.
+"""
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import metrics
+
+# Bump when the layout changes, so cached PDFs are rendered again
+LAYOUT_VERSION = 1
+
+PDF_CACHE_DIR = os.environ.get(
+    'PDF_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'pdf_cache')
+)
+PDF_CACHE_MAX_BYTES = int(os.environ.get('PDF_CACHE_MAX_MB', 200)) * 1024 * 1024
+EXPORT_PROCESSES = int(os.environ.get('PDF_EXPORT_PROCESSES', os.cpu_count() or 2))
+
+# Settings that end up in the document
+SETTINGS_KEYS = (
+    'company_name', 'company_address', 'company_phone', 'company_email',
+    'company_kvk', 'company_btw_id', 'company_iban', 'estimate_prefix', 'invoice_prefix',
+)
+
+INVOICE_STATUSES = ('factuur', 'betaald')
+
+
+def document_info(est, settings):
+    """(doc_type, prefix, filename) for an estimate row."""
+    is_invoice = est['status'] in INVOICE_STATUSES
+    doc_type = 'FACTUUR' if is_invoice else 'OFFERTE'
+    prefix = settings.get('invoice_prefix', 'FAC') if is_invoice else settings.get('estimate_prefix', 'OFF')
+    return doc_type, prefix, f"{doc_type.lower()}_{est['id'][:8]}.pdf"
+
+
+def document_settings(settings):
+    """The printed settings as a plain dict, defaults filled in.
+
+    What render pool processes get: they do not load settings.py, so the
+    ``Settings`` defaults have to travel with the values.
+    """
+    return {k: settings.get(k) for k in SETTINGS_KEYS}
+
+
+def cache_key(est, lines, upsells, settings):
+    """Hash of everything that is printed on the document."""
+    customer = est.get('customers') or {}
+    payload = {
+        'layout': LAYOUT_VERSION,
+        'estimate': {k: est.get(k) for k in ('id', 'status', 'created_at', 'subtotal', 'btw_percentage', 'total_incl_btw', 'notes')},
+        'signature': est.get('signature_sha256') or hashlib.sha256((est.get('signature_data') or '').encode('utf-8')).hexdigest(),
+        'customer': {k: customer.get(k) for k in ('name', 'address', 'phone', 'email')},
+        'lines': [[l['description'], l['square_meters'], l['unit_price'], l['pollution_level'], l['line_total']] for l in lines],
+        'upsells': [[u['description'], u['price']] for u in upsells],
+        'settings': {k: settings.get(k) for k in SETTINGS_KEYS},
+    }
+    raw = json.dumps(payload, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(raw).hexdigest()
+
+
+class PdfCache:
+    """Rendered PDFs on disk, named by cache key, evicted least-recently-used."""
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, f'{key}.pdf')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            os.utime(path)  # mtime doubles as "last used" for eviction
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, data):
+        path = self.path(key)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self._evict()
+        return path
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.root):
+                if entry.name.endswith('.pdf'):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+            if total <= self.max_bytes:
+                return
+            for _, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = PdfCache(PDF_CACHE_DIR, PDF_CACHE_MAX_BYTES)
+    return _cache
+
+
+def cached_pdf(est, lines, upsells, settings, key=None):
+    """Path and cache key of the PDF for this data, rendering it on a miss."""
+    key = key or cache_key(est, lines, upsells, settings)
+    cache = get_cache()
+    path = cache.get(key)
+    if path is None:
+        import pdf_layout
+        path = cache.put(key, pdf_layout.render_estimate_pdf(est, lines, upsells, settings))
+    return path, key
+
+
+# ─── Bulk export ────────────────────────────────────────────────
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_render_pool():
+    # Spawned (not forked) children: they only import this module, never the
+    # Flask app or the parent's open connections.
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=EXPORT_PROCESSES,
+                                            mp_context=multiprocessing.get_context('spawn'))
+    return _pool
+
+
+def _forget_pool():
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_pool)
+
+
+def render_to_cache(key, est, lines, upsells, settings):
+    # Runs in a pool process; only the file path travels back. The key comes
+    # from the parent, so the file lands where the parent looks for it.
+    path, _ = cached_pdf(est, lines, upsells, settings, key)
+    return path
+
+
+def cached_pdf_offloaded(est, lines, upsells, settings):
+    """cached_pdf() for request handlers: a miss is rendered in the pool.
+
+    ReportLab holds the GIL for the whole layout; in a threaded worker that
+    would stall every other request of the process while it renders.
+    """
+    key = cache_key(est, lines, upsells, settings)
+    path = get_cache().get(key)
+    if path is None:
+        started = time.perf_counter()
+        path = get_render_pool().submit(render_to_cache, key, est, lines, upsells,
+                                        document_settings(settings)).result()
+        metrics.PDF_RENDER_SECONDS.observe(time.perf_counter() - started)
+    return path, key
+
+
+def archive_name(est, settings):
+    doc_type, prefix, _ = document_info(est, settings)
+    return f"{doc_type.lower()}_{prefix}-{est['id'][:8].upper()}.pdf"
+
+
+class _ZipStream(io.RawIOBase):
+    """Write-only sink for ZipFile; written bytes are handed out by drain()."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def export_zip(documents, settings):
+    """Yield a ZIP of PDFs for (estimate, lines, upsells) tuples as renders finish.
+
+    At most two renders per pool process are in flight, so memory stays flat
+    however many documents are exported.
+    """
+    pool = get_render_pool()
+    plain_settings = document_settings(settings)
+    window = EXPORT_PROCESSES * 2
+    out = _ZipStream()
+    pending = {}
+    errors = []
+
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zf:
+        def write_finished(futures):
+            for future in futures:
+                est = pending.pop(future)
+                try:
+                    path = future.result()
+                except Exception as e:
+                    errors.append(f"{est['id']}: {e}")
+                    continue
+                zf.write(path, archive_name(est, settings))
+
+        for est, lines, upsells in documents:
+            while len(pending) >= window:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                write_finished(done)
+                yield out.drain()
+            key = cache_key(est, lines, upsells, plain_settings)
+            pending[pool.submit(render_to_cache, key, est, lines, upsells, plain_settings)] = est
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            write_finished(done)
+            yield out.drain()
+
+        if errors:
+            zf.writestr('fouten.txt', '\n'.join(errors))
+    yield out.drain()
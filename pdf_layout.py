@@ -0,0 +1,176 @@
+"""Estimate/invoice PDF layout (ReportLab).
+
+Imported on first render only, see pdf.py: ReportLab is the slowest import
+of the app and web workers never render themselves.
+"""
+import base64
+import io
+import threading
+
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import cm
+from reportlab.lib.colors import HexColor
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Flowable, Image as RLImage
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.enums import TA_RIGHT
+
+import signatures
+from pdf import INVOICE_STATUSES, document_info
+
+_styles = None
+_styles_lock = threading.Lock()
+
+
+def get_styles():
+    # Building the stylesheet is surprisingly expensive; do it once per process
+    global _styles
+    if _styles is None:
+        with _styles_lock:
+            if _styles is None:
+                styles = getSampleStyleSheet()
+                styles.add(ParagraphStyle(name='CompanyName', fontSize=20, spaceAfter=6, textColor=HexColor('#1a56db'), fontName='Helvetica-Bold'))
+                styles.add(ParagraphStyle(name='DocTitle', fontSize=14, spaceAfter=12, textColor=HexColor('#374151'), fontName='Helvetica-Bold'))
+                styles.add(ParagraphStyle(name='SectionHead', fontSize=11, spaceAfter=6, textColor=HexColor('#1a56db'), fontName='Helvetica-Bold'))
+                styles.add(ParagraphStyle(name='BodyText2', fontSize=10, spaceAfter=4, textColor=HexColor('#374151')))
+                styles.add(ParagraphStyle(name='SmallRight', fontSize=9, alignment=TA_RIGHT, textColor=HexColor('#6b7280')))
+                styles.add(ParagraphStyle(name='TotalStyle', fontSize=13, fontName='Helvetica-Bold', textColor=HexColor('#1a56db'), alignment=TA_RIGHT))
+                _styles = styles
+    return _styles
+
+
+LINES_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), HexColor('#1a56db')),
+    ('TEXTCOLOR', (0, 0), (-1, 0), HexColor('#ffffff')),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, -1), 9),
+    ('ALIGN', (1, 0), (-1, -1), 'RIGHT'),
+    ('GRID', (0, 0), (-1, -1), 0.5, HexColor('#e5e7eb')),
+    ('ROWBACKGROUNDS', (0, 1), (-1, -1), [HexColor('#ffffff'), HexColor('#f9fafb')]),
+    ('TOPPADDING', (0, 0), (-1, -1), 6),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
+])
+
+
+class SignatureImage(Flowable):
+    """A stored signature, scaled to fit the signature box with its aspect ratio."""
+
+    def __init__(self, reader, max_width=6*cm, max_height=3*cm):
+        super().__init__()
+        self.hAlign = 'CENTER'
+        self.reader = reader
+        width, height = reader.getSize()
+        scale = min(max_width / width, max_height / height)
+        self.draw_width = width * scale
+        self.draw_height = height * scale
+
+    def wrap(self, avail_width, avail_height):
+        return self.draw_width, self.draw_height
+
+    def draw(self):
+        # Palette PNG with per-entry opacity; mask='auto' keeps it transparent
+        self.canv.drawImage(self.reader, 0, 0, self.draw_width, self.draw_height, mask='auto')
+
+
+def render_estimate_pdf(est, lines, upsells, settings):
+    customer = est.get('customers') or {}
+    estimate_id = est['id']
+    styles = get_styles()
+
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=2*cm, bottomMargin=2*cm, leftMargin=2*cm, rightMargin=2*cm)
+    story = []
+
+    # Header
+    is_invoice = est['status'] in INVOICE_STATUSES
+    doc_type, prefix, _ = document_info(est, settings)
+
+    story.append(Paragraph(settings.get('company_name'), styles['CompanyName']))
+    if settings.get('company_address'):
+        story.append(Paragraph(settings['company_address'], styles['BodyText2']))
+    if settings.get('company_phone'):
+        story.append(Paragraph(f"Tel: {settings['company_phone']}", styles['BodyText2']))
+    if settings.get('company_email'):
+        story.append(Paragraph(f"E-mail: {settings['company_email']}", styles['BodyText2']))
+    if settings.get('company_kvk'):
+        story.append(Paragraph(f"KVK: {settings['company_kvk']}", styles['BodyText2']))
+    if settings.get('company_btw_id'):
+        story.append(Paragraph(f"BTW-ID: {settings['company_btw_id']}", styles['BodyText2']))
+
+    story.append(Spacer(1, 1*cm))
+    story.append(Paragraph(f"{doc_type} {prefix}-{estimate_id[:8].upper()}", styles['DocTitle']))
+    story.append(Paragraph(f"Datum: {est['created_at'][:10]}", styles['BodyText2']))
+    story.append(Spacer(1, 0.5*cm))
+
+    # Customer info
+    story.append(Paragraph('KLANTGEGEVENS', styles['SectionHead']))
+    story.append(Paragraph(f"{customer.get('name', '-')}", styles['BodyText2']))
+    if customer.get('address'):
+        story.append(Paragraph(customer['address'], styles['BodyText2']))
+    if customer.get('phone'):
+        story.append(Paragraph(f"Tel: {customer['phone']}", styles['BodyText2']))
+    if customer.get('email'):
+        story.append(Paragraph(f"E-mail: {customer['email']}", styles['BodyText2']))
+
+    story.append(Spacer(1, 0.8*cm))
+
+    # Services table
+    story.append(Paragraph('WERKZAAMHEDEN', styles['SectionHead']))
+    table_data = [['Omschrijving', 'm²', 'Prijs/m²', 'Vervuiling', 'Totaal']]
+    for line in lines:
+        pollution = 'Zwaar (1.3x)' if line['pollution_level'] == 'zwaar' else 'Standaard'
+        table_data.append([
+            line['description'],
+            f"{float(line['square_meters']):.1f}",
+            f"€{float(line['unit_price']):.2f}",
+            pollution,
+            f"€{float(line['line_total']):.2f}"
+        ])
+
+    for ups in upsells:
+        table_data.append([ups['description'], '', '', '', f"€{float(ups['price']):.2f}"])
+
+    t = Table(table_data, colWidths=[7*cm, 2*cm, 2.5*cm, 2.5*cm, 3*cm])
+    t.setStyle(LINES_TABLE_STYLE)
+    story.append(t)
+    story.append(Spacer(1, 0.5*cm))
+
+    # Totals
+    btw_pct = float(est['btw_percentage'])
+    subtotal = float(est['subtotal'])
+    btw_amount = subtotal * (btw_pct / 100)
+
+    story.append(Paragraph(f"Subtotaal: €{subtotal:.2f}", styles['SmallRight']))
+    story.append(Paragraph(f"BTW ({btw_pct:.0f}%): €{btw_amount:.2f}", styles['SmallRight']))
+    story.append(Spacer(1, 4))
+    story.append(Paragraph(f"TOTAAL: €{float(est['total_incl_btw']):.2f}", styles['TotalStyle']))
+
+    # Signature
+    if est.get('signature_sha256') or est.get('signature_data'):
+        story.append(Spacer(1, 1*cm))
+        story.append(Paragraph('HANDTEKENING KLANT', styles['SectionHead']))
+        try:
+            if est.get('signature_sha256'):
+                story.append(SignatureImage(signatures.image_reader(est['signature_sha256'])))
+            else:
+                # Not yet moved out of the row by `flask migrate-signatures`
+                sig_data = est['signature_data'].split(',')[1] if ',' in est['signature_data'] else est['signature_data']
+                sig_buffer = io.BytesIO(base64.b64decode(sig_data))
+                story.append(RLImage(sig_buffer, width=6*cm, height=3*cm))
+        except Exception:
+            story.append(Paragraph('[Handtekening opgeslagen]', styles['BodyText2']))
+
+    # Payment info for invoices
+    if is_invoice and settings.get('company_iban'):
+        story.append(Spacer(1, 1*cm))
+        story.append(Paragraph('BETAALGEGEVENS', styles['SectionHead']))
+        story.append(Paragraph(f"IBAN: {settings['company_iban']}", styles['BodyText2']))
+        story.append(Paragraph(f"T.n.v. {settings.get('company_name', '')}", styles['BodyText2']))
+        story.append(Paragraph(f"Ref: {prefix}-{estimate_id[:8].upper()}", styles['BodyText2']))
+
+    if est.get('notes'):
+        story.append(Spacer(1, 0.5*cm))
+        story.append(Paragraph('OPMERKINGEN', styles['SectionHead']))
+        story.append(Paragraph(est['notes'], styles['BodyText2']))
+
+    doc.build(story)
+    return buffer.getvalue()
@@ -0,0 +1,188 @@
+"""Project photo storage.
+
+Image bytes live in an object store under a content-addressed key, only the
+metadata is kept in ``project_photos``. Uploads are spooled to disk in
+chunks, so a photo never has to sit in worker memory as a whole. Pillow is
+imported on the first upload, not at startup.
+"""
+import base64
+import binascii
+import hashlib
+import io
+import os
+import tempfile
+import threading
+
+PHOTO_STORAGE = os.environ.get('PHOTO_STORAGE', 'local')
+PHOTO_STORAGE_DIR = os.environ.get(
+    'PHOTO_STORAGE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'photos')
+)
+MAX_PHOTO_BYTES = int(os.environ.get('MAX_PHOTO_BYTES', 20 * 1024 * 1024))
+THUMB_SIZE = int(os.environ.get('PHOTO_THUMB_SIZE', 320))
+CHUNK_SIZE = 64 * 1024
+
+CONTENT_TYPES = {
+    'JPEG': ('image/jpeg', 'jpg'),
+    'PNG': ('image/png', 'png'),
+    'WEBP': ('image/webp', 'webp'),
+    'GIF': ('image/gif', 'gif'),
+}
+
+# Columns of project_photos that describe a stored photo
+METADATA_COLUMNS = 'id, estimate_id, customer_id, photo_type, caption, created_at, storage_key, thumb_key, content_type, size_bytes, width, height, sha256'
+
+
+class PhotoError(ValueError):
+    pass
+
+
+class LocalFileStore:
+    """Object store backed by a directory on the local disk."""
+
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, '.tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def local_path(self, key):
+        # Served with send_file(), which needs a path for Range requests
+        return os.path.join(self.root, *key.split('/'))
+
+    def temp_file(self):
+        # Same filesystem as the store, so put_file() is a cheap rename
+        return tempfile.NamedTemporaryFile(dir=self.tmp_dir, delete=False)
+
+    def put_file(self, key, src_path):
+        dst = self.local_path(key)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.replace(src_path, dst)
+
+    def put_bytes(self, key, data):
+        with self.temp_file() as f:
+            f.write(data)
+        self.put_file(key, f.name)
+
+    def open(self, key):
+        return open(self.local_path(key), 'rb')
+
+    def exists(self, key):
+        return os.path.exists(self.local_path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+
+STORES = {
+    'local': lambda: LocalFileStore(PHOTO_STORAGE_DIR),
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if PHOTO_STORAGE not in STORES:
+                    raise RuntimeError(f'Unknown PHOTO_STORAGE backend: {PHOTO_STORAGE}')
+                _store = STORES[PHOTO_STORAGE]()
+    return _store
+
+
+def decode_data_url(data):
+    # "data:image/jpeg;base64,...." as produced by FileReader.readAsDataURL
+    if ',' in data:
+        data = data.split(',', 1)[1]
+    try:
+        return base64.b64decode(data)
+    except (binascii.Error, ValueError):
+        raise PhotoError('Ongeldige afbeelding')
+
+
+def _spool(stream, store):
+    digest = hashlib.sha256()
+    size = 0
+    with store.temp_file() as f:
+        try:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_PHOTO_BYTES:
+                    raise PhotoError('Foto is te groot')
+                digest.update(chunk)
+                f.write(chunk)
+        except Exception:
+            f.close()
+            os.remove(f.name)
+            raise
+    return f.name, digest.hexdigest(), size
+
+
+def _thumbnail(img):
+    # draft() lets the JPEG decoder skip most of the full-size image
+    from PIL import ImageOps
+    img.draft('RGB', (THUMB_SIZE, THUMB_SIZE))
+    thumb = ImageOps.exif_transpose(img)
+    if thumb.mode != 'RGB':
+        thumb = thumb.convert('RGB')
+    thumb.thumbnail((THUMB_SIZE, THUMB_SIZE))
+    buf = io.BytesIO()
+    thumb.save(buf, 'JPEG', quality=80, optimize=True)
+    return buf.getvalue()
+
+
+def save_photo(stream):
+    """Store an uploaded image plus thumbnail; returns the metadata columns."""
+    from PIL import Image
+    store = get_store()
+    tmp_path, sha256, size = _spool(stream, store)
+    try:
+        if size == 0:
+            raise PhotoError('Lege upload')
+        try:
+            with Image.open(tmp_path) as img:
+                if img.format not in CONTENT_TYPES:
+                    raise PhotoError('Bestandstype niet ondersteund')
+                content_type, ext = CONTENT_TYPES[img.format]
+                width, height = img.size
+                thumb = _thumbnail(img)
+        except (OSError, Image.DecompressionBombError):
+            raise PhotoError('Ongeldige afbeelding')
+
+        key = f'{sha256[:2]}/{sha256}.{ext}'
+        thumb_key = f'{sha256[:2]}/{sha256}_thumb.jpg'
+        # Content-addressed: an identical photo is only stored once
+        if store.exists(key):
+            os.remove(tmp_path)
+        else:
+            store.put_file(key, tmp_path)
+        if not store.exists(thumb_key):
+            store.put_bytes(thumb_key, thumb)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return {
+        'storage_key': key,
+        'thumb_key': thumb_key,
+        'content_type': content_type,
+        'size_bytes': size,
+        'width': width,
+        'height': height,
+        'sha256': sha256,
+    }
+
+
+def delete_blobs(meta):
+    store = get_store()
+    for key in (meta.get('storage_key'), meta.get('thumb_key')):
+        if key:
+            store.delete(key)
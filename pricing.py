@@ -0,0 +1,189 @@
+"""Quote pricing.
+
+All money math for estimates lives here, in Decimal: line totals (area ×
+price per unit × the service's multiplier for 'zwaar'), upsells, BTW and
+rounding to cents. Prices come from the services and upsell_items tables,
+not from the client; the price list is cached per process and dropped when
+an admin edits either table (the ``services``/``upsell_items`` tags on
+the invalidation bus, see cache.py).
+"""
+import os
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+import cache
+import db
+import settings
+
+PRICE_LIST_TTL = int(os.environ.get('PRICE_LIST_CACHE_TTL', 300))
+
+MAX_LINES = 100
+MAX_QUOTES = 50
+
+CENT = Decimal('0.01')
+ONE = Decimal('1')
+POLLUTION_LEVELS = ('standaard', 'zwaar')
+
+_cache = cache.TTLCache(PRICE_LIST_TTL, tags=('services', 'upsell_items'), max_entries=1)
+
+
+class PricingError(ValueError):
+    """The draft cannot be priced; the message is shown to the user."""
+
+
+def money(value):
+    return value.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def _decimal(value, field):
+    try:
+        number = Decimal(str(value).replace(',', '.'))
+    except (InvalidOperation, TypeError):
+        raise PricingError(f'{field} moet een getal zijn')
+    if not number.is_finite() or number < 0:
+        raise PricingError(f'{field} moet een positief getal zijn')
+    return number
+
+
+class PriceList:
+    """Active services and upsell items by id."""
+
+    def __init__(self, services, upsells):
+        self.services = {s['id']: s for s in services}
+        self.upsells = {u['id']: u for u in upsells}
+
+    def service(self, service_id):
+        service = self.services.get(service_id)
+        if service is None:
+            raise PricingError('Onbekende of inactieve dienst')
+        return service
+
+    def upsell(self, upsell_id):
+        upsell = self.upsells.get(upsell_id)
+        if upsell is None:
+            raise PricingError('Onbekende of inactieve upsell')
+        return upsell
+
+
+def _load():
+    sb = db.get_client()
+    services, upsells = db.fan_out(
+        sb.table('services').select('id, name, price_per_unit, heavy_multiplier').eq('active', True).execute,
+        sb.table('upsell_items').select('id, name, price').eq('active', True).execute,
+    )
+    return PriceList(
+        [{'id': s['id'], 'name': s['name'],
+          'price_per_unit': _decimal(s['price_per_unit'], 'price_per_unit'),
+          'heavy_multiplier': _decimal(s['heavy_multiplier'] if s['heavy_multiplier'] is not None else 1, 'heavy_multiplier')}
+         for s in services.data],
+        [{'id': u['id'], 'name': u['name'], 'price': _decimal(u['price'], 'price')} for u in upsells.data],
+    )
+
+
+def price_list():
+    return _cache.get_or_set('all', _load)
+
+
+# ─── Pricing ────────────────────────────────────────────────────
+def price_line(line, prices):
+    if not isinstance(line, dict):
+        raise PricingError('Ongeldige regel')
+    area = _decimal(line.get('square_meters', 0), 'square_meters')
+    level = line.get('pollution_level') or 'standaard'
+    if level not in POLLUTION_LEVELS:
+        raise PricingError(f"pollution_level moet {' of '.join(POLLUTION_LEVELS)} zijn")
+
+    if line.get('service_id'):
+        service = prices.service(line['service_id'])
+        unit_price = service['price_per_unit']
+        multiplier = service['heavy_multiplier'] if level == 'zwaar' else ONE
+        description = line.get('description') or service['name']
+    else:
+        # Free-form work without a service: the price is whatever was agreed
+        if not line.get('description'):
+            raise PricingError('Een regel zonder dienst heeft een omschrijving nodig')
+        unit_price = _decimal(line.get('unit_price'), 'unit_price')
+        multiplier = ONE
+        description = line['description']
+
+    return {
+        'service_id': line.get('service_id'),
+        'description': description,
+        'square_meters': area,
+        'pollution_level': level,
+        'unit_price': unit_price,
+        'multiplier': multiplier,
+        'line_total': money(area * unit_price * multiplier),
+    }
+
+
+def price_upsell(upsell, prices):
+    if not isinstance(upsell, dict):
+        raise PricingError('Ongeldige upsell')
+    if upsell.get('upsell_item_id'):
+        item = prices.upsell(upsell['upsell_item_id'])
+        return {'upsell_item_id': item['id'], 'description': upsell.get('description') or item['name'],
+                'price': money(item['price'])}
+    if not upsell.get('description'):
+        raise PricingError('Een upsell zonder item heeft een omschrijving nodig')
+    return {'upsell_item_id': None, 'description': upsell['description'],
+            'price': money(_decimal(upsell.get('price'), 'price'))}
+
+
+def price_quote(draft, prices=None):
+    """Price one draft ({lines, upsells, btw_percentage?}).
+
+    Returns the priced lines and upsells with subtotal, btw_amount and
+    total_incl_btw, all as Decimal rounded to cents. BTW is rounded once,
+    over the subtotal.
+    """
+    if not isinstance(draft, dict):
+        raise PricingError('Ongeldige offerte')
+    prices = prices or price_list()
+    lines = draft.get('lines') or []
+    upsells = draft.get('upsells') or []
+    if not isinstance(lines, list) or not isinstance(upsells, list):
+        raise PricingError('lines en upsells moeten lijsten zijn')
+    if len(lines) + len(upsells) > MAX_LINES:
+        raise PricingError(f'Maximaal {MAX_LINES} regels per offerte')
+
+    priced_lines = [price_line(line, prices) for line in lines]
+    priced_upsells = [price_upsell(upsell, prices) for upsell in upsells]
+
+    btw_pct = draft.get('btw_percentage')
+    if btw_pct is None or btw_pct == '':
+        btw_pct = settings.current().btw_percentage
+    else:
+        btw_pct = _decimal(btw_pct, 'btw_percentage')
+
+    subtotal = sum((l['line_total'] for l in priced_lines), Decimal(0)) + \
+        sum((u['price'] for u in priced_upsells), Decimal(0))
+    btw_amount = money(subtotal * btw_pct / 100)
+    return {
+        'lines': priced_lines,
+        'upsells': priced_upsells,
+        'subtotal': subtotal,
+        'btw_percentage': btw_pct,
+        'btw_amount': btw_amount,
+        'total_incl_btw': subtotal + btw_amount,
+    }
+
+
+def price_quotes(drafts):
+    """Price several drafts against one snapshot of the price list."""
+    if not isinstance(drafts, list) or not drafts:
+        raise PricingError('quotes moet een niet-lege lijst zijn')
+    if len(drafts) > MAX_QUOTES:
+        raise PricingError(f'Maximaal {MAX_QUOTES} offertes per keer')
+    prices = price_list()
+    return [price_quote(draft, prices) for draft in drafts]
+
+
+def as_json(value):
+    """Decimals → floats for JSON, recursively (amounts have at most a few decimals)."""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, dict):
+        return {k: as_json(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [as_json(v) for v in value]
+    return value
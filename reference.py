@@ -0,0 +1,73 @@
+"""Conditional GET for reference data.
+
+Services, upsell items and inventory change rarely but are fetched every
+time the estimate builder opens. Each table has a cache tag that the write
+handlers bump. Until that happens the serialized response is kept in
+memory with an ETag and Last-Modified, and a client that still has the same
+body gets a 304 without a Supabase request.
+"""
+import hashlib
+import os
+import threading
+import time
+
+from flask import current_app, request
+
+import cache
+
+REFERENCE_CACHE_TTL = int(os.environ.get('REFERENCE_CACHE_TTL', 300))
+
+# Response headers that are part of the cached payload
+KEPT_HEADERS = ('X-Next-Cursor',)
+
+
+class ReferenceData:
+    def __init__(self, tag, ttl=REFERENCE_CACHE_TTL, max_entries=32):
+        self.tag = tag
+        self._cache = cache.TTLCache(ttl, tags=(tag,), max_entries=max_entries)
+        # ETag → when that body was first served, so Last-Modified stays put
+        # across a bump that did not change the content
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def _last_modified(self, etag):
+        with self._lock:
+            if etag not in self._seen:
+                if len(self._seen) >= 64:
+                    self._seen.pop(next(iter(self._seen)))
+                self._seen[etag] = time.time()
+            return self._seen[etag]
+
+    def _load(self, build):
+        response = build()
+        if response.status_code != 200 or response.is_streamed:
+            return None, response
+        body = response.get_data()
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        headers = {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers}
+        return (body, response.mimetype, headers, etag, self._last_modified(etag)), response
+
+    def respond(self, build):
+        """Serve ``build()``'s response for this URL from memory, or a 304."""
+        key = request.full_path
+        entry = self._cache.get(key)
+        if entry is cache.MISSING:
+            stamp = self._cache.stamp()
+            entry, response = self._load(build)
+            if entry is None:
+                return response
+            self._cache.set(key, entry, stamp)
+
+        body, mimetype, headers, etag, last_modified = entry
+        response = current_app.response_class(body, mimetype=mimetype, headers=headers)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        # The browser keeps its copy but always revalidates; that is a 304
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+
+services = ReferenceData('services')
+upsell_items = ReferenceData('upsell_items')
+inventory = ReferenceData('inventory')
@@ -0,0 +1,166 @@
+"""Response encoding: fast JSON and on-the-fly compression.
+
+``jsonify`` serializes with orjson, which is several times faster than the
+stdlib encoder on our list and estimate payloads. Decimal (NUMERIC) becomes a
+JSON number and datetimes are written as ISO 8601 like the TIMESTAMPTZ
+strings Supabase sends.
+
+Bodies of at least COMPRESS_MIN_SIZE bytes are compressed with brotli or
+gzip, whichever the client prefers in Accept-Encoding. Media that is
+already compressed (photos, PDFs, ZIPs) is passed through unless
+COMPRESS_SKIP_MEDIA is turned off. Streamed responses (NDJSON exports) are
+compressed chunk by chunk.
+"""
+import datetime
+import decimal
+import os
+import uuid
+import zlib
+
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is in requirements.txt
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_SKIP_MEDIA = os.environ.get('COMPRESS_SKIP_MEDIA', 'true').lower() == 'true'
+GZIP_LEVEL = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 4))
+
+# Formats that are compressed already; another pass only costs CPU
+COMPRESSED_MEDIA_PREFIXES = ('image/', 'video/', 'audio/')
+COMPRESSED_MEDIA_TYPES = ('application/pdf', 'application/zip', 'application/gzip', 'application/x-gzip',
+                          'application/octet-stream', 'font/woff', 'font/woff2')
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+# ─── JSON ───────────────────────────────────────────────────────
+def _default(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (stdlib json when it is missing)."""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None:
+            kwargs.setdefault('default', _default)
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if orjson is None:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if orjson is None or self._app.debug:
+            # Indented output while debugging, like Flask's own provider
+            return super().response(*args, **kwargs)
+        body = orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+# ─── Compression ────────────────────────────────────────────────
+def _is_compressed_media(mimetype):
+    return mimetype.startswith(COMPRESSED_MEDIA_PREFIXES) or mimetype in COMPRESSED_MEDIA_TYPES
+
+
+def _compressor(encoding):
+    if encoding == 'br':
+        return brotli.Compressor(quality=BROTLI_QUALITY)
+    # wbits 16+: gzip container instead of a raw zlib stream
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    c = _compressor(encoding)
+    return c.compress(body) + c.flush()
+
+
+def _compress_stream(chunks, encoding):
+    c = _compressor(encoding)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        if encoding == 'br':
+            data = c.process(chunk) + c.flush()
+        else:
+            data = c.compress(chunk) + c.flush(zlib.Z_SYNC_FLUSH)
+        # Flushing per chunk keeps a slow export arriving as it is produced
+        if data:
+            yield data
+    yield c.finish() if encoding == 'br' else c.flush()
+
+
+def _add_vary(response):
+    vary = response.vary
+    if 'accept-encoding' not in {v.lower() for v in vary}:
+        vary.add('Accept-Encoding')
+
+
+def compress_response(response):
+    """Compress ``response`` for the current request in place when it pays off."""
+    if (response.status_code < 200 or response.status_code in (204, 206, 304)
+            or 'Content-Encoding' in response.headers or request.method == 'HEAD'):
+        return response
+    if COMPRESS_SKIP_MEDIA and _is_compressed_media(response.mimetype or ''):
+        return response
+
+    _add_vary(response)
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if encoding is None:
+        return response
+
+    if response.direct_passthrough:
+        # send_file() hands over an open file (the SPA's index.html, or
+        # media when COMPRESS_SKIP_MEDIA is off); read it to compress it
+        response.direct_passthrough = False
+        response.make_sequence()
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compress(body, encoding))
+    response.headers['Content-Encoding'] = encoding
+
+    # A strong ETag names exact bytes; the compressed body is a different
+    # representation of the same content
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    app.json_provider_class = OrjsonProvider
+    app.json = OrjsonProvider(app)
+
+    # Registered after the metrics hook so that one, running later, sees the
+    # size on the wire
+    @app.after_request
+    def _compress(response):
+        return compress_response(response)
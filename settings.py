@@ -0,0 +1,94 @@
+"""Company settings, cached per process.
+
+The ``settings`` table is small and read by almost every document we
+produce, so handlers use ``current()`` instead of querying it. Saving goes
+through ``update()``: one bulk upsert, after which the ``settings`` tag is
+bumped and every worker reloads on its next read.
+"""
+import datetime
+import os
+from decimal import Decimal, InvalidOperation
+
+import cache
+import db
+
+SETTINGS_CACHE_TTL = int(os.environ.get('SETTINGS_CACHE_TTL', 300))
+
+DEFAULTS = {
+    'company_name': 'MijnBedrijf',
+    'btw_percentage': '21',
+    'estimate_prefix': 'OFF',
+    'invoice_prefix': 'FAC',
+    'estimate_counter': '1',
+    'invoice_counter': '1',
+}
+
+NUMERIC_KEYS = ('btw_percentage',)
+INTEGER_KEYS = ('estimate_counter', 'invoice_counter')
+
+_cache = cache.TTLCache(SETTINGS_CACHE_TTL, tags=('settings',), max_entries=1)
+
+
+class Settings(dict):
+    """Read-only snapshot of the settings table (key → text value)."""
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return DEFAULTS.get(key, default)
+
+    def _number(self, key):
+        try:
+            value = Decimal(self.get(key))
+        except (TypeError, InvalidOperation):
+            value = None
+        if value is None or not value.is_finite() or value < 0:
+            return Decimal(DEFAULTS[key])
+        return value
+
+    @property
+    def btw_percentage(self):
+        return self._number('btw_percentage')
+
+
+def _load():
+    rows = db.get_client().table('settings').select('key, value').execute().data
+    return Settings({row['key']: row['value'] for row in rows})
+
+
+def current():
+    return _cache.get_or_set('all', _load)
+
+
+def validate(values):
+    """Return the values as settings rows' text, or raise ValueError."""
+    cleaned = {}
+    for key, value in values.items():
+        if not isinstance(key, str) or not key:
+            raise ValueError('Ongeldige instelling')
+        value = '' if value is None else str(value).strip()
+        if key in NUMERIC_KEYS:
+            try:
+                if float(value.replace(',', '.')) < 0:
+                    raise ValueError
+            except ValueError:
+                raise ValueError(f'{key} moet een positief getal zijn')
+            value = value.replace(',', '.')
+        if key in INTEGER_KEYS:
+            try:
+                int(value)
+            except ValueError:
+                raise ValueError(f'{key} moet een geheel getal zijn')
+        cleaned[key] = value
+    return cleaned
+
+
+def update(values):
+    """Write all given settings in one request and invalidate every cache."""
+    cleaned = validate(values)
+    if not cleaned:
+        return
+    now = datetime.datetime.utcnow().isoformat()
+    rows = [{'key': key, 'value': value, 'updated_at': now} for key, value in cleaned.items()]
+    db.get_client().table('settings').upsert(rows, on_conflict='key').execute()
+    cache.bump('settings')
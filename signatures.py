@@ -0,0 +1,127 @@
+"""Customer signatures.
+
+The signature pad sends a full-size canvas as a base64 PNG. At sign time it is
+normalized (trimmed to the ink, downscaled, stored as a 16-level palette PNG
+in the ink colour) and written to the photo store under its sha256; the
+estimate only keeps that hash. The same signature is stored once, can be
+served with immutable caching and is decoded at most once per process for
+PDF rendering. Pillow and ReportLab are imported on first use.
+"""
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+
+import photos
+
+MAX_SIGNATURE_BYTES = int(os.environ.get('MAX_SIGNATURE_BYTES', 2 * 1024 * 1024))
+SIGNATURE_MAX_WIDTH = int(os.environ.get('SIGNATURE_MAX_WIDTH', 600))
+SIGNATURE_MAX_HEIGHT = int(os.environ.get('SIGNATURE_MAX_HEIGHT', 200))
+DECODED_CACHE_SIZE = int(os.environ.get('SIGNATURE_DECODED_CACHE', 64))
+
+INK_COLOR = (15, 23, 42)  # strokeStyle of the signature pad
+LEVELS = 16
+PADDING = 8
+# Ink lighter than this is anti-aliasing noise or a stray touch
+INK_THRESHOLD = 24
+
+# Palette entry i is the ink colour at opacity i / (LEVELS - 1)
+_PALETTE = list(INK_COLOR) * LEVELS
+_ALPHAS = bytes(round(i * 255 / (LEVELS - 1)) for i in range(LEVELS))
+
+
+class SignatureError(ValueError):
+    pass
+
+
+def storage_key(sha256):
+    return f'signatures/{sha256[:2]}/{sha256}.png'
+
+
+def is_hash(value):
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+
+def _ink(img):
+    # Flattened on white, so transparent pads and white-filled ones look the
+    # same; the darker a pixel, the more ink
+    from PIL import Image
+    img = img.convert('RGBA')
+    flat = Image.new('RGBA', img.size, (255, 255, 255, 255))
+    flat.alpha_composite(img)
+    return flat.convert('L').point(lambda v: 255 - v)
+
+
+def normalize(data):
+    """Normalized PNG bytes for raw image bytes from the signature pad."""
+    from PIL import Image
+    if len(data) > MAX_SIGNATURE_BYTES:
+        raise SignatureError('Handtekening is te groot')
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            ink = _ink(img)
+    except (OSError, Image.DecompressionBombError):
+        raise SignatureError('Ongeldige handtekening')
+
+    bbox = ink.point(lambda v: 255 if v >= INK_THRESHOLD else 0).getbbox()
+    if bbox is None:
+        raise SignatureError('Handtekening is leeg')
+    left, top, right, bottom = bbox
+    ink = ink.crop((max(left - PADDING, 0), max(top - PADDING, 0),
+                    min(right + PADDING, ink.width), min(bottom + PADDING, ink.height)))
+    ink.thumbnail((SIGNATURE_MAX_WIDTH, SIGNATURE_MAX_HEIGHT), Image.LANCZOS)
+
+    # Ink level → palette index; opacity lives in the tRNS chunk
+    indexed = ink.point(lambda v: round(v * (LEVELS - 1) / 255)).convert('P')
+    indexed.putpalette(_PALETTE)
+    buf = io.BytesIO()
+    indexed.save(buf, 'PNG', optimize=True, transparency=_ALPHAS)
+    return buf.getvalue()
+
+
+def save_signature(data):
+    """Normalize and store a signature (data URL or raw bytes); returns its sha256."""
+    if isinstance(data, str):
+        try:
+            data = photos.decode_data_url(data)
+        except photos.PhotoError:
+            raise SignatureError('Ongeldige handtekening')
+    png = normalize(data)
+    sha256 = hashlib.sha256(png).hexdigest()
+    store = photos.get_store()
+    key = storage_key(sha256)
+    if not store.exists(key):
+        store.put_bytes(key, png)
+    return sha256
+
+
+def local_path(sha256):
+    return photos.get_store().local_path(storage_key(sha256))
+
+
+# ─── Decoded images for PDF rendering ───────────────────────────
+_decoded = OrderedDict()
+_decoded_lock = threading.Lock()
+
+
+def image_reader(sha256):
+    """ReportLab ImageReader for a stored signature, kept decoded per process.
+
+    Signatures are immutable, so a reader never goes stale; the cache only
+    bounds memory.
+    """
+    from reportlab.lib.utils import ImageReader
+    with _decoded_lock:
+        reader = _decoded.get(sha256)
+        if reader is not None:
+            _decoded.move_to_end(sha256)
+            return reader
+    with photos.get_store().open(storage_key(sha256)) as f:
+        reader = ImageReader(io.BytesIO(f.read()))
+    reader.getRGBData()  # decode now, not during the first layout
+    with _decoded_lock:
+        _decoded[sha256] = reader
+        while len(_decoded) > DECODED_CACHE_SIZE:
+            _decoded.popitem(last=False)
+    return reader
@@ -0,0 +1,124 @@
+"""Startup timing and the gunicorn preload step.
+
+app.py imports its subsystems inside ``timed()`` blocks, and slow ones that
+are only loaded on first use (the Supabase SDK, see ``db.load_sdk()``) are
+timed the same way when that happens. Together with the time to the first
+response this shows where a cold start goes: ``/api/metrics`` has it as
+``app_startup_seconds`` per worker, ``flask --app app startup-report``
+prints it for a fresh process.
+
+With ``preload_app`` (gunicorn.conf.py) the master imports the app and runs
+``warm()`` once; workers inherit everything at fork, so their own startup is
+only the time from fork to first response.
+
+This module is imported before anything else in app.py and must stay cheap:
+no imports beyond the standard library until the app has loaded .env.
+"""
+import contextlib
+import os
+import threading
+import time
+
+
+def _process_started():
+    # Wall-clock time the interpreter started (Linux: /proc); elsewhere the
+    # import of this module, which misses only the interpreter's own boot
+    try:
+        with open('/proc/self/stat') as f:
+            # Fields after "(comm)"; the 22nd field, starttime, is the 20th
+            starttime = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + starttime / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+PROCESS_STARTED = _process_started()
+
+_timings = {'interpreter': max(time.time() - PROCESS_STARTED, 0.0)}
+_lock = threading.Lock()
+_ready = False
+_responded = False
+_forked_at = None
+
+
+def _publish(phases):
+    import metrics
+    for phase in phases:
+        metrics.STARTUP_SECONDS.set(_timings[phase], phase)
+
+
+def record(phase, seconds):
+    """Keep the first timing of ``phase``; later ones are ignored."""
+    with _lock:
+        if phase in _timings:
+            return
+        _timings[phase] = seconds
+    if _ready:
+        _publish((phase,))
+
+
+@contextlib.contextmanager
+def timed(phase):
+    """Record how long the block takes as ``phase``, the first time it runs."""
+    if phase in _timings:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - started)
+
+
+def ready():
+    """Called once the app module has been imported."""
+    global _ready
+    record('ready', time.time() - PROCESS_STARTED)
+    _ready = True
+    _publish(list(_timings))
+
+
+def first_response():
+    """Called after every response; records the first one of this process."""
+    global _responded
+    if _responded:
+        return
+    _responded = True
+    # A preloaded worker counts from its fork, the master's import is shared
+    record('first_response', time.time() - (_forked_at or PROCESS_STARTED))
+
+
+def warm():
+    """Load what app.py defers to first use, before the gunicorn master forks.
+
+    Only imports and read-only state: no connections, threads or pools,
+    which do not survive a fork (each module re-creates those per process).
+    """
+    import db
+    db.load_sdk()
+    with timed('load:pillow'):
+        import PIL.Image
+        import PIL.ImageOps
+        PIL.Image.init()  # registers the format plugins
+    with timed('load:bcrypt'):
+        import bcrypt
+
+
+def report():
+    """Timings of this process as [(phase, seconds)], in the order recorded."""
+    with _lock:
+        return list(_timings.items())
+
+
+def _after_fork():
+    global _forked_at, _responded, _lock
+    _forked_at = time.time()
+    _responded = False
+    _lock = threading.Lock()
+    _timings.pop('first_response', None)
+    record('fork', _forked_at - PROCESS_STARTED)
+
+
+os.register_at_fork(after_in_child=_after_fork)
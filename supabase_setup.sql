@@ -184,3 +184,814 @@ CREATE INDEX idx_estimates_status ON estimates(status);
 CREATE INDEX idx_estimate_lines_estimate ON estimate_lines(estimate_id);
 CREATE INDEX idx_project_photos_estimate ON project_photos(estimate_id);
 CREATE INDEX idx_inventory_log_inventory ON inventory_log(inventory_id);
+CREATE INDEX idx_estimates_status_updated ON estimates(status, updated_at);
+
+-- ─── RPC functions ──────────────────────────────────────────────
+-- Called by the backend through PostgREST (/rest/v1/rpc/<name>).
+
+-- Estimate with customer, lines, upsells and photo metadata as one JSON document
+CREATE OR REPLACE FUNCTION estimate_json(p_estimate_id UUID)
+RETURNS JSONB LANGUAGE sql STABLE AS $$
+    SELECT to_jsonb(e)
+        || jsonb_build_object(
+            'customers', (SELECT to_jsonb(c) FROM customers c WHERE c.id = e.customer_id),
+            'lines', COALESCE((SELECT jsonb_agg(l ORDER BY l.created_at) FROM estimate_lines l WHERE l.estimate_id = e.id), '[]'::jsonb),
+            'upsells', COALESCE((SELECT jsonb_agg(u ORDER BY u.created_at) FROM estimate_upsells u WHERE u.estimate_id = e.id), '[]'::jsonb),
+            'photos', COALESCE((
+                SELECT jsonb_agg(jsonb_build_object('id', p.id, 'photo_type', p.photo_type, 'caption', p.caption, 'created_at', p.created_at) ORDER BY p.created_at)
+                FROM project_photos p WHERE p.estimate_id = e.id
+            ), '[]'::jsonb)
+        )
+    FROM estimates e
+    WHERE e.id = p_estimate_id;
+$$;
+
+-- Estimate, lines and upsells written in one transaction
+CREATE OR REPLACE FUNCTION create_estimate_with_children(p_estimate JSONB, p_lines JSONB, p_upsells JSONB)
+RETURNS JSONB LANGUAGE plpgsql AS $$
+DECLARE
+    v_id UUID;
+BEGIN
+    INSERT INTO estimates (customer_id, user_id, status, subtotal, btw_percentage, total_incl_btw, notes)
+    VALUES (
+        (p_estimate->>'customer_id')::UUID,
+        (p_estimate->>'user_id')::UUID,
+        COALESCE(p_estimate->>'status', 'concept'),
+        (p_estimate->>'subtotal')::NUMERIC,
+        (p_estimate->>'btw_percentage')::NUMERIC,
+        (p_estimate->>'total_incl_btw')::NUMERIC,
+        COALESCE(p_estimate->>'notes', '')
+    )
+    RETURNING id INTO v_id;
+
+    INSERT INTO estimate_lines (estimate_id, service_id, description, square_meters, pollution_level, unit_price, multiplier, line_total)
+    SELECT v_id, l.service_id, l.description, l.square_meters, COALESCE(l.pollution_level, 'standaard'),
+           l.unit_price, COALESCE(l.multiplier, 1.0), l.line_total
+    FROM jsonb_to_recordset(COALESCE(p_lines, '[]'::jsonb)) AS l(
+        service_id UUID, description TEXT, square_meters NUMERIC, pollution_level TEXT,
+        unit_price NUMERIC, multiplier NUMERIC, line_total NUMERIC
+    );
+
+    INSERT INTO estimate_upsells (estimate_id, upsell_item_id, description, price)
+    SELECT v_id, u.upsell_item_id, u.description, u.price
+    FROM jsonb_to_recordset(COALESCE(p_upsells, '[]'::jsonb)) AS u(upsell_item_id UUID, description TEXT, price NUMERIC);
+
+    RETURN estimate_json(v_id);
+END;
+$$;
+
+-- Inventory changes applied as one set-based update plus one bulk log insert.
+-- p_changes: [{"inventory_id": ..., "change_amount": ..., "reason": ...}]
+CREATE OR REPLACE FUNCTION apply_inventory_changes(p_changes JSONB, p_estimate_id UUID DEFAULT NULL)
+RETURNS JSONB LANGUAGE plpgsql AS $$
+DECLARE
+    v_result JSONB;
+BEGIN
+    -- Lock the rows in a fixed order so concurrent completions cannot deadlock
+    PERFORM 1 FROM inventory
+    WHERE id IN (SELECT (c->>'inventory_id')::UUID FROM jsonb_array_elements(p_changes) c)
+    ORDER BY id
+    FOR UPDATE;
+
+    WITH changes AS (
+        SELECT c.inventory_id, c.change_amount, c.reason
+        FROM jsonb_to_recordset(p_changes) AS c(inventory_id UUID, change_amount NUMERIC, reason TEXT)
+    ), totals AS (
+        SELECT inventory_id, SUM(change_amount) AS delta FROM changes GROUP BY inventory_id
+    ), updated AS (
+        UPDATE inventory i
+        SET quantity_on_hand = GREATEST(0, i.quantity_on_hand + t.delta), updated_at = NOW()
+        FROM totals t
+        WHERE i.id = t.inventory_id
+        RETURNING i.*
+    ), logged AS (
+        INSERT INTO inventory_log (inventory_id, estimate_id, change_amount, reason)
+        SELECT c.inventory_id, p_estimate_id, c.change_amount, c.reason
+        FROM changes c
+        JOIN updated u ON u.id = c.inventory_id
+    )
+    SELECT COALESCE(jsonb_agg(to_jsonb(u) ORDER BY u.item_name), '[]'::jsonb) INTO v_result FROM updated u;
+
+    RETURN v_result;
+END;
+$$;
+
+-- Mark a job as done and deduct its chemical usage in one transaction.
+-- Returns NULL for an unknown estimate and completed=false if it was already done.
+CREATE OR REPLACE FUNCTION complete_estimate(p_estimate_id UUID, p_changes JSONB)
+RETURNS JSONB LANGUAGE plpgsql AS $$
+DECLARE
+    v_status TEXT;
+BEGIN
+    SELECT status INTO v_status FROM estimates WHERE id = p_estimate_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN NULL;
+    END IF;
+    IF v_status IN ('voltooid', 'factuur', 'betaald') THEN
+        RETURN jsonb_build_object('completed', FALSE, 'status', v_status, 'inventory', '[]'::jsonb);
+    END IF;
+
+    UPDATE estimates SET status = 'voltooid', updated_at = NOW() WHERE id = p_estimate_id;
+
+    RETURN jsonb_build_object(
+        'completed', TRUE,
+        'status', 'voltooid',
+        'inventory', apply_inventory_changes(COALESCE(p_changes, '[]'::jsonb), p_estimate_id)
+    );
+END;
+$$;
+
+-- ─── Photos in object storage ───────────────────────────────────
+-- Image bytes live in the photo store; photo_data only holds rows that
+-- have not been moved yet by `flask --app app migrate-photos`.
+ALTER TABLE project_photos ALTER COLUMN photo_data DROP NOT NULL;
+ALTER TABLE project_photos ADD COLUMN IF NOT EXISTS storage_key TEXT;
+ALTER TABLE project_photos ADD COLUMN IF NOT EXISTS thumb_key TEXT;
+ALTER TABLE project_photos ADD COLUMN IF NOT EXISTS content_type TEXT;
+ALTER TABLE project_photos ADD COLUMN IF NOT EXISTS size_bytes INTEGER;
+ALTER TABLE project_photos ADD COLUMN IF NOT EXISTS width INTEGER;
+ALTER TABLE project_photos ADD COLUMN IF NOT EXISTS height INTEGER;
+ALTER TABLE project_photos ADD COLUMN IF NOT EXISTS sha256 TEXT;
+CREATE INDEX IF NOT EXISTS idx_project_photos_storage_key ON project_photos(storage_key);
+
+-- ─── Keyset pagination ──────────────────────────────────────────
+-- List endpoints page on (order column, id); these indexes let each page
+-- start with an index seek instead of scanning past the earlier rows.
+CREATE INDEX IF NOT EXISTS idx_customers_created_id ON customers(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_estimates_created_id ON estimates(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_estimates_status_created_id ON estimates(status, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_inventory_name_id ON inventory(item_name, id);
+CREATE INDEX IF NOT EXISTS idx_users_created_id ON users(created_at, id);
+
+-- ─── Customer search ────────────────────────────────────────────
+-- Search runs against generated columns with trigram and full-text
+-- indexes, so a keystroke in the search box is an index lookup instead of
+-- a scan over every customer.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Digits only, Dutch country code folded to the trunk prefix:
+-- "+31 6-1234 5678", "0031612345678" and "06 12345678" all become 0612345678
+CREATE OR REPLACE FUNCTION normalize_phone(p_phone TEXT)
+RETURNS TEXT
+LANGUAGE sql IMMUTABLE PARALLEL SAFE
+AS $$
+    SELECT regexp_replace(
+        regexp_replace(COALESCE(p_phone, ''), '[^0-9]', '', 'g'),
+        '^(0031|31(?=[1-9][0-9]{8}$))', '0'
+    );
+$$;
+
+-- "1234 AB" → "1234ab", so a postcode is a single prefix-searchable token
+CREATE OR REPLACE FUNCTION normalize_search_text(p_text TEXT)
+RETURNS TEXT
+LANGUAGE sql IMMUTABLE PARALLEL SAFE
+AS $$
+    SELECT regexp_replace(lower(COALESCE(p_text, '')), '([0-9]{4})\s+([a-z]{2})\M', '\1\2', 'g');
+$$;
+
+ALTER TABLE customers ADD COLUMN IF NOT EXISTS search_text TEXT
+    GENERATED ALWAYS AS (normalize_search_text(name || ' ' || COALESCE(address, ''))) STORED;
+ALTER TABLE customers ADD COLUMN IF NOT EXISTS search_phone TEXT
+    GENERATED ALWAYS AS (normalize_phone(phone)) STORED;
+ALTER TABLE customers ADD COLUMN IF NOT EXISTS search_vector TSVECTOR
+    GENERATED ALWAYS AS (to_tsvector('simple', normalize_search_text(name || ' ' || COALESCE(address, '')))) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_customers_search_text ON customers USING GIN (search_text gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_customers_search_phone ON customers USING GIN (search_phone gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_customers_search_vector ON customers USING GIN (search_vector);
+
+-- Ranked customer search. Every word of the query is a prefix match
+-- ("1234a" finds postcode 1234 AB, "12" finds house number 12b), the
+-- query as a whole may also match with typos, and queries made of digits
+-- are matched against the normalized phone number.
+CREATE OR REPLACE FUNCTION search_customers(p_query TEXT, p_limit INTEGER DEFAULT 20)
+RETURNS JSON
+LANGUAGE plpgsql STABLE
+AS $$
+DECLARE
+    v_text TEXT := normalize_search_text(p_query);
+    v_digits TEXT := normalize_phone(p_query);
+    v_prefix TSQUERY;
+BEGIN
+    SELECT to_tsquery('simple', string_agg(quote_literal(token) || ':*', ' & '))
+      INTO v_prefix
+      FROM regexp_split_to_table(v_text, '[^[:alnum:]]+') AS token
+     WHERE token <> '';
+    IF v_prefix IS NULL THEN
+        RETURN '[]'::json;
+    END IF;
+
+    -- Only treat the query as a phone number when it is mostly digits
+    IF length(v_digits) < 3 OR length(v_digits) * 2 < length(regexp_replace(p_query, '\s', '', 'g')) THEN
+        v_digits := NULL;
+    END IF;
+
+    RETURN COALESCE((
+        SELECT json_agg(r.row ORDER BY r.rank DESC, r.name)
+        FROM (
+            SELECT to_jsonb(c) - 'search_text' - 'search_phone' - 'search_vector'
+                       || jsonb_build_object('rank', round(ranked.rank::numeric, 4)) AS row,
+                   ranked.rank, c.name
+            FROM customers c
+            CROSS JOIN LATERAL (
+                SELECT GREATEST(
+                    CASE WHEN c.search_vector @@ v_prefix THEN 0.5 + ts_rank(c.search_vector, v_prefix) ELSE 0 END,
+                    word_similarity(v_text, c.search_text),
+                    CASE WHEN v_digits IS NOT NULL AND c.search_phone LIKE '%' || v_digits || '%' THEN 1 ELSE 0 END
+                ) AS rank
+            ) ranked
+            WHERE c.search_vector @@ v_prefix
+               OR v_text <% c.search_text
+               OR (v_digits IS NOT NULL AND c.search_phone LIKE '%' || v_digits || '%')
+            ORDER BY ranked.rank DESC, c.name
+            LIMIT LEAST(GREATEST(p_limit, 1), 100)
+        ) r
+    ), '[]'::json);
+END;
+$$;
+
+-- ─── Revenue rollups ────────────────────────────────────────────
+-- Revenue is booked on the day an estimate first reaches a done status
+-- (completed_at). Triggers keep two tables in step with estimates and
+-- their lines:
+--   revenue_entries  what each done estimate currently contributes, one row
+--                    per service on it plus one for the job itself (upsells
+--                    and manual adjustments to the subtotal)
+--   revenue_rollups  those entries summed per day and per month, by
+--                    technician, service and BTW rate
+-- Reports read the rollups, so their cost depends on the length of the
+-- period asked for, not on the number of estimates.
+ALTER TABLE estimates ADD COLUMN IF NOT EXISTS completed_at TIMESTAMPTZ;
+UPDATE estimates SET completed_at = updated_at
+WHERE completed_at IS NULL AND status IN ('voltooid', 'factuur', 'betaald');
+
+CREATE TABLE IF NOT EXISTS revenue_entries (
+    id BIGSERIAL PRIMARY KEY,
+    estimate_id UUID NOT NULL,
+    day DATE NOT NULL,
+    user_id UUID,
+    service_id UUID,
+    btw_percentage NUMERIC NOT NULL,
+    jobs INTEGER NOT NULL,
+    lines INTEGER NOT NULL,
+    subtotal NUMERIC NOT NULL,
+    btw NUMERIC NOT NULL,
+    total_incl_btw NUMERIC NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_revenue_entries_estimate ON revenue_entries(estimate_id);
+
+CREATE TABLE IF NOT EXISTS revenue_rollups (
+    grain TEXT NOT NULL CHECK (grain IN ('day', 'month')),
+    period DATE NOT NULL,
+    user_id UUID,
+    service_id UUID,
+    btw_percentage NUMERIC NOT NULL,
+    jobs INTEGER NOT NULL DEFAULT 0,
+    lines INTEGER NOT NULL DEFAULT 0,
+    subtotal NUMERIC NOT NULL DEFAULT 0,
+    btw NUMERIC NOT NULL DEFAULT 0,
+    total_incl_btw NUMERIC NOT NULL DEFAULT 0,
+    -- user_id/service_id are NULL for "unknown"/"no service"; still one row each
+    UNIQUE NULLS NOT DISTINCT (grain, period, user_id, service_id, btw_percentage)
+);
+
+-- Add (p_sign = 1) or take back (p_sign = -1) a set of revenue_entries rows
+CREATE OR REPLACE FUNCTION apply_revenue_entries(p_entries JSONB, p_sign INTEGER)
+RETURNS VOID LANGUAGE sql AS $$
+    INSERT INTO revenue_rollups AS r (grain, period, user_id, service_id, btw_percentage,
+                                      jobs, lines, subtotal, btw, total_incl_btw)
+    SELECT g.grain, g.period, e.user_id, e.service_id, e.btw_percentage,
+           p_sign * SUM(e.jobs), p_sign * SUM(e.lines), p_sign * SUM(e.subtotal),
+           p_sign * SUM(e.btw), p_sign * SUM(e.total_incl_btw)
+    FROM jsonb_to_recordset(COALESCE(p_entries, '[]'::jsonb)) AS e(
+        day DATE, user_id UUID, service_id UUID, btw_percentage NUMERIC,
+        jobs INTEGER, lines INTEGER, subtotal NUMERIC, btw NUMERIC, total_incl_btw NUMERIC)
+    CROSS JOIN LATERAL (VALUES ('day', e.day),
+                               ('month', date_trunc('month', e.day::timestamp)::date)) AS g(grain, period)
+    GROUP BY g.grain, g.period, e.user_id, e.service_id, e.btw_percentage
+    -- Same key order as the unique constraint, so concurrent jobs cannot deadlock
+    ORDER BY g.grain, g.period, e.user_id, e.service_id, e.btw_percentage
+    ON CONFLICT (grain, period, user_id, service_id, btw_percentage) DO UPDATE SET
+        jobs = r.jobs + EXCLUDED.jobs,
+        lines = r.lines + EXCLUDED.lines,
+        subtotal = r.subtotal + EXCLUDED.subtotal,
+        btw = r.btw + EXCLUDED.btw,
+        total_incl_btw = r.total_incl_btw + EXCLUDED.total_incl_btw;
+$$;
+
+-- Replace an estimate's contribution with one computed from its current
+-- state; a deleted or not (or no longer) done estimate contributes nothing
+CREATE OR REPLACE FUNCTION refresh_estimate_revenue(p_estimate_id UUID)
+RETURNS VOID LANGUAGE plpgsql AS $$
+DECLARE
+    v_removed JSONB;
+    v_added JSONB;
+BEGIN
+    WITH removed AS (
+        DELETE FROM revenue_entries WHERE estimate_id = p_estimate_id RETURNING *
+    )
+    SELECT jsonb_agg(to_jsonb(removed)) INTO v_removed FROM removed;
+    PERFORM apply_revenue_entries(v_removed, -1);
+
+    WITH e AS (
+        SELECT id, user_id, btw_percentage, subtotal, total_incl_btw - subtotal AS btw,
+               (completed_at AT TIME ZONE 'Europe/Amsterdam')::date AS day
+        FROM estimates
+        WHERE id = p_estimate_id AND completed_at IS NOT NULL
+    ), pieces AS (
+        SELECT service_id, SUM(jobs) AS jobs, SUM(lines) AS lines, SUM(amount) AS amount
+        FROM (
+            SELECT l.service_id, 0 AS jobs, 1 AS lines, l.line_total AS amount
+            FROM estimate_lines l JOIN e ON l.estimate_id = e.id
+            UNION ALL
+            -- The job itself: whatever of the subtotal the service lines do not explain
+            SELECT NULL, 1, 0, e.subtotal - COALESCE((
+                SELECT SUM(l.line_total) FROM estimate_lines l WHERE l.estimate_id = e.id), 0)
+            FROM e
+        ) p
+        GROUP BY service_id
+    ), shares AS (
+        -- BTW is split over the pieces in proportion to their amount; rounding
+        -- the running total means the parts add up to the estimate's BTW exactly
+        SELECT p.*, SUM(p.amount) OVER (ORDER BY p.service_id NULLS LAST) AS running
+        FROM pieces p
+    ), added AS (
+        INSERT INTO revenue_entries (estimate_id, day, user_id, service_id, btw_percentage,
+                                     jobs, lines, subtotal, btw, total_incl_btw)
+        SELECT e.id, e.day, e.user_id, s.service_id, e.btw_percentage, s.jobs, s.lines, s.amount, v.btw,
+               s.amount + v.btw
+        FROM shares s
+        CROSS JOIN e
+        CROSS JOIN LATERAL (SELECT CASE
+            WHEN e.subtotal = 0 THEN CASE WHEN s.service_id IS NULL THEN e.btw ELSE 0 END
+            ELSE round(s.running * e.btw / e.subtotal, 2) - round((s.running - s.amount) * e.btw / e.subtotal, 2)
+        END AS btw) v
+        RETURNING *
+    )
+    SELECT jsonb_agg(to_jsonb(added)) INTO v_added FROM added;
+    PERFORM apply_revenue_entries(v_added, 1);
+END;
+$$;
+
+-- completed_at is set when an estimate becomes done and cleared when it is
+-- reopened; moving between done statuses (factuur → betaald) keeps the date
+CREATE OR REPLACE FUNCTION estimates_set_completed_at()
+RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF NEW.status NOT IN ('voltooid', 'factuur', 'betaald') THEN
+        NEW.completed_at := NULL;
+    ELSIF TG_OP = 'UPDATE' AND OLD.status NOT IN ('voltooid', 'factuur', 'betaald') THEN
+        NEW.completed_at := NOW();
+    ELSE
+        NEW.completed_at := COALESCE(NEW.completed_at, NOW());
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION estimates_refresh_revenue()
+RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM refresh_estimate_revenue(OLD.id);
+    ELSE
+        PERFORM refresh_estimate_revenue(NEW.id);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+-- Lines only matter once the estimate is done (editing an invoice, say)
+CREATE OR REPLACE FUNCTION estimate_lines_refresh_revenue()
+RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM refresh_estimate_revenue(id) FROM estimates
+        WHERE id = OLD.estimate_id AND completed_at IS NOT NULL;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND (TG_OP = 'INSERT' OR NEW.estimate_id IS DISTINCT FROM OLD.estimate_id) THEN
+        PERFORM refresh_estimate_revenue(id) FROM estimates
+        WHERE id = NEW.estimate_id AND completed_at IS NOT NULL;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS estimates_completed_at ON estimates;
+CREATE TRIGGER estimates_completed_at
+    BEFORE INSERT OR UPDATE OF status, completed_at ON estimates
+    FOR EACH ROW EXECUTE FUNCTION estimates_set_completed_at();
+
+DROP TRIGGER IF EXISTS estimates_revenue_insert ON estimates;
+CREATE TRIGGER estimates_revenue_insert
+    AFTER INSERT ON estimates
+    FOR EACH ROW WHEN (NEW.completed_at IS NOT NULL)
+    EXECUTE FUNCTION estimates_refresh_revenue();
+
+DROP TRIGGER IF EXISTS estimates_revenue_update ON estimates;
+CREATE TRIGGER estimates_revenue_update
+    AFTER UPDATE OF status, completed_at, user_id, subtotal, btw_percentage, total_incl_btw ON estimates
+    FOR EACH ROW WHEN (OLD.completed_at IS NOT NULL OR NEW.completed_at IS NOT NULL)
+    EXECUTE FUNCTION estimates_refresh_revenue();
+
+DROP TRIGGER IF EXISTS estimates_revenue_delete ON estimates;
+CREATE TRIGGER estimates_revenue_delete
+    AFTER DELETE ON estimates
+    FOR EACH ROW WHEN (OLD.completed_at IS NOT NULL)
+    EXECUTE FUNCTION estimates_refresh_revenue();
+
+DROP TRIGGER IF EXISTS estimate_lines_revenue ON estimate_lines;
+CREATE TRIGGER estimate_lines_revenue
+    AFTER INSERT OR UPDATE OF estimate_id, service_id, line_total OR DELETE ON estimate_lines
+    FOR EACH ROW EXECUTE FUNCTION estimate_lines_refresh_revenue();
+
+-- Backfill; safe to run again, every estimate is recomputed from scratch
+SELECT refresh_estimate_revenue(id) FROM estimates WHERE completed_at IS NOT NULL;
+
+-- Revenue for [p_from, p_to) per p_period ('day', 'week', 'month',
+-- 'quarter', 'year' or 'total'), optionally split by any of p_group
+-- 'user', 'service' and 'btw'. Whole months are read from the month rows,
+-- only the partial months at the edges from the day rows.
+CREATE OR REPLACE FUNCTION revenue_report(p_from DATE, p_to DATE, p_period TEXT DEFAULT 'month',
+                                          p_group TEXT[] DEFAULT '{}')
+RETURNS JSON LANGUAGE sql STABLE AS $$
+    WITH bounds AS (
+        SELECT CASE WHEN p_period IN ('day', 'week') THEN NULL
+                    ELSE (date_trunc('month', (p_from - 1)::timestamp) + INTERVAL '1 month')::date
+               END AS month_from,
+               date_trunc('month', p_to::timestamp)::date AS month_to
+    ), source AS (
+        SELECT r.*
+        FROM revenue_rollups r, bounds b
+        WHERE (r.grain = 'month' AND r.period >= b.month_from AND r.period < b.month_to)
+           OR (r.grain = 'day' AND r.period >= p_from AND r.period < p_to
+               AND NOT (b.month_from IS NOT NULL AND r.period >= b.month_from AND r.period < b.month_to))
+    ), grouped AS (
+        SELECT CASE WHEN p_period = 'total' THEN p_from
+                    ELSE date_trunc(p_period, s.period::timestamp)::date END AS period,
+               CASE WHEN 'user' = ANY(p_group) THEN s.user_id END AS user_id,
+               CASE WHEN 'service' = ANY(p_group) THEN s.service_id END AS service_id,
+               CASE WHEN 'btw' = ANY(p_group) THEN s.btw_percentage END AS btw_percentage,
+               SUM(s.jobs) AS jobs, SUM(s.lines) AS lines, SUM(s.subtotal) AS subtotal,
+               SUM(s.btw) AS btw, SUM(s.total_incl_btw) AS total_incl_btw
+        FROM source s
+        GROUP BY 1, 2, 3, 4
+        HAVING SUM(s.jobs) <> 0 OR SUM(s.lines) <> 0
+    )
+    SELECT COALESCE(json_agg(r ORDER BY r.period, r.user_name, r.service_name, r.btw_percentage), '[]'::json)
+    FROM (
+        SELECT g.*, u.name AS user_name, sv.name AS service_name
+        FROM grouped g
+        LEFT JOIN users u ON u.id = g.user_id
+        LEFT JOIN services sv ON sv.id = g.service_id
+    ) r;
+$$;
+
+-- Dashboard: counts, revenue and low-stock items in one round trip.
+-- Revenue for the two months comes straight from the month rollups.
+CREATE OR REPLACE FUNCTION dashboard_summary(p_month_start DATE, p_last_month_start DATE)
+RETURNS JSON LANGUAGE sql STABLE AS $$
+    SELECT json_build_object(
+        'today_jobs', COALESCE((
+            SELECT json_agg(j ORDER BY j.created_at)
+            FROM (
+                SELECT e.id, e.customer_id, e.status, e.total_incl_btw, e.notes, e.created_at, e.updated_at,
+                       json_build_object('name', c.name, 'address', c.address) AS customers
+                FROM estimates e
+                JOIN customers c ON c.id = e.customer_id
+                WHERE e.status = 'akkoord'
+            ) j
+        ), '[]'::json),
+        'open_quotes_count', (SELECT COUNT(*) FROM estimates WHERE status = 'offerte'),
+        'month_revenue', (
+            SELECT COALESCE(SUM(total_incl_btw), 0) FROM revenue_rollups
+            WHERE grain = 'month' AND period = p_month_start
+        ),
+        'last_month_revenue', (
+            SELECT COALESCE(SUM(total_incl_btw), 0) FROM revenue_rollups
+            WHERE grain = 'month' AND period = p_last_month_start
+        ),
+        'inventory_warnings', COALESCE((
+            SELECT json_agg(i ORDER BY i.item_name)
+            FROM inventory i
+            WHERE i.quantity_on_hand <= i.threshold_warning
+        ), '[]'::json),
+        'customer_count', (SELECT COUNT(*) FROM customers)
+    );
+$$;
+
+-- ─── Delta sync ─────────────────────────────────────────────────
+-- Devices keep a copy of the synced tables and ask /api/sync for what
+-- changed since their cursor. Every row carries the id of the transaction
+-- that last wrote it (sync_txid) and deletes leave a tombstone. A cursor is
+-- the oldest transaction still running when the previous sync read its
+-- snapshot, so a write that commits late is never skipped; rows from
+-- transactions that had already committed may be sent twice, which is
+-- harmless for a client that upserts by id.
+ALTER TABLE services ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT NOW();
+ALTER TABLE upsell_items ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT NOW();
+
+ALTER TABLE customers ADD COLUMN IF NOT EXISTS sync_txid xid8 NOT NULL DEFAULT pg_current_xact_id();
+ALTER TABLE estimates ADD COLUMN IF NOT EXISTS sync_txid xid8 NOT NULL DEFAULT pg_current_xact_id();
+ALTER TABLE services ADD COLUMN IF NOT EXISTS sync_txid xid8 NOT NULL DEFAULT pg_current_xact_id();
+ALTER TABLE upsell_items ADD COLUMN IF NOT EXISTS sync_txid xid8 NOT NULL DEFAULT pg_current_xact_id();
+ALTER TABLE inventory ADD COLUMN IF NOT EXISTS sync_txid xid8 NOT NULL DEFAULT pg_current_xact_id();
+ALTER TABLE project_photos ADD COLUMN IF NOT EXISTS sync_txid xid8 NOT NULL DEFAULT pg_current_xact_id();
+CREATE INDEX IF NOT EXISTS idx_customers_sync ON customers(sync_txid, id);
+CREATE INDEX IF NOT EXISTS idx_estimates_sync ON estimates(sync_txid, id);
+CREATE INDEX IF NOT EXISTS idx_services_sync ON services(sync_txid, id);
+CREATE INDEX IF NOT EXISTS idx_upsell_items_sync ON upsell_items(sync_txid, id);
+CREATE INDEX IF NOT EXISTS idx_inventory_sync ON inventory(sync_txid, id);
+CREATE INDEX IF NOT EXISTS idx_project_photos_sync ON project_photos(sync_txid, id);
+
+CREATE TABLE IF NOT EXISTS sync_tombstones (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    table_name TEXT NOT NULL,
+    row_id UUID NOT NULL,
+    sync_txid xid8 NOT NULL DEFAULT pg_current_xact_id(),
+    deleted_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS idx_sync_tombstones_sync ON sync_tombstones(sync_txid, id);
+CREATE INDEX IF NOT EXISTS idx_sync_tombstones_deleted_at ON sync_tombstones(deleted_at);
+
+-- Newest transaction whose tombstones have been purged; older cursors
+-- cannot be served a complete delta any more and start over
+CREATE TABLE IF NOT EXISTS sync_horizon (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    horizon xid8 NOT NULL DEFAULT '0'
+);
+INSERT INTO sync_horizon DEFAULT VALUES ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION sync_touch()
+RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.sync_txid := pg_current_xact_id();
+    RETURN NEW;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION set_updated_at()
+RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.updated_at := NOW();
+    RETURN NEW;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION sync_tombstone()
+RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO sync_tombstones (table_name, row_id)
+    SELECT TG_TABLE_NAME, id FROM old_rows;
+    RETURN NULL;
+END;
+$$;
+
+DO $$
+DECLARE
+    t TEXT;
+BEGIN
+    FOREACH t IN ARRAY ARRAY['customers', 'estimates', 'services', 'upsell_items', 'inventory', 'project_photos'] LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', t || '_sync_touch', t);
+        EXECUTE format('CREATE TRIGGER %I BEFORE INSERT OR UPDATE ON %I
+                        FOR EACH ROW EXECUTE FUNCTION sync_touch()', t || '_sync_touch', t);
+        -- Statement level, so deleting a customer with all its estimates
+        -- and photos writes each table's tombstones in one insert
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', t || '_sync_tombstone', t);
+        EXECUTE format('CREATE TRIGGER %I AFTER DELETE ON %I REFERENCING OLD TABLE AS old_rows
+                        FOR EACH STATEMENT EXECUTE FUNCTION sync_tombstone()', t || '_sync_tombstone', t);
+    END LOOP;
+    FOREACH t IN ARRAY ARRAY['customers', 'estimates', 'services', 'upsell_items', 'inventory'] LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', t || '_updated_at', t);
+        EXECUTE format('CREATE TRIGGER %I BEFORE UPDATE ON %I
+                        FOR EACH ROW EXECUTE FUNCTION set_updated_at()', t || '_updated_at', t);
+    END LOOP;
+END;
+$$;
+
+-- One page of changes since p_since (NULL: everything, for a first sync).
+-- Tables are read in a fixed order, each by (sync_txid, id); a page that
+-- fills up returns where to continue as "next". Returns {"reset": true}
+-- when tombstones the cursor still needs have been purged.
+CREATE OR REPLACE FUNCTION sync_changes(p_since xid8, p_table TEXT DEFAULT NULL, p_after_txid xid8 DEFAULT NULL,
+                                        p_after_id UUID DEFAULT NULL, p_limit INTEGER DEFAULT 1000)
+RETURNS JSONB LANGUAGE plpgsql STABLE AS $$
+DECLARE
+    v_tables TEXT[] := ARRAY['customers', 'estimates', 'services', 'upsell_items', 'inventory', 'project_photos',
+                             'sync_tombstones'];
+    -- Columns devices have no use for: search internals and large blobs
+    -- that have their own endpoints
+    v_omit JSONB := '{"customers": ["search_text", "search_phone", "search_vector"],
+                      "estimates": ["signature_data"],
+                      "project_photos": ["photo_data"]}';
+    v_left INTEGER := GREATEST(p_limit, 1);
+    v_changes JSONB := '{}';
+    v_deleted JSONB := '{}';
+    v_next JSONB;
+    v_table TEXT;
+    v_first BOOLEAN := TRUE;
+    v_rows JSONB;
+    v_count INTEGER;
+    v_last_txid xid8;
+    v_last_id UUID;
+BEGIN
+    IF p_since IS NOT NULL AND p_since <= (SELECT horizon FROM sync_horizon) THEN
+        RETURN jsonb_build_object('reset', TRUE);
+    END IF;
+
+    FOR i IN COALESCE(array_position(v_tables, p_table), 1) .. array_length(v_tables, 1) LOOP
+        v_table := v_tables[i];
+        -- A first sync has nothing to delete
+        CONTINUE WHEN v_table = 'sync_tombstones' AND p_since IS NULL;
+
+        EXECUTE format($q$
+            SELECT COALESCE(jsonb_agg(to_jsonb(r) - 'sync_txid' - $5 ORDER BY r.sync_txid, r.id), '[]'::jsonb),
+                   COUNT(*),
+                   (array_agg(r.sync_txid ORDER BY r.sync_txid DESC, r.id DESC))[1],
+                   (array_agg(r.id ORDER BY r.sync_txid DESC, r.id DESC))[1]
+            FROM (
+                SELECT * FROM %I
+                WHERE ($1 IS NULL OR sync_txid >= $1)
+                  AND ($2 IS NULL OR (sync_txid, id) > ($2, $3))
+                ORDER BY sync_txid, id
+                LIMIT $4
+            ) r
+        $q$, v_table)
+        INTO v_rows, v_count, v_last_txid, v_last_id
+        USING p_since,
+              CASE WHEN v_first THEN p_after_txid END,
+              CASE WHEN v_first THEN p_after_id END,
+              v_left,
+              ARRAY(SELECT jsonb_array_elements_text(COALESCE(v_omit->v_table, '[]'::jsonb)));
+        v_first := FALSE;
+
+        IF v_table = 'sync_tombstones' THEN
+            SELECT COALESCE(jsonb_object_agg(table_name, ids), '{}'::jsonb) INTO v_deleted
+            FROM (
+                SELECT t->>'table_name' AS table_name, jsonb_agg(DISTINCT t->'row_id') AS ids
+                FROM jsonb_array_elements(v_rows) t
+                GROUP BY 1
+            ) d;
+        ELSIF v_count > 0 THEN
+            v_changes := v_changes || jsonb_build_object(v_table, v_rows);
+        END IF;
+
+        v_left := v_left - v_count;
+        IF v_left <= 0 THEN
+            v_next := jsonb_build_object('table', v_table, 'txid', v_last_txid::text, 'id', v_last_id);
+            EXIT;
+        END IF;
+    END LOOP;
+
+    RETURN jsonb_build_object(
+        'changes', v_changes,
+        'deleted', v_deleted,
+        'next', v_next,
+        'xmin', pg_snapshot_xmin(pg_current_snapshot())::text
+    );
+END;
+$$;
+
+-- Drop tombstones older than p_keep_days; devices that have not synced
+-- for that long get a full sync instead
+CREATE OR REPLACE FUNCTION purge_sync_tombstones(p_keep_days INTEGER DEFAULT 30)
+RETURNS INTEGER LANGUAGE plpgsql AS $$
+DECLARE
+    v_count INTEGER;
+    v_newest xid8;
+BEGIN
+    WITH purged AS (
+        DELETE FROM sync_tombstones WHERE deleted_at < NOW() - make_interval(days => p_keep_days)
+        RETURNING sync_txid
+    )
+    SELECT COUNT(*), (array_agg(sync_txid ORDER BY sync_txid DESC))[1] INTO v_count, v_newest FROM purged;
+
+    IF v_newest IS NOT NULL THEN
+        UPDATE sync_horizon SET horizon = GREATEST(horizon, v_newest);
+    END IF;
+    RETURN v_count;
+END;
+$$;
+
+-- ─── Signatures in object storage ───────────────────────────────
+-- A signature is a normalized PNG in the photo store, named by its sha256;
+-- signature_data only holds rows that have not been moved yet by
+-- `flask --app app migrate-signatures`.
+ALTER TABLE estimates ADD COLUMN IF NOT EXISTS signature_sha256 TEXT;
+
+-- ─── Customer import ────────────────────────────────────────────
+-- Lowercase, postcode folded like normalize_search_text(), punctuation and
+-- runs of spaces collapsed: "Dorpsstraat 1, 1234 AB" → "dorpsstraat 1 1234ab"
+CREATE OR REPLACE FUNCTION normalize_address(p_address TEXT)
+RETURNS TEXT
+LANGUAGE sql IMMUTABLE PARALLEL SAFE
+AS $$
+    SELECT btrim(regexp_replace(normalize_search_text(p_address), '[^[:alnum:]]+', ' ', 'g'));
+$$;
+
+-- Lookups that match import rows to existing customers
+CREATE INDEX IF NOT EXISTS idx_customers_email_lower ON customers (lower(btrim(email)))
+    WHERE COALESCE(btrim(email), '') <> '';
+CREATE INDEX IF NOT EXISTS idx_customers_phone_exact ON customers (search_phone)
+    WHERE search_phone <> '';
+CREATE INDEX IF NOT EXISTS idx_customers_address_norm ON customers (normalize_address(address))
+    WHERE COALESCE(btrim(address), '') <> '';
+
+-- One batch of validated import rows ({row, name, address, ...}). A row
+-- that matches an existing customer on e-mail, then phone, then address is
+-- skipped, or with p_update merged into it (empty fields keep the current
+-- value). New customers get the same defaults as the customer form.
+-- Returns [{row, id, action}] with action inserted/updated/skipped.
+CREATE OR REPLACE FUNCTION import_customers(p_rows JSONB, p_update BOOLEAN DEFAULT FALSE)
+RETURNS JSONB LANGUAGE plpgsql AS $$
+DECLARE
+    r JSONB;
+    v_id UUID;
+    v_action TEXT;
+    v_email TEXT;
+    v_phone TEXT;
+    v_address TEXT;
+    v_out JSONB := '[]';
+BEGIN
+    FOR r IN SELECT value FROM jsonb_array_elements(p_rows) LOOP
+        v_email := NULLIF(lower(btrim(r->>'email')), '');
+        v_phone := NULLIF(normalize_phone(r->>'phone'), '');
+        v_address := NULLIF(normalize_address(r->>'address'), '');
+        v_id := NULL;
+
+        IF v_email IS NOT NULL THEN
+            SELECT id INTO v_id FROM customers
+             WHERE COALESCE(btrim(email), '') <> '' AND lower(btrim(email)) = v_email
+             ORDER BY created_at LIMIT 1;
+        END IF;
+        IF v_id IS NULL AND v_phone IS NOT NULL THEN
+            SELECT id INTO v_id FROM customers
+             WHERE search_phone <> '' AND search_phone = v_phone
+             ORDER BY created_at LIMIT 1;
+        END IF;
+        IF v_id IS NULL AND v_address IS NOT NULL THEN
+            SELECT id INTO v_id FROM customers
+             WHERE COALESCE(btrim(address), '') <> '' AND normalize_address(address) = v_address
+             ORDER BY created_at LIMIT 1;
+        END IF;
+
+        IF v_id IS NULL THEN
+            INSERT INTO customers (name, address, phone, email, parking_situation, water_tap_location,
+                                   water_pressure_lpm, notes)
+            VALUES (r->>'name', r->>'address', r->>'phone', r->>'email',
+                    COALESCE(NULLIF(r->>'parking_situation', ''), 'oprit'), r->>'water_tap_location',
+                    COALESCE((r->>'water_pressure_lpm')::numeric, 0), r->>'notes')
+            RETURNING id INTO v_id;
+            v_action := 'inserted';
+        ELSIF p_update THEN
+            UPDATE customers SET
+                name = r->>'name',
+                address = COALESCE(NULLIF(r->>'address', ''), address),
+                phone = COALESCE(NULLIF(r->>'phone', ''), phone),
+                email = COALESCE(NULLIF(r->>'email', ''), email),
+                parking_situation = COALESCE(NULLIF(r->>'parking_situation', ''), parking_situation),
+                water_tap_location = COALESCE(NULLIF(r->>'water_tap_location', ''), water_tap_location),
+                water_pressure_lpm = COALESCE((r->>'water_pressure_lpm')::numeric, water_pressure_lpm),
+                notes = COALESCE(NULLIF(r->>'notes', ''), notes),
+                updated_at = NOW()
+             WHERE id = v_id;
+            v_action := 'updated';
+        ELSE
+            v_action := 'skipped';
+        END IF;
+
+        v_out := v_out || jsonb_build_object('row', r->'row', 'id', v_id, 'action', v_action);
+    END LOOP;
+    RETURN v_out;
+END;
+$$;
+
+-- ─── Cache invalidation bus ─────────────────────────────────────
+-- Only used with CACHE_BUS=postgres (see bus.py). One version counter per
+-- cache tag; every app process LISTENs on cache_invalidation and drops
+-- cached data of a tag once its version moves on.
+CREATE TABLE IF NOT EXISTS cache_versions (
+    tag TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- Raise the versions of p_tags and notify every listener with the new
+-- versions ({tag: version}); the notification goes out when the calling
+-- transaction commits. Returns the same object.
+CREATE OR REPLACE FUNCTION bump_cache_versions(p_tags TEXT[])
+RETURNS JSONB LANGUAGE plpgsql AS $$
+DECLARE
+    v_versions JSONB;
+BEGIN
+    WITH bumped AS (
+        INSERT INTO cache_versions AS c (tag, version)
+        SELECT DISTINCT t, 1 FROM unnest(p_tags) AS t
+        ON CONFLICT (tag) DO UPDATE SET version = c.version + 1, updated_at = NOW()
+        RETURNING c.tag, c.version
+    )
+    SELECT COALESCE(jsonb_object_agg(tag, version), '{}'::jsonb) INTO v_versions FROM bumped;
+    PERFORM pg_notify('cache_invalidation', v_versions::text);
+    RETURN v_versions;
+END;
+$$;